@@ -2,8 +2,8 @@
 set -e
 # -------------------------------------------------------------
 #
-# Sets up user DBus session, Xvfb, Brave Browser with remote debugging,
-# and starts VNC, noVNC and FastAPI services.
+# Sets up user DBus session, one Xvfb + Brave (remote debugging) per
+# browser worker, and starts VNC (worker 0's display), noVNC and FastAPI.
 # -------------------------------------------------------------
 
 start_dbus() {
@@ -16,50 +16,25 @@ start_dbus() {
 
 setup_display() {
     if [ -z "$DISPLAY" ]; then
-        export DISPLAY=:99
+        export DISPLAY=:${TENSHI_DISPLAY_BASE:-99}
         echo "DISPLAY variable set to $DISPLAY"
     fi
-
-    if [ ! -d /tmp/.X11-unix ]; then
-        echo "Creating /tmp/.X11-unix..."
-        mkdir -p /tmp/.X11-unix && chmod 1777 /tmp/.X11-unix
-    fi
-
-    if ! pgrep -x "Xvfb" >/dev/null; then
-        echo "Starting Xvfb on DISPLAY $DISPLAY..."
-        Xvfb "$DISPLAY" -screen 0 1920x1080x24 &
-        sleep 2
-    fi
 }
 
-setup_brave_preferences() {
-    CUSTOM_USER_DATA="/tenshi/BraveData"
-    mkdir -p "$CUSTOM_USER_DATA/Default"
-    PREF_FILE="$CUSTOM_USER_DATA/Default/Preferences"
-    if [ ! -f "$PREF_FILE" ]; then
-        echo "Creating Preferences file..."
-        cat <<EOF >"$PREF_FILE"
-{
-  "download": {
-    "default_directory": "/tenshi"
-  }
-}
-EOF
-    else
-        echo "Updating Preferences file for download directory..."
-        tmp_file=$(mktemp)
-        jq '.download.default_directory="/tenshi"' "$PREF_FILE" >"$tmp_file" && mv "$tmp_file" "$PREF_FILE"
-    fi
+start_browser_workers() {
+    # Each worker gets its own Xvfb display, Brave profile and CDP port
+    WORKERS=${TENSHI_BROWSER_WORKERS:-1}
+    for i in $(seq 0 $((WORKERS - 1))); do
+        /tenshi/config/start_browser.sh "$i"
+    done
 }
 
 start_services() {
-    TARGET_URL=${TARGET_URL:-"about:blank"}
-    echo "Launching Brave Browser with URL: $TARGET_URL"
-    brave-browser --user-data-dir="$CUSTOM_USER_DATA" \
-        --enable-unsafe-swiftshader --no-sandbox --disable-setuid-sandbox \
-        --disable-gpu --no-first-run --remote-debugging-port=9223 "$TARGET_URL" &
-    echo "Starting socat to forward 9222->127.0.0.1:9223"
-    socat TCP4-LISTEN:9222,fork TCP4:127.0.0.1:9223 &
+    start_browser_workers
+    # Port 9222 stays the published CDP port; it reaches worker 0's browser
+    CDP_PORT=${TENSHI_CDP_PORT_BASE:-9223}
+    echo "Starting socat to forward 9222->127.0.0.1:$CDP_PORT (worker 0)"
+    socat TCP4-LISTEN:9222,fork "TCP4:127.0.0.1:$CDP_PORT" &
 
     if [ -z "$VNC_PASSWORD" ]; then
         echo "VNC_PASSWORD not set. Exiting."
@@ -72,12 +47,11 @@ start_services() {
     echo "Starting noVNC..."
     websockify --web=/usr/share/novnc 6080 localhost:5900 &
     echo "Starting FastAPI server..."
-    python3 /tenshi/scripts/fastapi_server.py &
+    python3 -m scripts &
 }
 
 start_dbus
 setup_display
-setup_brave_preferences
 start_services
 
 # Keep container alive.
@@ -0,0 +1,72 @@
+#!/bin/bash
+set -e
+# -------------------------------------------------------------
+#
+# Starts (or restarts) browser worker <index>: its own Xvfb display,
+# Brave profile directory and remote debugging port. Called once per
+# worker by entrypoint.sh and again by the FastAPI server to recycle an
+# unhealthy worker.
+# -------------------------------------------------------------
+
+INDEX=${1:-0}
+DISPLAY_NUM=$((${TENSHI_DISPLAY_BASE:-99} + INDEX))
+CDP_PORT=$((${TENSHI_CDP_PORT_BASE:-9223} + INDEX))
+if [ "$INDEX" -eq 0 ]; then
+    USER_DATA="/tenshi/BraveData"
+else
+    USER_DATA="/tenshi/BraveData-$INDEX"
+fi
+export DISPLAY=":$DISPLAY_NUM"
+
+start_xvfb() {
+    if [ ! -d /tmp/.X11-unix ]; then
+        mkdir -p /tmp/.X11-unix && chmod 1777 /tmp/.X11-unix
+    fi
+    if ! pgrep -f "Xvfb $DISPLAY( |$)" >/dev/null; then
+        echo "Starting Xvfb on DISPLAY $DISPLAY..."
+        rm -f "/tmp/.X11-unix/X$DISPLAY_NUM" "/tmp/.X$DISPLAY_NUM-lock"
+        Xvfb "$DISPLAY" -screen 0 1920x1080x24 &
+        for _ in $(seq 1 50); do
+            [ -e "/tmp/.X11-unix/X$DISPLAY_NUM" ] && break
+            sleep 0.1
+        done
+    fi
+}
+
+setup_brave_preferences() {
+    mkdir -p "$USER_DATA/Default"
+    PREF_FILE="$USER_DATA/Default/Preferences"
+    if [ ! -f "$PREF_FILE" ]; then
+        echo "Creating Preferences file..."
+        cat <<PREFS >"$PREF_FILE"
+{
+  "download": {
+    "default_directory": "/tenshi"
+  }
+}
+PREFS
+    else
+        echo "Updating Preferences file for download directory..."
+        tmp_file=$(mktemp)
+        jq '.download.default_directory="/tenshi"' "$PREF_FILE" >"$tmp_file" && mv "$tmp_file" "$PREF_FILE"
+    fi
+}
+
+start_brave() {
+    # Stop a previous instance of this worker's browser (recycling)
+    if pkill -f -- "--user-data-dir=$USER_DATA( |$)"; then
+        sleep 1
+        pkill -9 -f -- "--user-data-dir=$USER_DATA( |$)" || true
+    fi
+    rm -f "$USER_DATA/SingletonLock"
+    TARGET_URL=${TARGET_URL:-"about:blank"}
+    echo "Launching Brave worker $INDEX on $DISPLAY (CDP port $CDP_PORT) with URL: $TARGET_URL"
+    brave-browser --user-data-dir="$USER_DATA" \
+        --enable-unsafe-swiftshader --no-sandbox --disable-setuid-sandbox \
+        --disable-gpu --no-first-run --remote-debugging-port="$CDP_PORT" "$TARGET_URL" \
+        >"/tmp/brave-$INDEX.log" 2>&1 &
+}
+
+start_xvfb
+setup_brave_preferences
+start_brave
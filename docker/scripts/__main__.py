@@ -0,0 +1,12 @@
+"""
+Start the API server: `python3 -m scripts`.
+
+Spawned worker processes (the variant transcoders) re-import the main
+module unless it is a package `__main__` like this one, so it imports
+nothing beyond what it needs to run uvicorn.
+"""
+
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run("scripts.fastapi_server:app", host="0.0.0.0", port=8000)
@@ -0,0 +1,209 @@
+"""
+Content-addressed image storage (optional, TENSHI_DEDUP=1).
+
+Every saved image is also kept once under /tenshi/data/.blobs/<aa>/<sha256>,
+and chapter files (000.jpg, …) are hardlinks to those blobs, so a credit
+page repeated in every chapter occupies disk space once. Bytes already in
+hand (captured or single-image saves) are checked against the store before
+anything is written, and a URL → hash index lets downloads of previously
+seen URLs be replaced by a link.
+
+Chapter files are only ever replaced by rename, never rewritten in place,
+so writing a chapter file can never alter a shared blob.
+"""
+
+import errno
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from scripts.file_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+DEDUP = os.environ.get("TENSHI_DEDUP", "0") == "1"
+BLOB_DIR = "/tenshi/data/.blobs"
+URL_INDEX_NAME = "urls.json"
+# os.link failures that mean hardlinks cannot be used here (other device,
+# filesystem without hardlinks, too many links)
+NO_LINK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK)
+
+
+class BlobStore:
+    """Blobs keyed by SHA-256, hardlinked into chapter directories."""
+
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+        self.links = 0
+        self.url_hits = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._link_failed = False
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(os.path.join(root, URL_INDEX_NAME)) as f:
+                self._urls: dict[str, str] = json.load(f)
+        except (OSError, ValueError):
+            self._urls = {}
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def has(self, sha256: str) -> bool:
+        return os.path.isfile(self.blob_path(sha256))
+
+    def lookup_url(self, url: str) -> str | None:
+        """Hash of the blob last saved from `url`, if it is still stored."""
+        with self._lock:
+            sha256 = self._urls.get(url)
+        if sha256 and self.has(sha256):
+            with self._lock:
+                self.url_hits += 1
+            return sha256
+        return None
+
+    def _link(self, sha256: str, path: str, copy: bool = False) -> None:
+        """
+        Atomically replace `path` with a hardlink to the blob (or, with
+        `copy`, a copy of it).
+        """
+        tmp = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}")
+        try:
+            if copy:
+                shutil.copyfile(self.blob_path(sha256), tmp)
+            else:
+                os.link(self.blob_path(sha256), tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        if not copy:
+            with self._lock:
+                self.links += 1
+
+    def _links_unavailable(self, error: OSError) -> None:
+        if error.errno not in NO_LINK_ERRNOS:
+            raise error
+        if not self._link_failed:
+            logger.warning("Hardlinks unavailable (%s); storing plain files", error)
+            self._link_failed = True
+
+    def link_to(self, sha256: str, path: str, url: str | None = None) -> int:
+        """
+        Point `path` at an existing blob instead of writing its bytes, and
+        return the blob's size. Falls back to copying the blob where
+        hardlinks are unavailable.
+        """
+        size = os.path.getsize(self.blob_path(sha256))
+        try:
+            self._link(sha256, path)
+        except OSError as e:
+            self._links_unavailable(e)
+            self._link(sha256, path, copy=True)
+        else:
+            with self._lock:
+                self.bytes_saved += size
+        self._remember(url, sha256)
+        return size
+
+    def adopt(self, path: str, sha256: str, url: str | None = None) -> bool:
+        """
+        Deduplicate a freshly written file: link it to the existing blob
+        with the same hash, or make it the blob. Returns True if the file
+        turned out to be a duplicate.
+        """
+        blob = self.blob_path(sha256)
+        try:
+            if os.path.isfile(blob):
+                if not os.path.samefile(blob, path):
+                    self._link(sha256, path)
+                    self._remember(url, sha256)
+                    return True
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(path, blob)
+        except FileExistsError:
+            # Another worker stored the same blob concurrently
+            return self.adopt(path, sha256, url)
+        except OSError as e:
+            self._links_unavailable(e)
+            return False
+        self._remember(url, sha256)
+        return False
+
+    def write(self, path: str, data: bytes, sha256: str, url: str | None) -> bool:
+        """
+        Save `data` at `path`, linking to the stored blob instead of writing
+        when its hash is already known. Returns True if it was a duplicate.
+        """
+        if self.has(sha256):
+            self.link_to(sha256, path, url)
+            return True
+        atomic_write(path, data)
+        return self.adopt(path, sha256, url)
+
+    def _remember(self, url: str | None, sha256: str) -> None:
+        if not url:
+            return
+        with self._lock:
+            if self._urls.get(url) != sha256:
+                self._urls[url] = sha256
+                self._dirty = True
+
+    def save_index(self) -> None:
+        """Persist the URL → hash index if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._urls, sort_keys=True).encode()
+            self._dirty = False
+        atomic_write(os.path.join(self.root, URL_INDEX_NAME), data)
+
+    def stats(self) -> dict:
+        """
+        Dedup report: blobs stored, bytes on disk, bytes the chapter files
+        would occupy without sharing, and counters since startup.
+        """
+        blobs = stored = logical = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name == URL_INDEX_NAME:
+                    continue
+                st = os.stat(os.path.join(dirpath, name))
+                blobs += 1
+                stored += st.st_size
+                # Every link besides the blob itself is a chapter file
+                logical += st.st_size * max(st.st_nlink - 1, 1)
+        with self._lock:
+            return {
+                "enabled": True,
+                "blobs": blobs,
+                "stored_bytes": stored,
+                "logical_bytes": logical,
+                "saved_bytes": logical - stored,
+                "known_urls": len(self._urls),
+                "session": {
+                    "links": self.links,
+                    "url_hits": self.url_hits,
+                    "bytes_not_written": self.bytes_saved,
+                },
+            }
+
+
+_store: BlobStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore | None:
+    """The process-wide blob store, or None when dedup is disabled."""
+    global _store
+    if not DEDUP:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = BlobStore()
+        return _store
@@ -0,0 +1,123 @@
+"""
+Browser control for Tenshi: CDP navigation of the visible Brave tab, window
+focus via xdotool for the screen automation, plus the in-process Cloudflare
+trigger flow shared by the FastAPI server and the save_* automation scripts.
+"""
+
+import logging
+import subprocess
+import threading
+
+from scripts import cloudflare_automation
+from scripts.browser_pool import get_browser_pool
+from scripts.clearance_cache import ChallengeError, ClearanceCache
+from scripts.screen_capture import current_display, display_env
+
+logger = logging.getLogger(__name__)
+
+# Keyboard/mouse input goes to a shared display; only one flow may drive
+# each display at a time.
+_display_locks: dict[str | None, threading.Lock] = {}
+_display_locks_lock = threading.Lock()
+
+
+def display_lock(display: str | None = None) -> threading.Lock:
+    """The lock serialising screen automation on `display` (default: current)."""
+    display = display or current_display()
+    with _display_locks_lock:
+        return _display_locks.setdefault(display, threading.Lock())
+
+
+class BrowserUpdateError(Exception):
+    """Raised when the browser could not be pointed at the requested URL."""
+
+
+def activate_browser():
+    """Finds the visible Brave browser window and gives it input focus."""
+    window_ids = (
+        subprocess.check_output(
+            ["xdotool", "search", "--onlyvisible", "--class", "Brave-browser"],
+            env=display_env(),
+        )
+        .decode()
+        .split()
+    )
+    if not window_ids:
+        raise Exception("No visible Brave browser window found.")
+    window_id = window_ids[0]
+    logging.info("Found Brave window id: %s", window_id)
+    activate = ["xdotool", "windowactivate", "--sync", window_id]
+    if subprocess.call(activate, env=display_env()) != 0:
+        logging.warning("Window activation failed.")
+    return window_id
+
+
+def update_browser_url(target_url: str):
+    """
+    Navigate the visible tab to `target_url` over CDP and wait for its load
+    event, then make sure the window has focus for the screen automation.
+    """
+    try:
+        get_browser_pool().navigate(target_url)
+        activate_browser()
+    except Exception as e:
+        logging.error("Error updating browser URL: %s", e)
+        raise
+
+
+def trigger(url: str) -> None:
+    """
+    Load `url` in the visible browser and run the Cloudflare automation
+    in-process. Raises BrowserUpdateError if navigation fails.
+    """
+    with display_lock():
+        try:
+            update_browser_url(url)
+        except Exception as e:
+            raise BrowserUpdateError(str(e)) from e
+        logger.info("Starting Cloudflare automation in-process...")
+        cloudflare_automation.main()
+
+
+def bypass_cf(chapter_url: str, force: bool = False):
+    """
+    Run the Cloudflare trigger for `chapter_url` unless the browser already
+    holds clearance for its domain (or `force` is set).
+    """
+    if not force and get_browser_pool().clearance.is_valid(chapter_url):
+        logging.info("Reusing CF clearance for %s", chapter_url)
+        return
+    try:
+        logging.info("Bypassing CF for chapter %s", chapter_url)
+        trigger(chapter_url)
+        logging.info("✅ CF bypass completed for %s", chapter_url)
+    except Exception as e:
+        logging.warning("CF bypass failed: %s", e)
+
+
+async def _run_and_record(page, clearance: ClearanceCache, fn, url: str, *args):
+    result = await fn(page, url, *args)
+    clearance.store(url, await page.context.cookies(url))
+    return result
+
+
+def run_with_clearance(fn, url: str, *args, timeout: float | None = None):
+    """
+    Run `await fn(page, url, *args)` on a pooled page after making sure the
+    browser is cleared for `url`. `fn` raises ChallengeError when it lands
+    on a challenge; the cached clearance is then dropped and the full bypass
+    runs once before retrying. Successful runs refresh the cache.
+    """
+    pool = get_browser_pool()
+    bypass_cf(url)
+    try:
+        return pool.run(
+            _run_and_record, pool.clearance, fn, url, *args, timeout=timeout
+        )
+    except ChallengeError as e:
+        logging.warning("%s; re-running CF bypass", e)
+        pool.clearance.invalidate(url)
+        bypass_cf(url, force=True)
+        return pool.run(
+            _run_and_record, pool.clearance, fn, url, *args, timeout=timeout
+        )
@@ -0,0 +1,376 @@
+"""
+Persistent CDP connection to the Brave instance, shared by all automation.
+
+`BrowserPool` keeps one async Playwright connection alive on a dedicated
+event-loop thread and hands out reusable pages (tabs). Synchronous callers
+(job workers, CLI scripts) use `run()` to execute a coroutine against a
+leased page; the connection is re-established automatically if Brave
+restarts. `navigate()` drives the visible tab the screen automation
+watches, which is never handed out as a pooled page. Pooled tabs are also
+remembered by CDP target ID, so the ones left over from a lost connection
+are closed on reconnect instead of being mistaken for the visible tab.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable
+
+from playwright.async_api import Browser, BrowserContext, Page
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import async_playwright
+from scripts.clearance_cache import ClearanceCache
+from scripts.metrics import NAVIGATION_SECONDS
+from scripts.utils import CDP_ENDPOINT
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of pages leased at once
+PAGE_POOL_SIZE = int(os.environ.get("TENSHI_PAGE_POOL_SIZE", "4"))
+# Connection attempts (with linear backoff) before a lease fails
+CONNECT_ATTEMPTS = 3
+CONNECT_BACKOFF = 2.0
+# Seconds to wait for the load event when navigating the visible tab
+NAVIGATION_TIMEOUT = 30.0
+
+
+class BrowserPool:
+    """A long-lived CDP connection plus a pool of reusable pages."""
+
+    def __init__(self, cdp_endpoint: str = CDP_ENDPOINT, size: int = PAGE_POOL_SIZE):
+        self.cdp_endpoint = cdp_endpoint
+        self.size = size
+        self.reconnects = 0
+        # Cloudflare clearance held by this browser's profile, per domain
+        self.clearance = ClearanceCache()
+        self._connected_once = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._playwright = None
+        self._browser: Browser | None = None
+        self._context: BrowserContext | None = None
+        self._idle: list[Page] = []
+        # Pages created for leasing (-> CDP target ID); any other tab is the
+        # visible one
+        self._owned: dict[Page, str | None] = {}
+        # Target IDs of pooled tabs from a lost connection, closed on reconnect
+        self._orphans: set[str] = set()
+        self._in_use = 0
+        self._slots: asyncio.Semaphore | None = None
+        self._connect_lock: asyncio.Lock | None = None
+        self._start_lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Lifecycle (called from ordinary threads)
+    # ------------------------------------------------------------------
+    def start(self) -> None:
+        """Start the pool's event-loop thread. Connecting happens lazily."""
+        with self._start_lock:
+            if self._thread:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="browser-pool", daemon=True
+            )
+            self._thread.start()
+            self._call(self._init())
+
+    def close(self) -> None:
+        """Close pooled pages and the Playwright connection, then stop the loop."""
+        with self._start_lock:
+            if not self._thread:
+                return
+            try:
+                self._call(self._shutdown(), timeout=30)
+            finally:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                self._thread = None
+                self._loop = None
+
+    def submit(self, fn: Callable[..., Awaitable], *args) -> Future:
+        """
+        Schedule `await fn(page, *args)` on a leased page and return a
+        concurrent Future, so several pages can be prepared in parallel.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self._with_page(fn, *args), self._loop)
+
+    def run(
+        self, fn: Callable[..., Awaitable], *args, timeout: float | None = None
+    ) -> Any:
+        """
+        Run `await fn(page, *args)` on a leased page and return its result.
+        On timeout the coroutine is cancelled, which returns the page.
+        """
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def navigate(
+        self, url: str, wait_until: str = "load", timeout: float = NAVIGATION_TIMEOUT
+    ) -> int | None:
+        """
+        Point the visible browser tab at `url` over CDP, bring it to the
+        front and wait for `wait_until`. Returns the HTTP status, if any.
+        """
+        self.start()
+        return self._call(self._navigate(url, wait_until, timeout))
+
+    def request(
+        self, url: str, headers: dict[str, str], timeout: float
+    ) -> tuple[int, dict[str, str], bytes]:
+        """
+        GET `url` through the browser context's request API, which sends the
+        context's cookies (e.g. cf_clearance) and user agent. Returns the
+        status, lower-cased headers and body. No page is leased.
+        """
+        self.start()
+        return self._call(self._request(url, headers, timeout))
+
+    def health(self) -> dict:
+        """Connection status; reconnects if the browser went away."""
+        self.start()
+        return self._call(self._health())
+
+    def _call(self, coro, timeout: float | None = None) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    # ------------------------------------------------------------------
+    # Event-loop side
+    # ------------------------------------------------------------------
+    async def _init(self) -> None:
+        self._slots = asyncio.Semaphore(self.size)
+        self._connect_lock = asyncio.Lock()
+
+    async def _shutdown(self) -> None:
+        for page in self._idle:
+            if not page.is_closed():
+                await page.close()
+        self._idle.clear()
+        if self._browser and self._browser.is_connected():
+            # Disconnects from CDP without killing the shared Brave process
+            await self._browser.close()
+        if self._playwright:
+            await self._playwright.stop()
+        self._browser = self._context = self._playwright = None
+
+    def _forget_pages(self) -> None:
+        """Drop page handles of the current connection, remembering our tabs."""
+        self._orphans.update(target for target in self._owned.values() if target)
+        self._idle.clear()
+        self._owned.clear()
+
+    def _on_disconnected(self, browser: Browser) -> None:
+        if browser is self._browser:
+            logger.warning("Lost CDP connection to %s", self.cdp_endpoint)
+            self._browser = self._context = None
+            self._forget_pages()
+
+    async def _target_id(self, context: BrowserContext, page: Page) -> str | None:
+        try:
+            session = await context.new_cdp_session(page)
+            try:
+                info = await session.send("Target.getTargetInfo")
+            finally:
+                await session.detach()
+            return info["targetInfo"]["targetId"]
+        except Exception as e:
+            logger.debug("No CDP target ID for page: %s", e)
+            return None
+
+    async def _close_orphans(self, context: BrowserContext) -> None:
+        """Close pooled tabs opened over a previous connection."""
+        if not self._orphans:
+            return
+        for page in context.pages:
+            if await self._target_id(context, page) in self._orphans:
+                logger.info("Closing pooled tab left from a lost connection")
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+        self._orphans.clear()
+
+    async def _ensure_connected(self) -> BrowserContext:
+        async with self._connect_lock:
+            if self._browser and self._browser.is_connected() and self._context:
+                return self._context
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            for attempt in range(1, CONNECT_ATTEMPTS + 1):
+                try:
+                    browser = await self._playwright.chromium.connect_over_cdp(
+                        self.cdp_endpoint
+                    )
+                    break
+                except Exception as e:
+                    if attempt == CONNECT_ATTEMPTS:
+                        raise
+                    logger.warning(
+                        "CDP connect to %s failed (%s); retrying",
+                        self.cdp_endpoint,
+                        e,
+                    )
+                    await asyncio.sleep(CONNECT_BACKOFF * attempt)
+            if self._connected_once:
+                self.reconnects += 1
+            self._connected_once = True
+            browser.on("disconnected", self._on_disconnected)
+            self._browser = browser
+            self._context = (
+                browser.contexts[0] if browser.contexts else await browser.new_context()
+            )
+            self._forget_pages()
+            await self._close_orphans(self._context)
+            logger.info("Connected to browser over CDP at %s", self.cdp_endpoint)
+            return self._context
+
+    @asynccontextmanager
+    async def lease(self):
+        """Borrow a page from the pool; it is returned (or discarded) on exit."""
+        async with self._slots:
+            context = await self._ensure_connected()
+            page = None
+            while self._idle and page is None:
+                candidate = self._idle.pop()
+                if not candidate.is_closed():
+                    page = candidate
+            if page is None:
+                page = await context.new_page()
+                self._owned[page] = None  # owned before the lookup yields
+                self._owned[page] = await self._target_id(context, page)
+            self._in_use += 1
+            healthy = False
+            try:
+                yield page
+                healthy = True
+            finally:
+                self._in_use -= 1
+                await self._release(page, healthy)
+
+    async def _release(self, page: Page, healthy: bool) -> None:
+        if page.is_closed():
+            self._owned.pop(page, None)
+            return
+        if healthy and self._browser and self._browser.is_connected():
+            try:
+                await page.goto("about:blank")
+                self._idle.append(page)
+                return
+            except Exception as e:
+                logger.debug("Discarding pooled page: %s", e)
+        self._owned.pop(page, None)
+        try:
+            await page.close()
+        except Exception:
+            pass
+
+    async def _with_page(self, fn: Callable[..., Awaitable], *args) -> Any:
+        async with self.lease() as page:
+            return await fn(page, *args)
+
+    async def _visible_page(self, context: BrowserContext) -> Page:
+        for page in context.pages:
+            if page not in self._owned and not page.is_closed():
+                return page
+        return await context.new_page()
+
+    async def _navigate(self, url: str, wait_until: str, timeout: float) -> int | None:
+        context = await self._ensure_connected()
+        page = await self._visible_page(context)
+        await page.bring_to_front()
+        try:
+            with NAVIGATION_SECONDS.time(kind="visible_tab"):
+                response = await page.goto(
+                    url, wait_until=wait_until, timeout=timeout * 1000
+                )
+        except PlaywrightTimeoutError:
+            # Slow subresources; the document itself is usable by now
+            logger.warning("No %s event for %s after %gs", wait_until, url, timeout)
+            return None
+        logger.info(
+            "Navigated visible tab to %s (%s)",
+            url,
+            response.status if response else "no response",
+        )
+        return response.status if response else None
+
+    async def _request(
+        self, url: str, headers: dict[str, str], timeout: float
+    ) -> tuple[int, dict[str, str], bytes]:
+        context = await self._ensure_connected()
+        response = await context.request.get(
+            url, headers=headers, timeout=timeout * 1000
+        )
+        try:
+            return response.status, response.headers, await response.body()
+        finally:
+            await response.dispose()
+
+    async def _health(self) -> dict:
+        try:
+            await self._ensure_connected()
+            version = self._browser.version
+            connected = True
+        except Exception as e:
+            logger.warning("Browser health check failed: %s", e)
+            version, connected = None, False
+        return {
+            "endpoint": self.cdp_endpoint,
+            "connected": connected,
+            "version": version,
+            "pages_idle": len(self._idle),
+            "pages_in_use": self._in_use,
+            "pool_size": self.size,
+            "reconnects": self.reconnects,
+        }
+
+
+_pool: BrowserPool | None = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+@contextmanager
+def use_browser_pool(pool: BrowserPool):
+    """Make `get_browser_pool()` return `pool` on this thread."""
+    previous = getattr(_local, "pool", None)
+    _local.pool = pool
+    try:
+        yield pool
+    finally:
+        _local.pool = previous
+
+
+def get_browser_pool() -> BrowserPool:
+    """
+    Return the pool selected on this thread with `use_browser_pool` (a
+    leased worker's browser), else the process-wide browser pool, starting
+    it on first use.
+    """
+    leased = getattr(_local, "pool", None)
+    if leased is not None:
+        return leased
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool()
+        _pool.start()
+        return _pool
+
+
+def close_browser_pool() -> None:
+    """Close the process-wide browser pool if one was started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
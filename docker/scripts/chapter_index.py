@@ -0,0 +1,181 @@
+"""
+Cached listings of chapter directories for /get_image.
+
+A listing holds every image's size, mtime, detected MIME type and, when the
+chapter's `.manifest.json` has a current entry, its SHA-256. Building a
+listing never reads image bodies: files without a manifest entry get a
+size/mtime ETag, and their hash is only computed (and kept with the
+listing) when a variant needs it. Listings are rebuilt only when the
+directory's mtime changes; images are always written by rename, so any
+added, removed or replaced file bumps it.
+"""
+
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from scripts.file_utils import ChapterManifest, sha256_file
+
+IMAGE_EXTENSIONS = (
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    ".tiff",
+    ".tif",
+    ".avif",
+    ".heic",
+)
+# Chapter listings kept in memory
+CHAPTER_CACHE_SIZE = int(os.environ.get("TENSHI_CHAPTER_CACHE_SIZE", "256"))
+
+# Leading bytes of each supported image format
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+)
+_FTYP_BRANDS = {
+    b"avif": "image/avif",
+    b"avis": "image/avif",
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"mif1": "image/heif",
+}
+
+
+def image_sort_key(name: str):
+    """Sort by the numeric prefix (before the extension)."""
+    base, _ = os.path.splitext(name)
+    try:
+        return (0, int(base), "")
+    except ValueError:
+        return (1, 0, base)  # non-numeric names after, lexicographically
+
+
+def detect_mime(path: str) -> str:
+    """MIME type from the file's magic bytes, falling back to its extension."""
+    with open(path, "rb") as f:
+        head = f.read(16)
+    for signature, mime in _SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in _FTYP_BRANDS:
+        return _FTYP_BRANDS[head[8:12]]
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+class ImageInfo(NamedTuple):
+    """One image in a chapter listing."""
+
+    name: str
+    stat: os.stat_result
+    mime: str
+    sha256: str | None  # None: not in the manifest, hashed on demand
+
+    @property
+    def etag(self) -> str:
+        if self.sha256 is None:
+            return f'"{self.stat.st_size:x}-{self.stat.st_mtime_ns:x}"'
+        return f'"{self.sha256[:32]}"'
+
+
+class ChapterListing(NamedTuple):
+    """Sorted images of a chapter directory at a given directory mtime."""
+
+    mtime_ns: int
+    images: list[str]
+    files: dict[str, ImageInfo]
+    # SHA-256 computed on demand for files without a manifest entry
+    hashes: dict[str, str]
+
+    @property
+    def etag(self) -> str:
+        return f'W/"{self.mtime_ns:x}-{len(self.images)}"'
+
+
+def _scan(path: str, mtime_ns: int) -> ChapterListing:
+    manifest = ChapterManifest(path)
+    files = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.name.lower().endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            recorded = manifest.get(entry.name)
+            sha256 = None
+            if recorded and recorded["size"] == stat.st_size:
+                sha256 = recorded["sha256"]
+            files[entry.name] = ImageInfo(
+                entry.name, stat, detect_mime(entry.path), sha256
+            )
+    return ChapterListing(mtime_ns, sorted(files, key=image_sort_key), files, {})
+
+
+class ChapterIndex:
+    """LRU cache of chapter listings, invalidated by directory mtime."""
+
+    def __init__(self, max_chapters: int = CHAPTER_CACHE_SIZE):
+        self.max_chapters = max_chapters
+        self.hits = 0
+        self.misses = 0
+        self._listings: "OrderedDict[str, ChapterListing]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> ChapterListing:
+        """
+        Listing of chapter directory `path`, rescanned only if the directory
+        changed. Raises FileNotFoundError/NotADirectoryError.
+        """
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            listing = self._listings.get(path)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self._listings.move_to_end(path)
+                self.hits += 1
+                return listing
+            self.misses += 1
+        if not os.path.isdir(path):
+            raise NotADirectoryError(path)
+        listing = _scan(path, mtime_ns)
+        with self._lock:
+            self._listings[path] = listing
+            self._listings.move_to_end(path)
+            while len(self._listings) > self.max_chapters:
+                self._listings.popitem(last=False)
+        return listing
+
+    def sha256(self, image_path: str) -> str:
+        """
+        SHA-256 of an image in a chapter directory: from the manifest when
+        recorded, otherwise hashed once per listing. Raises KeyError if the
+        image is not in the listing.
+        """
+        listing = self.get(os.path.dirname(image_path))
+        name = os.path.basename(image_path)
+        info = listing.files[name]
+        if info.sha256 is not None:
+            return info.sha256
+        sha256 = listing.hashes.get(name)
+        if sha256 is None:
+            sha256 = listing.hashes[name] = sha256_file(image_path)
+        return sha256
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chapters": len(self._listings),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+chapter_index = ChapterIndex()
@@ -0,0 +1,101 @@
+"""
+Per-domain record of Cloudflare clearance held by a browser profile.
+
+After a page loads without a challenge, the cookies the browser holds for
+that host are inspected and the domain is marked cleared until its
+`cf_clearance` cookie expires (or for CLEARANCE_TTL when there is none).
+While a domain is cleared, the full trigger flow (navigation, template
+polling, clicking) is skipped. Each BrowserPool owns one cache, since
+clearance cookies live in that browser's profile.
+"""
+
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# How long a domain counts as cleared when no expiring cf_clearance cookie is set
+CLEARANCE_TTL = float(os.environ.get("TENSHI_CLEARANCE_TTL", "1800"))
+# Treat sessions as expired this many seconds early
+EXPIRY_MARGIN = 60
+CLEARANCE_COOKIE = "cf_clearance"
+
+
+class ChallengeError(Exception):
+    """Raised when a page load hits a Cloudflare challenge or a 403."""
+
+
+def domain_of(url: str) -> str:
+    return (urlparse(url).hostname or "").lower()
+
+
+def _cookie_matches(cookie: dict, host: str) -> bool:
+    domain = cookie.get("domain", "").lstrip(".").lower()
+    return host == domain or host.endswith("." + domain)
+
+
+class ClearanceCache:
+    """Domain → clearance expiry, with hit/miss counters."""
+
+    def __init__(self, ttl: float = CLEARANCE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._expires: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def is_valid(self, url: str) -> bool:
+        """Whether the browser still holds clearance for `url`'s domain."""
+        domain = domain_of(url)
+        with self._lock:
+            valid = self._expires.get(domain, 0) - EXPIRY_MARGIN > time.time()
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._expires.pop(domain, None)
+            return valid
+
+    def store(self, url: str, cookies: list[dict]) -> None:
+        """
+        Mark `url`'s domain cleared after a successful page load, using the
+        expiry of the matching cf_clearance cookie when one is present.
+        """
+        host = domain_of(url)
+        expiries = [
+            c["expires"]
+            for c in cookies
+            if c.get("name") == CLEARANCE_COOKIE
+            and _cookie_matches(c, host)
+            and c.get("expires", -1) > 0
+        ]
+        expires = min(expiries) if expiries else time.time() + self.ttl
+        with self._lock:
+            self._expires[host] = expires
+        logger.info(
+            "Clearance for %s valid for %.0fs", host, max(0, expires - time.time())
+        )
+
+    def invalidate(self, url: str) -> None:
+        """Forget `url`'s domain so the next call runs the full bypass."""
+        with self._lock:
+            if self._expires.pop(domain_of(url), None) is not None:
+                self.invalidations += 1
+                logger.info("Invalidated clearance for %s", domain_of(url))
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "domains": {
+                    domain: round(expires - now)
+                    for domain, expires in self._expires.items()
+                },
+            }
@@ -8,10 +8,13 @@ import subprocess
 import time
 
 from scripts.cloudflare_utils import (
-    find_template_coords,
-    wait_for_page_load,
-    wait_for_template,
+    TemplateQuery,
+    detect_templates,
+    grab_frame,
+    wait_for_screen_idle,
+    wait_for_templates,
 )
+from scripts.screen_capture import display_env
 from scripts.utils import RELOAD_TPL
 
 logging.basicConfig(level=logging.INFO)
@@ -21,41 +24,58 @@ logger = logging.getLogger(__name__)
 LOGO_TPL = "/tenshi/images/cloudflare_logo_template.png"
 CHALLENGE_TPL = "/tenshi/images/cloudflare_verify_click_template_light.png"
 
+RELOAD_QUERY = TemplateQuery(RELOAD_TPL, threshold=0.75)
+# Use broader scales and lower threshold to improve logo detection
+LOGO_QUERY = TemplateQuery(LOGO_TPL, threshold=0.2, scales=(0.5, 0.75, 1.0, 1.25))
+CHALLENGE_QUERY = TemplateQuery(CHALLENGE_TPL, threshold=0.75)
+
 
 def simulate_click(x, y):
     """
     Move mouse to (x, y) and perform a click using xdotool.
     """
     subprocess.check_call(
-        ["xdotool", "mousemove", "--sync", str(x), str(y), "click", "1"]
+        ["xdotool", "mousemove", "--sync", str(x), str(y), "click", "1"],
+        env=display_env(),
     )
 
 
 def main():
-    # 1) Wait for the page to load (detect reload icon or fallback sleep)
-    wait_for_page_load(template_path=RELOAD_TPL)
+    # Every poll tick captures one frame and checks all templates against it.
 
-    # 2) Early detection: check for Cloudflare logo presence
-    # Use broader scales and lower threshold to improve detection
-    logo_coords = find_template_coords(
-        LOGO_TPL, threshold=0.2, scales=(0.5, 0.75, 1.0, 1.25)
+    # 1) Wait for the page to load (reload icon), or for the challenge itself
+    hits = wait_for_templates(
+        [RELOAD_QUERY, LOGO_QUERY, CHALLENGE_QUERY],
+        interval=0.5,
+        timeout=20.0,
+        require=(RELOAD_TPL, CHALLENGE_TPL),
     )
-    if not logo_coords:
-        logger.info("No Cloudflare logo detected; skipping challenge bypass.")
-        return
+    if not hits:
+        logger.info("Reload button never appeared; waiting for screen to settle…")
+        wait_for_screen_idle()
+        hits = detect_templates(grab_frame(), [LOGO_QUERY, CHALLENGE_QUERY])
+    found = {hit.path: hit for hit in hits}
 
-    logger.info(
-        "Cloudflare logo detected at %s; proceeding with challenge bypass.", logo_coords
-    )
+    if CHALLENGE_TPL not in found:
+        # 2) Early detection: check for Cloudflare logo presence
+        if LOGO_TPL not in found:
+            logger.info("No Cloudflare logo detected; skipping challenge bypass.")
+            return
 
-    # 3) detect & click Cloudflare challenge if present
-    coords = wait_for_template(
-        CHALLENGE_TPL,
-        threshold=0.75,
-        interval=0.5,
-        timeout=10.0,
-    )
-    if coords:
+        logger.info(
+            "Cloudflare logo detected at %s; proceeding with challenge bypass.",
+            found[LOGO_TPL].coords,
+        )
+
+        # 3) detect Cloudflare challenge if present
+        found = {
+            hit.path: hit
+            for hit in wait_for_templates([CHALLENGE_QUERY], interval=0.5, timeout=10.0)
+        }
+
+    # 4) click Cloudflare challenge
+    if CHALLENGE_TPL in found:
+        coords = found[CHALLENGE_TPL].coords
         logger.info("Clicking Cloudflare challenge at %s", coords)
         simulate_click(*coords)
         time.sleep(1)
@@ -5,71 +5,460 @@ Place this file alongside your other scripts under `docker/scripts`.
 
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, NamedTuple
 
 import cv2
 import numpy as np
-from PIL import ImageGrab
+from scripts.metrics import CAPTURE_SECONDS, MATCH_SECONDS, TEMPLATE_WAIT_SECONDS
+from scripts.screen_capture import Region, get_capture_backend
+from scripts.utils import IMAGES_DIR, container_cpu_count
 
 logger = logging.getLogger(__name__)
 
 # Enable extra debug output if the environment flag is set
 DEBUG_OPENCV = os.environ.get("DEBUG_OPENCV", "0") == "1"
 
+# Scaled templates smaller than this (in either dimension) are not matched
+MIN_TEMPLATE_SIZE = 10
 
-def take_screenshot(debug_dir: str = "/tenshi/data/screenshots") -> np.ndarray:
-    """Capture full-screen screenshot as an RGB NumPy array."""
-    logger.debug("Capturing full-screen screenshot")
-    screen = np.array(ImageGrab.grab())
-    rgb = cv2.cvtColor(screen, cv2.COLOR_BGR2RGB)
+# Matching mode: "exhaustive" (full-resolution search) or "coarse"
+# (downscaled search, then full-resolution refinement around candidates)
+MATCH_MODE = os.environ.get("TENSHI_MATCH_MODE", "exhaustive").lower()
+# Downscale factor used by the coarse pass
+COARSE_FACTOR = float(os.environ.get("TENSHI_COARSE_FACTOR", "0.5"))
+# Candidates refined per scale, and how far below the threshold they may score
+COARSE_CANDIDATES = 3
+COARSE_MARGIN = 0.25
+# Coarse templates smaller than this fall back to an exhaustive search
+MIN_COARSE_SIZE = 6
+# Threads used to run matchTemplate calls in parallel (OpenCV releases the GIL)
+MATCH_WORKERS = int(os.environ.get("TENSHI_MATCH_WORKERS", container_cpu_count()))
+
+# Adaptive polling: signature thumbnail size, gray-level delta of any
+# thumbnail cell that counts as a screen change, and idle backoff
+SIGNATURE_SIZE = (64, 36)
+CHANGE_THRESHOLD = 4
+POLL_BACKOFF = 1.5
+POLL_MAX_INTERVAL_FACTOR = 4
+# Consecutive unchanged frames after which the screen counts as settled
+IDLE_FRAMES = 3
+
+_match_pool: ThreadPoolExecutor | None = None
+_match_pool_lock = threading.Lock()
+
+
+def _run_parallel(tasks: list[Callable]) -> list:
+    """Run independent matching tasks on the shared pool, preserving order."""
+    global _match_pool
+    if len(tasks) <= 1 or MATCH_WORKERS <= 1:
+        return [task() for task in tasks]
+    if _match_pool is None:
+        with _match_pool_lock:
+            if _match_pool is None:
+                _match_pool = ThreadPoolExecutor(
+                    max_workers=MATCH_WORKERS, thread_name_prefix="match"
+                )
+    return list(_match_pool.map(lambda task: task(), tasks))
+
+
+class TemplateRegistry:
+    """
+    Process-wide cache of grayscale templates and their resized variants.
+    Templates are read from disk once; each scale tuple is resized once.
+    Call `reload()` after template files change on disk.
+    """
+
+    def __init__(self, images_dir: str = IMAGES_DIR):
+        self.images_dir = images_dir
+        self._lock = threading.Lock()
+        self._templates: dict[str, np.ndarray] = {}
+        self._variants: dict[tuple, list] = {}
+
+    def preload(self) -> None:
+        """Load every PNG template found in `images_dir`."""
+        if not os.path.isdir(self.images_dir):
+            logger.debug("Template directory %s not found", self.images_dir)
+            return
+        for name in sorted(os.listdir(self.images_dir)):
+            if name.lower().endswith(".png"):
+                self.get(os.path.join(self.images_dir, name))
+
+    def get(self, template_path: str) -> np.ndarray | None:
+        """Return the grayscale template, reading it from disk on first use."""
+        template = self._templates.get(template_path)
+        if template is not None:
+            return template
+        with self._lock:
+            template = self._templates.get(template_path)
+            if template is None:
+                logger.debug("Loading template %s", template_path)
+                template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
+                if template is None:
+                    return None
+                self._templates[template_path] = template
+        return template
+
+    def variants(
+        self, template_path: str, scales: tuple
+    ) -> list[tuple[float, np.ndarray]]:
+        """
+        Return (scale, resized template) pairs for the given scales.
+        Scales producing a template smaller than MIN_TEMPLATE_SIZE are dropped.
+        """
+        key = (template_path, tuple(scales))
+        cached = self._variants.get(key)
+        if cached is not None:
+            return cached
+        template = self.get(template_path)
+        if template is None:
+            return []
+        variants = []
+        for scale in scales:
+            w = int(template.shape[1] * scale)
+            h = int(template.shape[0] * scale)
+            if w < MIN_TEMPLATE_SIZE or h < MIN_TEMPLATE_SIZE:
+                continue
+            variants.append((scale, cv2.resize(template, (w, h))))
+        with self._lock:
+            self._variants[key] = variants
+        return variants
+
+    def coarse_variants(
+        self, template_path: str, scales: tuple, factor: float
+    ) -> list[tuple[float, np.ndarray, np.ndarray | None]]:
+        """
+        Return (scale, resized, downscaled) triples for coarse-to-fine matching.
+        The downscaled template is None when it would be too small to match.
+        """
+        key = (template_path, tuple(scales), factor)
+        cached = self._variants.get(key)
+        if cached is not None:
+            return cached
+        variants = []
+        for scale, resized in self.variants(template_path, scales):
+            w = int(resized.shape[1] * factor)
+            h = int(resized.shape[0] * factor)
+            coarse = None
+            if w >= MIN_COARSE_SIZE and h >= MIN_COARSE_SIZE:
+                coarse = cv2.resize(resized, (w, h), interpolation=cv2.INTER_AREA)
+            variants.append((scale, resized, coarse))
+        with self._lock:
+            self._variants[key] = variants
+        return variants
+
+    def reload(self, template_path: str | None = None) -> None:
+        """
+        Drop cached data for one template (or all of them) so the next
+        lookup re-reads the file from disk.
+        """
+        with self._lock:
+            if template_path is None:
+                self._templates.clear()
+                self._variants.clear()
+            else:
+                self._templates.pop(template_path, None)
+                for key in [k for k in self._variants if k[0] == template_path]:
+                    del self._variants[key]
+        logger.info("Template cache reloaded (%s)", template_path or "all")
+        if template_path is None:
+            self.preload()
+
+
+# Shared registry used by all matching helpers in this process
+templates = TemplateRegistry()
+
+
+def reload_templates(template_path: str | None = None) -> None:
+    """Invalidate the shared template registry (e.g. after editing a PNG)."""
+    templates.reload(template_path)
+
+
+class TemplateQuery(NamedTuple):
+    """A template to look for in a frame, with its threshold and scales."""
+
+    path: str
+    threshold: float = 0.7
+    scales: tuple = (0.9, 1.0, 1.1)
+    mode: str | None = None  # defaults to MATCH_MODE
+
+
+class TemplateHit(NamedTuple):
+    """A template match: center coordinates, score and winning scale."""
+
+    path: str
+    coords: tuple[int, int]
+    score: float
+    scale: float
+
+
+def grab_frame(
+    region: Region | None = None,
+    debug_dir: str = "/tenshi/data/screenshots",
+) -> np.ndarray:
+    """
+    Capture the screen (or an (x, y, w, h) `region`) once as a grayscale
+    frame for template matching, using the configured capture backend.
+    """
+    backend = get_capture_backend()
+    with CAPTURE_SECONDS.time(backend=type(backend).__name__):
+        frame = backend.grab(region)
     if DEBUG_OPENCV:
         os.makedirs(debug_dir, exist_ok=True)
         ts = time.strftime("%Y%m%d-%H%M%S")
-        fname = os.path.join(debug_dir, f"screenshot_{ts}.png")
-        cv2.imwrite(fname, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
-        logger.debug("Saved debug screenshot to %s", fname)
-    return rgb
+        fname = os.path.join(debug_dir, f"frame_{ts}.png")
+        cv2.imwrite(fname, frame)
+        logger.debug("Saved debug frame to %s", fname)
+    return frame
+
+
+def downscale_frame(frame: np.ndarray, factor: float = COARSE_FACTOR) -> np.ndarray:
+    """Shrink a frame for the coarse pass of coarse-to-fine matching."""
+    return cv2.resize(frame, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+
+def _timed_match(template: str, mode: str, task: Callable):
+    with MATCH_SECONDS.time(template=template, mode=mode):
+        return task()
+
+
+def _match_exhaustive(
+    frame: np.ndarray, template: np.ndarray
+) -> tuple[float, tuple[int, int]]:
+    """Full-resolution search: best (score, top-left) over the whole frame."""
+    result = cv2.matchTemplate(frame, template, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    return max_val, max_loc
+
+
+def _match_coarse_to_fine(
+    frame: np.ndarray,
+    coarse_frame: np.ndarray,
+    template: np.ndarray,
+    coarse_template: np.ndarray,
+    threshold: float,
+    factor: float,
+) -> tuple[float, tuple[int, int]]:
+    """
+    Find candidates on the downscaled frame, then re-run the full-resolution
+    match only inside a small region of interest around each candidate.
+    Returns the best refined (score, top-left), or (0.0, (0, 0)) if none.
+    """
+    h, w = template.shape[:2]
+    ch, cw = coarse_template.shape[:2]
+    result = cv2.matchTemplate(coarse_frame, coarse_template, cv2.TM_CCOEFF_NORMED)
+    # Margin covers the position error introduced by downscaling
+    pad = int(round(1 / factor)) * 2 + 2
+    best_val, best_loc = 0.0, (0, 0)
+
+    for _ in range(COARSE_CANDIDATES):
+        _, coarse_val, _, (cx, cy) = cv2.minMaxLoc(result)
+        if coarse_val < threshold - COARSE_MARGIN:
+            break
+        x0 = max(0, int(cx / factor) - pad)
+        y0 = max(0, int(cy / factor) - pad)
+        x1 = min(frame.shape[1], int(cx / factor) + w + pad)
+        y1 = min(frame.shape[0], int(cy / factor) + h + pad)
+        if x1 - x0 >= w and y1 - y0 >= h:
+            val, (x, y) = _match_exhaustive(frame[y0:y1, x0:x1], template)
+            if val > best_val:
+                best_val, best_loc = val, (x0 + x, y0 + y)
+        # Suppress this candidate so the next iteration finds another peak
+        result[
+            max(0, cy - ch // 2) : cy + ch // 2 + 1,
+            max(0, cx - cw // 2) : cx + cw // 2 + 1,
+        ] = -1.0
+
+    return best_val, best_loc
+
+
+def match_template(
+    frame: np.ndarray,
+    query: TemplateQuery,
+    origin: tuple[int, int] = (0, 0),
+) -> TemplateHit | None:
+    """
+    Match one template against an already captured grayscale frame.
+    Returns the best hit at or above the query threshold, else None.
+    `origin` is the screen position of the frame's top-left corner.
+    """
+    hits = detect_templates(frame, [query], origin)
+    return hits[0] if hits else None
+
+
+def detect_templates(
+    frame: np.ndarray | None,
+    queries: list[TemplateQuery | str],
+    origin: tuple[int, int] = (0, 0),
+) -> list[TemplateHit]:
+    """
+    Evaluate any number of templates against a single frame.
+    Grabs a new frame when `frame` is None. Returns every hit with its score.
+    Every (template, scale) pair is matched in parallel on the shared pool.
+    """
+    if frame is None:
+        frame = grab_frame()
+    queries = [TemplateQuery(q) if isinstance(q, str) else q for q in queries]
+    coarse_frame = None
+    if any((q.mode or MATCH_MODE) == "coarse" for q in queries):
+        coarse_frame = downscale_frame(frame)
+
+    # (query index, scale, template size, task) for every variant to score
+    tasks = []
+    for i, query in enumerate(queries):
+        if templates.get(query.path) is None:
+            logger.error("Template not found: %s", query.path)
+            continue
+        coarse = (query.mode or MATCH_MODE) == "coarse"
+        for scale, resized, coarse_tpl in templates.coarse_variants(
+            query.path, query.scales, COARSE_FACTOR
+        ):
+            h, w = resized.shape[:2]
+            if w > frame.shape[1] or h > frame.shape[0]:
+                continue
+            if coarse and coarse_tpl is not None:
+                mode = "coarse"
+                task = partial(
+                    _match_coarse_to_fine,
+                    frame,
+                    coarse_frame,
+                    resized,
+                    coarse_tpl,
+                    query.threshold,
+                    COARSE_FACTOR,
+                )
+            else:
+                mode = "exhaustive"
+                task = partial(_match_exhaustive, frame, resized)
+            task = partial(_timed_match, os.path.basename(query.path), mode, task)
+            tasks.append((i, scale, (w, h), task))
+
+    results = _run_parallel([task for *_, task in tasks])
+
+    # Reduce to the best-scoring variant per template
+    best: dict[int, tuple[float, tuple[int, int], tuple[int, int], float]] = {}
+    for (i, scale, size, _), (max_val, max_loc) in zip(tasks, results):
+        logger.debug("%s scale %.2f → %.2f", queries[i].path, scale, max_val)
+        if max_val >= queries[i].threshold and max_val > best.get(i, (0.0,))[0]:
+            best[i] = (max_val, max_loc, size, scale)
+
+    hits = []
+    for i, query in enumerate(queries):
+        if i not in best:
+            continue
+        best_val, (x, y), (w, h), best_scale = best[i]
+        cx = origin[0] + x + w // 2
+        cy = origin[1] + y + h // 2
+        logger.info("Template %s found at (%d,%d)", query.path, cx, cy)
+        hits.append(TemplateHit(query.path, (cx, cy), best_val, best_scale))
+    return hits
 
 
 def find_template_coords(
     template_path: str,
     threshold: float = 0.7,
     scales: tuple = (0.9, 1.0, 1.1),
+    frame: np.ndarray | None = None,
 ) -> tuple[int, int] | None:
     """
-    Search for a given template image on-screen.
+    Search for a given template image on-screen (or in `frame` if given).
     Returns center (x,y) if found at or above threshold, else None.
     """
-    logger.debug("Loading template %s", template_path)
-    template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
-    if template is None:
-        logger.error("Template not found: %s", template_path)
-        return None
-
-    gray = cv2.cvtColor(take_screenshot(), cv2.COLOR_RGB2GRAY)
-    best_val = 0.0
-    best_loc = None
-    best_size = (0, 0)
-
-    for scale in scales:
-        w = int(template.shape[1] * scale)
-        h = int(template.shape[0] * scale)
-        if w < 10 or h < 10:
+    if frame is None:
+        frame = grab_frame()
+    hit = match_template(frame, TemplateQuery(template_path, threshold, scales))
+    return hit.coords if hit else None
+
+
+def frame_signature(frame: np.ndarray) -> np.ndarray:
+    """Cheap fingerprint of a frame: a tiny area-averaged thumbnail."""
+    return cv2.resize(frame, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def frame_changed(previous: np.ndarray, current: np.ndarray) -> bool:
+    """True if any cell of two frame signatures differs by > CHANGE_THRESHOLD."""
+    return int(cv2.absdiff(previous, current).max()) > CHANGE_THRESHOLD
+
+
+def wait_for_screen_idle(
+    timeout: float = 5.0, interval: float = 0.2, region: Region | None = None
+) -> bool:
+    """
+    Block until the screen stops changing for IDLE_FRAMES consecutive
+    captures (rendering has settled), or `timeout` passes. Returns True
+    if the screen settled.
+    """
+    last_signature = frame_signature(grab_frame(region))
+    still = 0
+    end = time.time() + timeout
+    while time.time() < end:
+        time.sleep(interval)
+        signature = frame_signature(grab_frame(region))
+        if frame_changed(last_signature, signature):
+            last_signature, still = signature, 0
             continue
-        resized = cv2.resize(template, (w, h))
-        result = cv2.matchTemplate(gray, resized, cv2.TM_CCOEFF_NORMED)
-        _, max_val, _, max_loc = cv2.minMaxLoc(result)
-        logger.debug("scale %.2f → %.2f", scale, max_val)
-        if max_val >= threshold and max_val > best_val:
-            best_val, best_loc, best_size = max_val, max_loc, (w, h)
-
-    if best_loc:
-        x, y = best_loc
-        cx = x + best_size[0] // 2
-        cy = y + best_size[1] // 2
-        logger.info("Template %s found at (%d,%d)", template_path, cx, cy)
-        return (cx, cy)
-    return None
+        still += 1
+        if still >= IDLE_FRAMES:
+            return True
+    return False
+
+
+def wait_for_templates(
+    queries: list[TemplateQuery | str],
+    interval: float = 0.5,
+    timeout: float = 30.0,
+    require: tuple[str, ...] | None = None,
+    region: Region | None = None,
+    max_interval: float | None = None,
+) -> list[TemplateHit]:
+    """
+    Poll the screen with one capture per tick, matching all `queries`
+    against it, until one of the `require` templates (default: any) is hit.
+    Only `region` is captured when given; hit coords stay screen-absolute.
+
+    Matching is skipped while the screen is unchanged since the last matched
+    frame, and the poll interval backs off from `interval` towards
+    `max_interval` (default 4x `interval`) until the screen changes again.
+    Returns every hit from that tick, or an empty list on timeout.
+    """
+    queries = [TemplateQuery(q) if isinstance(q, str) else q for q in queries]
+    if require is None:
+        require = tuple(q.path for q in queries)
+    if max_interval is None:
+        max_interval = interval * POLL_MAX_INTERVAL_FACTOR
+    logger.info(
+        "Waiting for templates %s (%.1fs timeout)...", ", ".join(require), timeout
+    )
+    origin = region[:2] if region else (0, 0)
+    waited_for = ",".join(sorted(os.path.basename(path) for path in require))
+    started = time.perf_counter()
+    last_signature = None
+    delay = interval
+    end = time.time() + timeout
+    while time.time() < end:
+        frame = grab_frame(region)
+        signature = frame_signature(frame)
+        if last_signature is None or frame_changed(last_signature, signature):
+            last_signature = signature
+            delay = interval
+            hits = detect_templates(frame, queries, origin)
+            if any(hit.path in require for hit in hits):
+                TEMPLATE_WAIT_SECONDS.observe(
+                    time.perf_counter() - started, templates=waited_for, outcome="found"
+                )
+                return hits
+        else:
+            delay = min(delay * POLL_BACKOFF, max_interval)
+            logger.debug("Screen unchanged; next poll in %.2fs", delay)
+        time.sleep(max(0.0, min(delay, end - time.time())))
+    TEMPLATE_WAIT_SECONDS.observe(
+        time.perf_counter() - started, templates=waited_for, outcome="timeout"
+    )
+    logger.warning("Timeout waiting for %s", ", ".join(require))
+    return []
 
 
 def wait_for_template(
@@ -82,15 +471,10 @@ def wait_for_template(
     Poll for the given template until it appears or timeout expires.
     Returns coords or None.
     """
-    logger.info("Waiting for template %s (%.1fs timeout)...", template_path, timeout)
-    end = time.time() + timeout
-    while time.time() < end:
-        coords = find_template_coords(template_path, threshold)
-        if coords:
-            return coords
-        time.sleep(interval)
-    logger.warning("Timeout waiting for %s", template_path)
-    return None
+    hits = wait_for_templates(
+        [TemplateQuery(template_path, threshold)], interval, timeout
+    )
+    return hits[0].coords if hits else None
 
 
 def wait_for_page_load(
@@ -100,26 +484,13 @@ def wait_for_page_load(
     interval: float = 0.5,
 ) -> None:
     """
-    Block until Cloudflare's reload icon appears, or fallback to a fixed sleep.
+    Block until Cloudflare's reload icon appears, or fall back to waiting
+    for the screen to stop changing.
     """
     logger.info("Waiting for page load via template %s", template_path)
     coords = wait_for_template(template_path, threshold, interval, timeout)
     if coords:
         logger.info("Page loaded, reload icon at %s", coords)
     else:
-        logger.info("Reload button never appeared; sleeping fallback…")
-        time.sleep(5)
-
-
-def bypass_cf(chapter_url: str):
-    try:
-        logging.info("Bypassing CF for chapter %s", chapter_url)
-        resp = requests.get(
-            f"{FASTAPI_BASE}/trigger",
-            params={"url": chapter_url, "js": "", "wait": "", "sleep": 2000},
-            timeout=60,
-        )
-        resp.raise_for_status()
-        logging.info("✅ CF bypass completed for %s", chapter_url)
-    except Exception as e:
-        logging.warning("CF bypass failed: %s", e)
+        logger.info("Reload button never appeared; waiting for screen to settle…")
+        wait_for_screen_idle()
@@ -0,0 +1,537 @@
+"""
+Concurrent image download stage for Tenshi.
+
+Images are fetched on a bounded thread pool with a per-host concurrency cap,
+retried with exponential backoff on transient failures, and written under
+their `filename_for_index` names so page order is preserved.
+
+Requests go through the browser context's request API, so they carry the
+browser's cookies (e.g. cf_clearance) and user agent. With
+TENSHI_DOWNLOAD_CLIENT=requests they use a plain requests session seeded with
+those cookies instead, which streams bodies but has its own TLS fingerprint;
+images it gets a 403 for are fetched through the browser.
+
+Bodies are streamed to a `.part` file and renamed into place only once
+complete, so a crash never leaves a truncated image under its final name.
+Interrupted `.part` files are resumed with a Range request, and each saved
+file's size and SHA-256 are recorded in the chapter manifest so re-runs
+verify existing files instead of trusting that they exist. Files saved
+before the manifest existed are only adopted if they decode completely.
+
+With TENSHI_DEDUP=1, URLs already in the blob store are linked instead of
+downloaded, and new files are handed to the store to be deduplicated.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http import cookiejar
+from typing import Any, Iterable, Mapping, NamedTuple
+from urllib.parse import urlparse
+
+import requests
+from PIL import Image
+from playwright.async_api import Error as PlaywrightError
+from requests.adapters import HTTPAdapter
+from scripts.blob_store import get_blob_store
+from scripts.file_utils import (
+    ChapterManifest,
+    atomic_write,
+    filename_for_index,
+    reserve_indices,
+    sha256_file,
+)
+from scripts.metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS, DOWNLOAD_SIZE_BYTES
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CONCURRENCY = int(os.environ.get("TENSHI_DOWNLOAD_CONCURRENCY", "8"))
+DOWNLOAD_PER_HOST = int(os.environ.get("TENSHI_DOWNLOAD_PER_HOST", "4"))
+DOWNLOAD_RETRIES = int(os.environ.get("TENSHI_DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_TIMEOUT = 60
+# Base delay (seconds) for exponential backoff between attempts
+BACKOFF_BASE = 0.5
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Re-hash existing files against the manifest on re-runs (size is always checked)
+VERIFY_HASHES = os.environ.get("TENSHI_VERIFY_HASHES", "1") != "0"
+CHUNK_SIZE = 1 << 16
+PART_SUFFIX = ".part"
+# browser (the context's request API) | requests (plain session, browser on 403)
+DOWNLOAD_CLIENT = os.environ.get("TENSHI_DOWNLOAD_CLIENT", "browser").lower()
+
+
+class DownloadResult(NamedTuple):
+    """Outcome of one image download."""
+
+    index: int
+    url: str
+    filename: str
+    status: str  # saved | captured | linked | skipped | failed
+    bytes: int = 0
+    attempts: int = 0
+    error: str | None = None
+
+
+def session_for(cookies: list[dict], user_agent: str | None, referer: str):
+    """
+    Build a requests session that presents the browser's cookies (e.g.
+    cf_clearance) and user agent, so downloads share its clearance.
+    """
+    cj = cookiejar.CookieJar()
+    for c in cookies:
+        cj.set_cookie(
+            cookiejar.Cookie(
+                version=0,
+                name=c["name"],
+                value=c["value"],
+                port=None,
+                port_specified=False,
+                domain=c["domain"],
+                domain_specified=True,
+                domain_initial_dot=c["domain"].startswith("."),
+                path=c["path"],
+                path_specified=True,
+                secure=c["secure"],
+                expires=None,
+                discard=True,
+                comment=None,
+                comment_url=None,
+                rest={},
+                rfc2109=False,
+            )
+        )
+    session = requests.Session()
+    session.cookies = cj
+    session.headers.update({"Referer": referer})
+    if user_agent:
+        session.headers["User-Agent"] = user_agent
+    adapter = HTTPAdapter(pool_maxsize=max(DOWNLOAD_CONCURRENCY, 10))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class DownloadClient(NamedTuple):
+    """
+    How a chapter's images are requested: through `browser` (a BrowserPool)
+    unless a requests `session` is set, which then falls back to `browser`
+    on 403.
+    """
+
+    browser: Any
+    referer: str
+    session: requests.Session | None = None
+
+
+def client_for(
+    browser,
+    referer: str,
+    cookies: list[dict] | None = None,
+    user_agent: str | None = None,
+) -> DownloadClient:
+    """
+    The download client for one chapter, per TENSHI_DOWNLOAD_CLIENT. The
+    browser's `cookies` and `user_agent` are only used by a requests session.
+    """
+    session = None
+    if DOWNLOAD_CLIENT == "requests":
+        session = session_for(cookies or [], user_agent, referer)
+    return DownloadClient(browser, referer, session)
+
+
+class _HostLimiter:
+    """Hands out one semaphore per host to cap per-host concurrency."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+
+    def __call__(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return sem
+
+
+def _backoff_delay(attempt: int, headers: Mapping | None = None) -> float:
+    retry_after = headers.get("retry-after") if headers is not None else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return BACKOFF_BASE * (2 ** (attempt - 1)) + random.uniform(0, BACKOFF_BASE)
+
+
+class _IncompleteDownload(Exception):
+    """The body ended before the advertised length; the .part is kept."""
+
+
+def _expected_length(status: int, headers: Mapping) -> int | None:
+    """
+    Total size of the resource, if the server told us. `headers` may be a
+    requests CaseInsensitiveDict or Playwright's lower-cased dict.
+    """
+    if status == 206:
+        total = headers.get("content-range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    # Content-Length counts encoded bytes, but bodies arrive decoded
+    if headers.get("content-encoding", "identity") != "identity":
+        return None
+    length = headers.get("content-length", "")
+    return int(length) if length.isdigit() else None
+
+
+def _write_part(
+    part_path: str, chunks: Iterable[bytes], resumed: bool
+) -> tuple[int, str]:
+    """
+    Append `chunks` to `part_path` (or replace it unless `resumed`), fsync
+    it and return the whole file's size and SHA-256.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    if resumed:
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+    with open(part_path, "ab" if resumed else "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    return size, digest.hexdigest()
+
+
+def _stream_to_part(
+    session: requests.Session, url: str, part_path: str
+) -> tuple[requests.Response, int, str]:
+    """
+    Stream `url` into `part_path`, resuming from its current size when the
+    server honours Range. Returns the response plus the final size and
+    SHA-256 (size is -1 when the status was not a success).
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as resp:
+        if resp.status_code == 416 and offset:
+            # Stale partial (e.g. the image changed upstream): start over
+            os.remove(part_path)
+            return _stream_to_part(session, url, part_path)
+        resumed = resp.status_code == 206 and resp.headers.get(
+            "Content-Range", ""
+        ).startswith(f"bytes {offset}-")
+        if resp.status_code != 200 and not resumed:
+            return resp, -1, ""
+        size, sha256 = _write_part(part_path, resp.iter_content(CHUNK_SIZE), resumed)
+        expected = _expected_length(resp.status_code, resp.headers)
+        if expected is not None and size != expected:
+            raise _IncompleteDownload(f"got {size} of {expected} bytes")
+        return resp, size, sha256
+
+
+def _browser_to_part(
+    browser, url: str, referer: str, part_path: str
+) -> tuple[int, Mapping, int, str]:
+    """
+    `_stream_to_part` through the browser context's request API, which
+    buffers the body. Returns the status, headers, final size and SHA-256.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Referer": referer}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    status, resp_headers, body = browser.request(url, headers, DOWNLOAD_TIMEOUT)
+    if status == 416 and offset:
+        os.remove(part_path)
+        return _browser_to_part(browser, url, referer, part_path)
+    resumed = status == 206 and resp_headers.get("content-range", "").startswith(
+        f"bytes {offset}-"
+    )
+    if status != 200 and not resumed:
+        return status, resp_headers, -1, ""
+    size, sha256 = _write_part(part_path, [body], resumed)
+    expected = _expected_length(status, resp_headers)
+    if expected is not None and size != expected:
+        raise _IncompleteDownload(f"got {size} of {expected} bytes")
+    return status, resp_headers, size, sha256
+
+
+def _download_to_part(
+    client: DownloadClient, url: str, part_path: str
+) -> tuple[int, Mapping, int, str]:
+    """Fetch `url` into `part_path` with `client`; see `_browser_to_part`."""
+    if client.session is not None:
+        resp, size, sha256 = _stream_to_part(client.session, url, part_path)
+        if resp.status_code != 403 or client.browser is None:
+            return resp.status_code, resp.headers, size, sha256
+        logger.info("%s refused the requests client; fetching via the browser", url)
+    return _browser_to_part(client.browser, url, client.referer, part_path)
+
+
+def _decodes(path: str) -> bool:
+    """Whether `path` is an image Pillow can decode to the last pixel."""
+    try:
+        with Image.open(path) as img:
+            # load() raises on truncated data; verify() alone misses it for JPEG
+            img.load()
+        return True
+    except Exception as e:
+        logger.debug("%s does not decode: %s", path, e)
+        return False
+
+
+def _already_saved(
+    manifest: ChapterManifest, filename: str, url: str, out_path: str
+) -> bool:
+    """
+    Whether `out_path` holds a complete copy. Files from before the manifest
+    existed are adopted once they decode completely; recorded files must
+    match size (and hash).
+    """
+    if not os.path.exists(out_path):
+        return False
+    if manifest.get(filename) is None:
+        if _decodes(out_path):
+            size = os.path.getsize(out_path)
+            manifest.record(filename, url, size, sha256_file(out_path))
+            return True
+        logger.warning("%s is not a complete image; downloading again", filename)
+    elif manifest.verify(filename, VERIFY_HASHES):
+        return True
+    else:
+        logger.warning("%s does not match the manifest; downloading again", filename)
+    os.remove(out_path)
+    manifest.forget(filename)
+    return False
+
+
+def _timed_fetch(*args) -> DownloadResult:
+    """`_fetch`, recording its latency and size by outcome."""
+    start = time.perf_counter()
+    result = _fetch(*args)
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - start, status=result.status)
+    DOWNLOAD_SIZE_BYTES.observe(result.bytes, status=result.status)
+    DOWNLOAD_BYTES.inc(result.bytes, status=result.status)
+    return result
+
+
+def _fetch(
+    client: DownloadClient,
+    index: int,
+    url: str,
+    out_dir: str,
+    limiter: _HostLimiter,
+    retries: int,
+    manifest: ChapterManifest,
+    body: bytes | None = None,
+) -> DownloadResult:
+    filename = filename_for_index(url, index)
+    out_path = os.path.join(out_dir, filename)
+
+    # skip if already downloaded and intact
+    if _already_saved(manifest, filename, url, out_path):
+        return DownloadResult(index, url, filename, "skipped")
+
+    store = get_blob_store()
+    if store is not None:
+        sha256 = store.lookup_url(url)
+        if sha256 is not None:
+            size = store.link_to(sha256, out_path, url)
+            manifest.record(filename, url, size, sha256)
+            return DownloadResult(index, url, filename, "linked", size)
+
+    # body already captured from the browser's own network traffic
+    if body is not None:
+        sha256 = hashlib.sha256(body).hexdigest()
+        if store is not None:
+            store.write(out_path, body, sha256, url)
+        else:
+            atomic_write(out_path, body)
+        manifest.record(filename, url, len(body), sha256)
+        return DownloadResult(index, url, filename, "captured", len(body))
+
+    part_path = out_path + PART_SUFFIX
+    error = None
+    for attempt in range(1, retries + 2):
+        headers = None
+        try:
+            with limiter(url):
+                status, headers, size, sha256 = _download_to_part(
+                    client, url, part_path
+                )
+            if size >= 0:
+                os.replace(part_path, out_path)
+                if store is not None:
+                    store.adopt(out_path, sha256, url)
+                manifest.record(filename, url, size, sha256)
+                logger.info("Downloaded %s (%d bytes)", filename, size)
+                return DownloadResult(index, url, filename, "saved", size, attempt)
+            error = f"status {status}"
+            if status not in RETRY_STATUSES:
+                break
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            PlaywrightError,
+            _IncompleteDownload,
+        ) as e:
+            error = str(e)
+        except Exception as e:
+            error = str(e)
+            break
+        if attempt <= retries:
+            delay = _backoff_delay(attempt, headers)
+            logger.warning(
+                "Fetching %s failed (%s); retry %d in %.1fs", url, error, attempt, delay
+            )
+            time.sleep(delay)
+
+    logger.error("Failed to fetch %s: %s", url, error)
+    return DownloadResult(index, url, filename, "failed", 0, attempt, error)
+
+
+class ChapterDownload:
+    """Handle for one chapter's images queued on a DownloadStage."""
+
+    def __init__(self, futures: list[Future], manifest: ChapterManifest):
+        self.futures = futures
+        self.manifest = manifest
+
+    @property
+    def done(self) -> int:
+        return sum(future.done() for future in self.futures)
+
+    def results(self) -> list[DownloadResult]:
+        """Wait for every image, persist the manifest and return results."""
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.manifest.save()
+            store = get_blob_store()
+            if store is not None:
+                store.save_index()
+
+
+class DownloadStage:
+    """
+    Download workers and per-host limits shared by every chapter submitted
+    to it, so concurrent chapters stay within one global budget.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = DOWNLOAD_CONCURRENCY,
+        per_host: int = DOWNLOAD_PER_HOST,
+        retries: int = DOWNLOAD_RETRIES,
+    ):
+        self.retries = retries
+        self._limiter = _HostLimiter(per_host)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, concurrency), thread_name_prefix="download"
+        )
+
+    def submit(
+        self,
+        client: DownloadClient,
+        srcs: list[str],
+        out_dir: str,
+        prefetched: dict[str, bytes] | None = None,
+        indices: list[int] | None = None,
+    ) -> ChapterDownload:
+        """
+        Queue `srcs` for download into `out_dir` and return immediately.
+        Pages are numbered 0, 1, … unless their `indices` are given.
+        """
+        prefetched = prefetched or {}
+        indices = list(range(len(srcs))) if indices is None else indices
+        manifest = ChapterManifest(out_dir)
+        # Later single-image saves append after this chapter's pages
+        reserve_indices(out_dir, max(indices, default=-1) + 1)
+        futures = [
+            self._pool.submit(
+                _timed_fetch,
+                client,
+                idx,
+                src,
+                out_dir,
+                self._limiter,
+                self.retries,
+                manifest,
+                prefetched.get(src),
+            )
+            for idx, src in zip(indices, srcs)
+        ]
+        return ChapterDownload(futures, manifest)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> "DownloadStage":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+_stage: DownloadStage | None = None
+_stage_lock = threading.Lock()
+
+
+def get_download_stage() -> DownloadStage:
+    """Process-wide download stage shared by all save jobs."""
+    global _stage
+    with _stage_lock:
+        if _stage is None:
+            _stage = DownloadStage()
+        return _stage
+
+
+def download_images(
+    client: DownloadClient,
+    srcs: list[str],
+    out_dir: str,
+    concurrency: int = DOWNLOAD_CONCURRENCY,
+    per_host: int = DOWNLOAD_PER_HOST,
+    retries: int = DOWNLOAD_RETRIES,
+    prefetched: dict[str, bytes] | None = None,
+) -> list[DownloadResult]:
+    """
+    Download `srcs` into `out_dir` as 000.jpg, 001.png, … using up to
+    `concurrency` parallel requests (`per_host` per host). Bodies found in
+    `prefetched` (by URL) are written without a request. Returns one
+    DownloadResult per image, in page order.
+    """
+    with DownloadStage(concurrency, per_host, retries) as stage:
+        return stage.submit(client, srcs, out_dir, prefetched).results()
+
+
+def summarize(results: list[DownloadResult]) -> dict:
+    """Aggregate per-image results into counts plus the failed entries."""
+    summary = {
+        "total": len(results),
+        "saved": 0,
+        "captured": 0,
+        "linked": 0,
+        "skipped": 0,
+        "failed": 0,
+    }
+    for result in results:
+        summary[result.status] += 1
+    summary["bytes"] = sum(r.bytes for r in results)
+    summary["failures"] = [
+        {"index": r.index, "url": r.url, "error": r.error}
+        for r in results
+        if r.status == "failed"
+    ]
+    return summary
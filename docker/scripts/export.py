@@ -0,0 +1,119 @@
+"""
+Streaming CBZ/ZIP export of saved chapters.
+
+Archives are produced on the fly: entries are stored (not compressed, the
+images already are), each file is read in chunks and every chunk is handed
+to the client as soon as zipfile has framed it. Nothing is buffered beyond
+one chunk, so a whole series streams at disk speed in constant memory.
+"""
+
+import os
+import re
+import time
+import zipfile
+from typing import Iterator
+
+from scripts.chapter_index import chapter_index
+
+CHUNK_SIZE = 1 << 16
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def chapter_number(name: str) -> float | None:
+    """First number in a chapter folder name ('chapter-12.5' -> 12.5)."""
+    match = _NUMBER.search(name)
+    return float(match.group()) if match else None
+
+
+def chapter_sort_key(name: str):
+    """Natural order for chapter folders: chapter-2 before chapter-10."""
+    return [
+        (0, int(part), "") if part.isdigit() else (1, 0, part.lower())
+        for part in re.split(r"(\d+)", name)
+        if part
+    ]
+
+
+def select_chapters(
+    series_path: str,
+    chapter: str | None = None,
+    start: float | None = None,
+    end: float | None = None,
+) -> list[str]:
+    """
+    Chapter folder names under `series_path` to export: just `chapter`, or
+    every chapter whose number lies in [start, end] (bounds optional), in
+    natural order. Raises FileNotFoundError if nothing matches.
+    """
+    if chapter:
+        if not os.path.isdir(os.path.join(series_path, chapter)):
+            raise FileNotFoundError(chapter)
+        return [chapter]
+    chapters = []
+    for entry in os.scandir(series_path):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        number = chapter_number(entry.name)
+        if start is not None and (number is None or number < start):
+            continue
+        if end is not None and (number is None or number > end):
+            continue
+        chapters.append(entry.name)
+    if not chapters:
+        raise FileNotFoundError(series_path)
+    return sorted(chapters, key=chapter_sort_key)
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that collects zipfile output."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        """Yield (and forget) whatever has been written since the last drain."""
+        if self._chunks:
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            yield data
+
+
+def iter_archive(series_path: str, chapters: list[str]) -> Iterator[bytes]:
+    """
+    Yield a ZIP of the images of `chapters` (folders under `series_path`),
+    each chapter in /get_image order. A single chapter is stored flat;
+    several are stored under `<chapter>/` prefixes.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for chapter in chapters:
+            chapter_path = os.path.join(series_path, chapter)
+            listing = chapter_index.get(chapter_path)
+            for name in listing.images:
+                stat = listing.files[name].stat
+                info = zipfile.ZipInfo(
+                    name if len(chapters) == 1 else f"{chapter}/{name}",
+                    date_time=_zip_time(stat.st_mtime),
+                )
+                info.compress_type = zipfile.ZIP_STORED
+                # Lets zipfile pick zip64 framing for very large images up front
+                info.file_size = stat.st_size
+                with open(os.path.join(chapter_path, name), "rb") as src:
+                    with archive.open(info, "w") as dst:
+                        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                            dst.write(chunk)
+                            yield from sink.drain()
+                yield from sink.drain()
+    yield from sink.drain()
+
+
+def _zip_time(mtime: float) -> tuple:
+    # ZIP timestamps cannot predate 1980
+    return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
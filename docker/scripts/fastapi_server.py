@@ -5,79 +5,175 @@ FastAPI Server for Cloudflare Automation Trigger
 Listens for HTTP GET requests on endpoints (trigger, save_image, and get_image) to automate browser actions.
 """
 
+import asyncio
+import functools
 import logging
 import os
-import re
-import subprocess
-import time
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse
-from scripts.cloudflare_utils import wait_for_page_load
-from scripts.utils import RELOAD_TPL
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from scripts.blob_store import get_blob_store
+from scripts.browser_control import BrowserUpdateError, trigger
+from scripts.browser_pool import close_browser_pool
+from scripts.chapter_index import ImageInfo, chapter_index
+from scripts.cloudflare_utils import reload_templates, templates
+from scripts.export import iter_archive, select_chapters
+from scripts.jobs import JobQueue, JobQueueFull, current_job, get_job
+from scripts.metrics import Gauge, registry
+from scripts.save_chapter_automation import CAPTURE_NETWORK
+from scripts.save_chapter_automation import save_chapter as save_chapter_images
+from scripts.save_chapter_automation import save_series as save_series_images
+from scripts.save_chapter_automation import sync_series as sync_series_images
+from scripts.save_image_automation import save_image as save_chapter_image
+from scripts.save_image_automation import save_images as save_image_batch
+from scripts.state_store import close_state_store, get_state_store
+from scripts.variants import (
+    DEFAULT_QUALITY,
+    TranscodeError,
+    VariantSpec,
+    close_variant_cache,
+    get_variant_cache,
+    variant_spec,
+)
+from scripts.workers import (
+    BROWSER_WORKERS,
+    close_scheduler,
+    free_workers,
+    get_scheduler,
+)
+
+# Root of every saved series/chapter folder
+DATA_DIR = "/tenshi/data"
+
+# Default extraction snippet for Madara-style reader pages
+DEFAULT_CHAPTER_JS = (
+    "(function(){"
+    '  var imgs = document.querySelectorAll("div.reading-content img.wp-manga-chapter-img");'
+    "  var srcs = [];"
+    "  for(var i=0;i<imgs.length;i++){"
+    '    var src = imgs[i].getAttribute("src")||imgs[i].getAttribute("data-src");'
+    "    if(src&&src.trim()) srcs.push(src.trim());"
+    "  }"
+    "  return JSON.stringify(srcs);"
+    "})();"
+)
+
+# Each trigger job drives one browser worker's display.
+trigger_jobs = JobQueue("trigger", workers=BROWSER_WORKERS)
+# Download jobs (save_*/sync_series) may overlap each other.
+automation_jobs = JobQueue(
+    "automation",
+    workers=int(os.environ.get("TENSHI_JOB_WORKERS", "2")),
+    max_pending=int(os.environ.get("TENSHI_JOB_QUEUE_SIZE", "32")),
+)
+
+Gauge(
+    "tenshi_jobs_queued",
+    "Jobs waiting for a worker.",
+    lambda: {(q.name,): q.depth for q in (trigger_jobs, automation_jobs)},
+    ("queue",),
+)
+Gauge(
+    "tenshi_jobs_running",
+    "Jobs currently running.",
+    lambda: {(q.name,): q.in_flight for q in (trigger_jobs, automation_jobs)},
+    ("queue",),
+)
+Gauge(
+    "tenshi_browser_workers_free",
+    "Browser workers not leased to a job.",
+    free_workers,
+)
+Gauge(
+    "tenshi_transcodes_pending",
+    "Image variants waiting to be transcoded.",
+    lambda: get_variant_cache().stats()["pending"],
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warm shared caches, start job workers and the browser workers before
+    serving requests.
+    """
+    templates.preload()
+    get_variant_cache()
+    get_scheduler()
+    trigger_jobs.start()
+    automation_jobs.start()
+    resume_syncs()
+    yield
+    trigger_jobs.shutdown()
+    automation_jobs.shutdown()
+    close_scheduler()
+    close_browser_pool()
+    close_variant_cache()
+    close_state_store()
+
 
 # Create FastAPI app and configure logging.
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 
-def run_xdotool(args, delay=0):
-    """Wrapper for xdotool command execution with delay support."""
-    logging.info("Executing xdotool command: %s", " ".join(args))
-    try:
-        subprocess.check_call(["xdotool"] + args)
-        if delay:
-            time.sleep(delay)
-    except subprocess.CalledProcessError as e:
-        logging.error("xdotool command failed: %s", e)
-        raise
-
-
-def activate_browser():
-    """Finds the visible Brave browser window and activates it."""
-    window_ids = (
-        subprocess.check_output(
-            ["xdotool", "search", "--onlyvisible", "--class", "Brave-browser"]
-        )
-        .decode()
-        .split()
-    )
-    if not window_ids:
-        raise Exception("No visible Brave browser window found.")
-    window_id = window_ids[0]
-    logging.info("Found Brave window id: %s", window_id)
-    if subprocess.call(["xdotool", "windowactivate", window_id]) != 0:
-        logging.warning("Window activation failed.")
-    time.sleep(0.5)
-    return window_id
-
-
-def focus_address_bar():
-    """Focus the address bar by simulating Ctrl+L and clearing existing text."""
-    logging.info("Focusing and clearing browser address bar...")
-    run_xdotool(["key", "--delay", "10", "ctrl+l"], delay=0.5)
-    run_xdotool(["key", "--delay", "10", "ctrl+a"], delay=0.1)
-    run_xdotool(["key", "--delay", "10", "BackSpace"], delay=0.5)
+def on_browser_worker(fn):
+    """
+    Run `fn` with a browser worker leased for the whole job. Chapter and
+    series saves lease one per extraction instead (see save_series).
+    """
 
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with get_scheduler().lease():
+            return fn(*args, **kwargs)
 
-def type_and_submit_url(url: str):
-    """Types the provided URL into the browser and simulates pressing Enter."""
-    logging.info("Typing URL: %s", url)
-    run_xdotool(["type", "--delay", "10", url], delay=0.5)
-    run_xdotool(["key", "--delay", "10", "Return"])
+    return wrapper
 
 
-def update_browser_url(target_url: str):
-    """High-level function to update the browser's URL with proper focus and typing."""
+async def run_job(
+    queue: JobQueue, name: str, background: bool, timeout: float, fn, *args
+):
+    """
+    Submit `fn(*args)` to `queue`. In background mode return a 202 with the
+    job ID; otherwise wait up to `timeout` seconds for the job without
+    blocking the event loop. On timeout a job that never started is
+    cancelled (504); one already running is left to finish and answered
+    with a 202 so its outcome can still be polled.
+    """
     try:
-        activate_browser()
-        focus_address_bar()
-        type_and_submit_url(target_url)
-        wait_for_page_load(template_path=RELOAD_TPL)
-    except Exception as e:
-        logging.error("Error updating browser URL: %s", e)
-        raise
+        job = queue.submit(name, fn, *args)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=f"{e}; retry later.")
+    if background:
+        return JSONResponse(
+            status_code=202,
+            content={"status": "Queued", "job_id": job.id, "job": f"/jobs/{job.id}"},
+        )
+    try:
+        return await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(job.future)), timeout
+        )
+    except asyncio.TimeoutError:
+        if queue.cancel(job):
+            raise HTTPException(
+                status_code=504,
+                detail=f"Job {job.id} was still queued after {timeout:g}s; cancelled.",
+            )
+        return JSONResponse(
+            status_code=202,
+            content={
+                "status": "Running",
+                "detail": f"Still running after {timeout:g}s",
+                "job_id": job.id,
+                "job": f"/jobs/{job.id}",
+            },
+        )
 
 
 @app.get("/trigger")
@@ -91,36 +187,28 @@ async def trigger_automation(
     sleep: int = Query(
         5000, description="(Optional) Delay in milliseconds for page stabilization."
     ),
+    background: bool = Query(
+        False, description="Return a job ID immediately instead of waiting."
+    ),
 ):
     if not (url.startswith("http://") or url.startswith("https://")):
         raise HTTPException(
             status_code=400, detail="Invalid URL scheme. Must be http or https."
         )
+    return await run_job(
+        trigger_jobs, "trigger", background, 120, run_trigger, url, js, wait, sleep
+    )
 
-    try:
-        update_browser_url(url)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Browser update error: {e}")
 
+@on_browser_worker
+def run_trigger(url: str, js: str, wait: str, sleep: int) -> dict:
+    """Load `url` in the browser and run the Cloudflare automation."""
     try:
-        logging.info("Starting Cloudflare automation synchronously...")
-        automation_cmd = [
-            "/tenshi/config/cloudflare_start.sh",
-            url,
-            wait,
-            str(sleep),
-            js,
-        ]
-        output = subprocess.check_output(
-            automation_cmd, stderr=subprocess.STDOUT, timeout=120
-        )
-        logging.info("Cloudflare automation output:\n%s", output.decode("utf-8"))
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(
-            status_code=500, detail=f"Automation error: {e.output.decode('utf-8')}"
-        )
+        trigger(url)
+    except BrowserUpdateError as e:
+        raise HTTPException(status_code=500, detail=f"Browser update error: {e}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {e}")
+        raise HTTPException(status_code=500, detail=f"Automation error: {e}")
 
     return {"status": "Triggered", "url": url, "js": js, "wait": wait, "sleep": sleep}
 
@@ -129,38 +217,185 @@ async def trigger_automation(
 async def save_chapter(
     chapter_url: str = Query(..., description="Chapter URL to fetch & save all images"),
     js: str = Query(
-        "(function(){"
-        '  var imgs = document.querySelectorAll("div.reading-content img.wp-manga-chapter-img");'
-        "  var srcs = [];"
-        "  for(var i=0;i<imgs.length;i++){"
-        '    var src = imgs[i].getAttribute("src")||imgs[i].getAttribute("data-src");'
-        "    if(src&&src.trim()) srcs.push(src.trim());"
-        "  }"
-        "  return JSON.stringify(srcs);"
-        "})();",
+        DEFAULT_CHAPTER_JS,
         description="JavaScript snippet returning a JSON‑stringified array of image URLs",
     ),
     slug: str = Query(
         ..., description="Series slug, e.g. 'the-knight-king-who-returned-with-a-god'"
     ),
+    capture_network: bool = Query(
+        CAPTURE_NETWORK,
+        description="Reuse image bodies the browser already loaded instead of re-downloading.",
+    ),
+    background: bool = Query(
+        False, description="Return a job ID immediately instead of waiting."
+    ),
 ):
+    return await run_job(
+        automation_jobs,
+        "save_chapter",
+        background,
+        600,
+        run_save_chapter,
+        chapter_url,
+        js,
+        slug,
+        capture_network,
+    )
+
+
+def run_save_chapter(
+    chapter_url: str, js: str, slug: str, capture_network: bool
+) -> dict:
+    """Download every image of a chapter into /tenshi/data/<slug>/<chapter>."""
     try:
-        subprocess.check_output(
-            [
-                "python3",
-                "/tenshi/scripts/save_chapter_automation.py",
-                chapter_url,
-                js,
-                slug,
-            ],
-            stderr=subprocess.STDOUT,
-            timeout=600,
+        summary = save_chapter_images(
+            chapter_url, js, slug, capture_network, get_scheduler().lease
         )
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(
-            status_code=500, detail=f"Automation error: {e.output.decode()}"
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Automation error: {e}")
+    return {
+        "status": "Saved",
+        "chapter_url": chapter_url,
+        "slug": slug,
+        "images": summary,
+    }
+
+
+@app.get("/save_series")
+async def save_series(
+    chapter_url: list[str] = Query(
+        ..., description="Chapter URLs to save, in order (repeat the parameter)."
+    ),
+    js: str = Query(
+        DEFAULT_CHAPTER_JS,
+        description="JavaScript snippet returning a JSON‑stringified array of image URLs",
+    ),
+    slug: str = Query(..., description="Series slug"),
+    capture_network: bool = Query(
+        CAPTURE_NETWORK,
+        description="Reuse image bodies the browser already loaded instead of re-downloading.",
+    ),
+    background: bool = Query(
+        False, description="Return a job ID immediately instead of waiting."
+    ),
+):
+    return await run_job(
+        automation_jobs,
+        "save_series",
+        background,
+        3600,
+        run_save_series,
+        chapter_url,
+        js,
+        slug,
+        capture_network,
+    )
+
+
+def run_save_series(
+    chapter_urls: list[str], js: str, slug: str, capture_network: bool
+) -> dict:
+    """
+    Save several chapters, overlapping each chapter's extraction with the
+    previous chapter's downloads. Per-chapter progress is visible on the job.
+    """
+    job = current_job()
+    try:
+        result = save_series_images(
+            chapter_urls,
+            js,
+            slug,
+            capture_network,
+            progress=job.progress if job else None,
+            lease=get_scheduler().lease,
         )
-    return {"status": "Saved", "chapter_url": chapter_url, "slug": slug}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Automation error: {e}")
+    return {"status": "Saved", "slug": slug, **result}
+
+
+@app.get("/sync_series")
+async def sync_series(
+    chapter_url: list[str] = Query(
+        ..., description="The series' chapter URLs, in order (repeat the parameter)."
+    ),
+    js: str = Query(
+        DEFAULT_CHAPTER_JS,
+        description="JavaScript snippet returning a JSON‑stringified array of image URLs",
+    ),
+    slug: str = Query(..., description="Series slug"),
+    capture_network: bool = Query(
+        CAPTURE_NETWORK,
+        description="Reuse image bodies the browser already loaded instead of re-downloading.",
+    ),
+    full: bool = Query(
+        False, description="Ignore the recorded state and process every chapter."
+    ),
+    background: bool = Query(
+        False, description="Return a job ID immediately instead of waiting."
+    ),
+):
+    return await run_job(
+        automation_jobs,
+        "sync_series",
+        background,
+        3600,
+        run_sync_series,
+        chapter_url,
+        js,
+        slug,
+        capture_network,
+        full,
+    )
+
+
+def run_sync_series(
+    chapter_urls: list[str],
+    js: str,
+    slug: str,
+    capture_network: bool,
+    full: bool = False,
+    run_id: int | None = None,
+) -> dict:
+    """
+    Process only what the state store says is missing: new chapters, and
+    failed or missing images of partially saved ones.
+    """
+    job = current_job()
+    try:
+        result = sync_series_images(
+            chapter_urls,
+            js,
+            slug,
+            capture_network,
+            progress=job.progress if job else None,
+            full=full,
+            run_id=run_id,
+            lease=get_scheduler().lease,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Automation error: {e}")
+    return {"status": "Synced", "slug": slug, **result}
+
+
+def resume_syncs() -> None:
+    """Re-queue sync runs that were interrupted by a restart."""
+    for run in get_state_store().unfinished_runs():
+        logger.info("Resuming sync run %d of %s", run["id"], run["slug"])
+        try:
+            automation_jobs.submit(
+                "sync_series",
+                run_sync_series,
+                run["chapter_urls"],
+                run["js"],
+                run["slug"],
+                run["capture_network"],
+                run_id=run["id"],
+            )
+        except JobQueueFull:
+            logger.warning("Queue full; sync run %d resumes next start", run["id"])
+            return
 
 
 @app.get("/save_image")
@@ -168,6 +403,9 @@ async def save_image(
     chapter_url: str = Query(..., description="Chapter URL for verification."),
     image_url: str = Query(..., description="Full image URL from CDN."),
     slug: str = Query(..., description="Series slug"),
+    background: bool = Query(
+        False, description="Return a job ID immediately instead of waiting."
+    ),
 ):
     if "cdn." not in image_url:
         raise HTTPException(
@@ -177,33 +415,179 @@ async def save_image(
         raise HTTPException(
             status_code=400, detail="Chapter URL should not be a CDN URL."
         )
+    return await run_job(
+        automation_jobs,
+        "save_image",
+        background,
+        180,
+        run_save_image,
+        chapter_url,
+        image_url,
+        slug,
+    )
+
 
+@on_browser_worker
+def run_save_image(chapter_url: str, image_url: str, slug: str) -> dict:
+    """Download a single CDN image for a chapter."""
     try:
-        subprocess.check_output(
-            [
-                "python3",
-                "/tenshi/scripts/save_image_automation.py",
-                chapter_url,
-                image_url,
-                slug,
-            ],
-            stderr=subprocess.STDOUT,
-            timeout=180,
+        save_chapter_image(chapter_url, image_url, slug)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Automation error: {e}")
+    return {
+        "status": "Saved",
+        "chapter_url": chapter_url,
+        "image_url": image_url,
+        "slug": slug,
+    }
+
+
+@app.get("/save_images")
+async def save_images(
+    chapter_url: str = Query(..., description="Chapter URL for verification."),
+    image_url: list[str] = Query(
+        ..., description="Image URLs from the CDN, in page order (repeatable)."
+    ),
+    slug: str = Query(..., description="Series slug"),
+    background: bool = Query(
+        False, description="Return a job ID immediately instead of waiting."
+    ),
+):
+    """
+    Save several images of one chapter, loading the chapter page once.
+    Images are appended after the chapter's existing ones.
+    """
+    if any("cdn." not in url for url in image_url):
+        raise HTTPException(
+            status_code=400, detail="Image URL does not belong to a CDN."
         )
-    except subprocess.CalledProcessError as e:
+    if "cdn." in chapter_url:
         raise HTTPException(
-            status_code=500, detail=f"Automation error: {e.output.decode('utf-8')}"
+            status_code=400, detail="Chapter URL should not be a CDN URL."
         )
+    return await run_job(
+        automation_jobs,
+        "save_images",
+        background,
+        max(180, 30 * len(image_url)),
+        run_save_images,
+        chapter_url,
+        image_url,
+        slug,
+    )
+
+
+@on_browser_worker
+def run_save_images(chapter_url: str, image_urls: list[str], slug: str) -> dict:
+    """Download several CDN images of a chapter in one page session."""
+    try:
+        images = save_image_batch(chapter_url, image_urls, slug)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Automation error: {e}")
     return {
         "status": "Saved",
         "chapter_url": chapter_url,
-        "image_url": image_url,
         "slug": slug,
+        "saved": sum(image["status"] == "saved" for image in images),
+        "failed": sum(image["status"] == "failed" for image in images),
+        "images": images,
     }
 
 
+@app.get("/health")
+async def health():
+    """Browser worker health (reconnects if a Brave instance was restarted)."""
+    workers = await asyncio.to_thread(get_scheduler().health)
+    return {"free": get_scheduler().free, "workers": workers}
+
+
+@app.get("/clearance")
+async def clearance_stats():
+    """Per-worker clearance cache: hit/miss counts and seconds left per domain."""
+    return {
+        "workers": [
+            {"index": w.index, **w.pool.clearance.stats()}
+            for w in get_scheduler().workers
+        ]
+    }
+
+
+@app.get("/storage")
+async def storage_stats():
+    """Deduplicated blob store usage (TENSHI_DEDUP=1)."""
+    store = get_blob_store()
+    if store is None:
+        return {"enabled": False}
+    return await asyncio.to_thread(store.stats)
+
+
+@app.get("/state")
+async def sync_state(
+    slug: str = Query(
+        None, description="(Optional) Series slug; totals for all series if omitted."
+    ),
+):
+    """Recorded chapters of a series (status, image counts) or overall totals."""
+    store = get_state_store()
+    if slug is None:
+        return await asyncio.to_thread(store.stats)
+    return {"slug": slug, "chapters": await asyncio.to_thread(store.chapters, slug)}
+
+
+@app.get("/variants")
+async def variant_stats():
+    """Transcoded variant cache: size against its budget, hits and evictions."""
+    return get_variant_cache().stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text-format latency/size histograms, counters and gauges."""
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/jobs")
+async def list_queues():
+    return {"queues": {q.name: q.stats() for q in (trigger_jobs, automation_jobs)}}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against `etag`."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == bare for tag in if_none_match.split(",")
+    )
+
+
+def not_modified(request: Request, etag: str, mtime: float | None = None) -> bool:
+    """Whether the client's cached copy (by ETag, else date) is still current."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = request.headers.get("if-modified-since")
+    if since and mtime is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
 @app.get("/get_image")
 async def get_image(
+    request: Request,
     slug: str = Query(
         None, description="(Optional) Series slug subfolder under /tenshi/data/"
     ),
@@ -211,56 +595,144 @@ async def get_image(
     filename: str = Query(
         None, description="(Optional) Filename of the image (e.g., 'page_001.jpg')."
     ),
+    image_format: str = Query(
+        None,
+        alias="format",
+        pattern="^(webp|jpe?g|png)$",
+        description="(Optional) Re-encode the image as webp, jpeg or png.",
+    ),
+    width: int = Query(
+        None, ge=16, le=8192, description="(Optional) Scale down to this width."
+    ),
+    quality: int = Query(
+        DEFAULT_QUALITY, ge=1, le=100, description="Encoder quality for variants."
+    ),
 ):
-    # Build the path under /tenshi/data
+    # Build the path under /tenshi/data, refusing anything that escapes it
     if slug:
-        chapter_path = os.path.join("/tenshi/data", slug, chapter)
+        chapter_path = os.path.normpath(os.path.join(DATA_DIR, slug, chapter))
     else:
-        chapter_path = os.path.join("/tenshi/data", chapter)
+        chapter_path = os.path.normpath(os.path.join(DATA_DIR, chapter))
+    if chapter_path == DATA_DIR or (
+        os.path.commonpath([chapter_path, DATA_DIR]) != DATA_DIR
+    ):
+        raise HTTPException(status_code=404, detail="Chapter folder not found")
 
-    if not os.path.isdir(chapter_path):
+    try:
+        listing = await asyncio.to_thread(chapter_index.get, chapter_path)
+    except (FileNotFoundError, NotADirectoryError):
         raise HTTPException(status_code=404, detail="Chapter folder not found")
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error reading chapter folder: {e}"
+        )
 
     if filename:
-        image_path = os.path.join(chapter_path, filename)
-        if not os.path.isfile(image_path):
+        image = listing.files.get(filename)
+        if image is None:
             raise HTTPException(status_code=404, detail="Image not found")
-        return FileResponse(image_path, media_type="image/jpeg")
-    else:
-        try:
-            # List all common image file types including modern formats
-            images = [
-                f
-                for f in os.listdir(chapter_path)
-                if f.lower().endswith(
-                    (
-                        ".jpg",
-                        ".jpeg",
-                        ".png",
-                        ".gif",
-                        ".webp",
-                        ".tiff",
-                        ".tif",
-                        ".avif",
-                        ".heic",
-                    )
-                )
-            ]
-
-            # Sort by the numeric prefix (before the extension)
-            def sort_key(name: str):
-                base, _ = os.path.splitext(name)
-                try:
-                    return int(base)
-                except ValueError:
-                    return base  # fallback to lexicographical
-
-            images.sort(key=sort_key)
-            return {"chapter": chapter, "images": images}
-        except Exception as e:
-            raise HTTPException(
-                status_code=500, detail=f"Error reading chapter folder: {e}"
+        headers = {
+            "ETag": image.etag,
+            "Last-Modified": formatdate(image.stat.st_mtime, usegmt=True),
+        }
+        if image_format or width:
+            return await get_variant(
+                request,
+                os.path.join(chapter_path, filename),
+                image,
+                variant_spec(image.mime, image_format, width, quality),
+                headers,
             )
+        if not_modified(request, image.etag, image.stat.st_mtime):
+            return Response(status_code=304, headers=headers)
+        # FileResponse serves Range/If-Range requests with 206 partial content
+        return FileResponse(
+            os.path.join(chapter_path, filename),
+            media_type=image.mime,
+            headers=headers,
+            stat_result=image.stat,
+        )
+
+    headers = {"ETag": listing.etag}
+    if not_modified(request, listing.etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"chapter": chapter, "images": listing.images}, headers=headers)
+
+
+async def get_variant(
+    request: Request, path: str, image: ImageInfo, spec: VariantSpec, headers: dict
+):
+    """Serve a resized/re-encoded copy of `image`, transcoding it on a miss."""
+    try:
+        sha256 = image.sha256 or await asyncio.to_thread(chapter_index.sha256, path)
+    except (KeyError, FileNotFoundError):
+        raise HTTPException(status_code=404, detail="Image not found")
+    headers["ETag"] = spec.etag(sha256)
+    if not_modified(request, headers["ETag"], image.stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    try:
+        variant = await asyncio.wrap_future(
+            get_variant_cache().request(path, sha256, spec)
+        )
+    except TranscodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except BrokenProcessPool:
+        raise HTTPException(
+            status_code=503,
+            detail="The image transcoder crashed and is restarting; retry shortly",
+        )
+    return FileResponse(variant, media_type=spec.mime, headers=headers)
+
+
+@app.get("/export")
+async def export_archive(
+    slug: str = Query(..., description="Series slug subfolder under /tenshi/data/"),
+    chapter: str = Query(
+        None, description="(Optional) Single chapter folder to export."
+    ),
+    start: float = Query(
+        None, description="(Optional) First chapter number to include."
+    ),
+    end: float = Query(None, description="(Optional) Last chapter number to include."),
+    archive_format: str = Query(
+        "cbz", alias="format", pattern="^(cbz|zip)$", description="cbz or zip"
+    ),
+):
+    """
+    Stream a chapter, a chapter range or a whole series as an uncompressed
+    CBZ/ZIP, page order matching /get_image.
+    """
+    series_path = os.path.join(DATA_DIR, slug)
+    try:
+        chapters = await asyncio.to_thread(
+            select_chapters, series_path, chapter, start, end
+        )
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="No matching chapters found")
+
+    name = f"{slug}-{chapter}" if chapter else slug
+    media_type = (
+        "application/vnd.comicbook+zip"
+        if archive_format == "cbz"
+        else "application/zip"
+    )
+    return StreamingResponse(
+        iter_archive(series_path, chapters),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}.{archive_format}"'
+        },
+    )
+
+
+@app.get("/reload_templates")
+async def reload_template_cache(
+    path: str = Query(
+        None, description="(Optional) Template path to reload; reloads all if omitted."
+    ),
+):
+    reload_templates(path)
+    return {"status": "Reloaded", "path": path}
 
 
 if __name__ == "__main__":
@@ -1,6 +1,19 @@
+import fcntl
+import hashlib
+import json
 import os
+import re
+import tempfile
+import threading
 from urllib.parse import urlparse
 
+# Per-chapter record of downloaded files: {filename: {url, size, sha256}}
+MANIFEST_NAME = ".manifest.json"
+# Per-chapter next free image index, updated under an exclusive file lock
+COUNTER_NAME = ".next_index"
+_INDEXED_NAME = re.compile(r"^(\d+)\.")
+_counter_lock = threading.Lock()
+
 
 def filename_for_index(src_url: str, idx: int) -> str:
     """
@@ -9,3 +22,125 @@ def filename_for_index(src_url: str, idx: int) -> str:
     """
     ext = os.path.splitext(urlparse(src_url).path)[1] or ".jpg"
     return f"{idx:03d}{ext}"
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 16) -> str:
+    """Hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Write `data` to a temp file beside `path`, then rename it into place."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _scan_next_index(directory: str) -> int:
+    """One past the highest numbered file (000.jpg, …) in `directory`."""
+    highest = -1
+    with os.scandir(directory) as it:
+        for entry in it:
+            match = _INDEXED_NAME.match(entry.name)
+            if match:
+                highest = max(highest, int(match.group(1)))
+    return highest + 1
+
+
+def _update_counter(directory: str, update) -> int:
+    """
+    Apply `update(next_index) -> new_next_index` to a chapter's counter
+    while holding an exclusive lock on it, so concurrent threads and
+    processes never see the same value. A missing or unreadable counter
+    is rebuilt from the files present. Returns the value before updating.
+    """
+    path = os.path.join(directory, COUNTER_NAME)
+    # Record locks are per process (and not inherited across fork), so
+    # threads of this process are serialized separately
+    with _counter_lock:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            raw = os.read(fd, 32).strip()
+            current = int(raw) if raw.isdigit() else _scan_next_index(directory)
+            new = update(current)
+            if new != current or not raw.isdigit():
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, str(new).encode())
+            return current
+        finally:
+            os.close(fd)  # releases the lock
+
+
+def allocate_indices(directory: str, count: int = 1) -> range:
+    """Atomically reserve the next `count` image indices of a chapter."""
+    start = _update_counter(directory, lambda current: current + count)
+    return range(start, start + count)
+
+
+def reserve_indices(directory: str, end: int) -> None:
+    """Mark indices below `end` as taken (e.g. after saving a whole chapter)."""
+    _update_counter(directory, lambda current: max(current, end))
+
+
+class ChapterManifest:
+    """
+    Thread-safe view of a chapter directory's `.manifest.json`, which
+    records the source URL, byte size and SHA-256 of every saved file.
+    """
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(self.path) as f:
+                self.entries: dict[str, dict] = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, filename: str) -> dict | None:
+        with self._lock:
+            return self.entries.get(filename)
+
+    def record(self, filename: str, url: str, size: int, sha256: str) -> None:
+        with self._lock:
+            self.entries[filename] = {"url": url, "size": size, "sha256": sha256}
+            self._dirty = True
+
+    def forget(self, filename: str) -> None:
+        with self._lock:
+            if self.entries.pop(filename, None) is not None:
+                self._dirty = True
+
+    def verify(self, filename: str, check_hash: bool = True) -> bool:
+        """True if the file on disk matches its recorded size (and hash)."""
+        entry = self.get(filename)
+        path = os.path.join(os.path.dirname(self.path), filename)
+        if entry is None or not os.path.isfile(path):
+            return False
+        if os.path.getsize(path) != entry["size"]:
+            return False
+        return not check_hash or sha256_file(path) == entry["sha256"]
+
+    def save(self) -> None:
+        """Persist the manifest atomically if anything changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self.entries, indent=1, sort_keys=True).encode()
+            self._dirty = False
+        atomic_write(self.path, data)
@@ -0,0 +1,197 @@
+"""
+In-process job queue for long-running Tenshi automation.
+
+Jobs run on a bounded pool of worker threads so FastAPI handlers never block
+the event loop. Callers either await a job's future or poll its status by ID.
+"""
+
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs kept around for status lookups
+MAX_FINISHED_JOBS = 500
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted to a queue that has no free slots."""
+
+
+class Job:
+    """A unit of work plus its lifecycle state and outcome."""
+
+    def __init__(self, name: str, fn: Callable, args: tuple, kwargs: dict):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.result: Any = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        # Free-form progress the job function may update while it runs
+        self.progress: dict = {}
+        self.future: Future = Future()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+_jobs: "OrderedDict[str, Job]" = OrderedDict()
+_jobs_lock = threading.Lock()
+_current = threading.local()
+
+
+def current_job() -> Job | None:
+    """The job running on this worker thread, if any."""
+    return getattr(_current, "job", None)
+
+
+def _register(job: Job) -> None:
+    with _jobs_lock:
+        _jobs[job.id] = job
+        # Evict the oldest finished jobs once the history grows too large
+        finished = [j.id for j in _jobs.values() if j.finished_at is not None]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del _jobs[job_id]
+
+
+def get_job(job_id: str) -> Job | None:
+    """Look up a job by ID across all queues."""
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+class JobQueue:
+    """A bounded FIFO of jobs served by a fixed number of worker threads."""
+
+    def __init__(self, name: str, workers: int = 1, max_pending: int = 32):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._queue: queue.Queue = queue.Queue()
+        # Jobs waiting for a worker; cancelled ones leave it (and free their
+        # slot) at once, though they stay in _queue until a worker skips them
+        self._pending: set[Job] = set()
+        self._threads: list[threading.Thread] = []
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the worker threads (idempotent)."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"{self.name}-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, name: str, fn: Callable, *args, **kwargs) -> Job:
+        """Queue `fn(*args, **kwargs)`; raises JobQueueFull if no slot is free."""
+        self.start()
+        job = Job(name, fn, args, kwargs)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise JobQueueFull(f"{self.name} queue is full")
+            self._pending.add(job)
+        self._queue.put(job)
+        _register(job)
+        logger.info("Queued %s job %s (depth %d)", name, job.id, self.depth)
+        return job
+
+    def cancel(self, job: Job) -> bool:
+        """
+        Cancel `job` if it has not started yet; a worker then drops it.
+        Returns False when it is already running or finished.
+        """
+        if not job.future.cancel():
+            return False
+        with self._lock:
+            self._pending.discard(job)
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        logger.info("Cancelled %s job %s before it started", job.name, job.id)
+        return True
+
+    @property
+    def depth(self) -> int:
+        """Jobs waiting for a worker (cancelled ones excluded)."""
+        return len(self._pending)
+
+    @property
+    def in_flight(self) -> int:
+        """Jobs currently running."""
+        return self._in_flight
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.depth,
+            "running": self.in_flight,
+        }
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: Job) -> None:
+        with self._lock:
+            self._pending.discard(job)
+        if not job.future.set_running_or_notify_cancel():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return
+        with self._lock:
+            self._in_flight += 1
+        job.status = "running"
+        job.started_at = time.time()
+        _current.job = job
+        try:
+            job.result = job.fn(*job.args, **job.kwargs)
+            job.status = "done"
+            job.future.set_result(job.result)
+        except BaseException as e:
+            logger.error("%s job %s failed: %s", job.name, job.id, e)
+            job.error = str(getattr(e, "detail", e))
+            job.status = "failed"
+            job.future.set_exception(e)
+        finally:
+            _current.job = None
+            job.finished_at = time.time()
+            with self._lock:
+                self._in_flight -= 1
+
+    def shutdown(self) -> None:
+        """Stop the workers once the jobs already queued have been drained."""
+        for _ in self._threads:
+            self._queue.put(None)
+        self._threads = []
@@ -0,0 +1,234 @@
+"""
+Minimal Prometheus-style metrics for Tenshi, rendered by /metrics.
+
+Counters and histograms are plain in-process objects: recording a value is
+one lock acquisition plus a bisect over the bucket bounds, cheap enough to
+leave on around every capture, match, navigation and download. Gauges are
+callbacks evaluated only when /metrics is scraped.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+# Seconds, from a single matchTemplate call up to a slow chapter load
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+# Bytes, from a thumbnail up to a long webtoon strip
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(9))  # 1 KiB … 64 MiB
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(_Metric):
+    """Monotonic count (or byte total) per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return super().render() + [
+            f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    """Bucketed observations (latencies, sizes) per label set."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the `with` block (also when it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._series.items()
+            }
+        lines = super().render()
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                bucket = _labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            label_str = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{label_str} {total:g}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    Current value(s) read from a callback at scrape time. The callback
+    returns a number, a {label values tuple: number} dict, or None when
+    there is nothing to report yet.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, fn: Callable, labelnames: tuple = ()
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        values = self.fn()
+        if values is None:
+            values = {}
+        elif not isinstance(values, dict):
+            values = {(): values}
+        return super().render() + [
+            f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Registry:
+    """Every metric created in this process, in creation order."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            # Re-registering a name (e.g. gauges on app reload) replaces it
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Vision
+CAPTURE_SECONDS = Histogram(
+    "tenshi_capture_seconds", "Screen capture latency.", ("backend",)
+)
+MATCH_SECONDS = Histogram(
+    "tenshi_match_template_seconds",
+    "matchTemplate time for one scaled template, by template and mode.",
+    ("template", "mode"),
+)
+TEMPLATE_WAIT_SECONDS = Histogram(
+    "tenshi_wait_for_template_seconds",
+    "Time until a waited-for template was detected (or the wait timed out).",
+    ("templates", "outcome"),
+)
+
+# Browser
+NAVIGATION_SECONDS = Histogram(
+    "tenshi_navigation_seconds", "Page navigation time.", ("kind",)
+)
+LAZY_LOAD_SECONDS = Histogram(
+    "tenshi_lazy_load_seconds", "Scrolling until lazy-loaded images settled."
+)
+EXTRACTION_SECONDS = Histogram(
+    "tenshi_extraction_js_seconds", "Image URL extraction JS run time."
+)
+
+# Network
+DOWNLOAD_SECONDS = Histogram(
+    "tenshi_image_download_seconds", "Per-image download time.", ("status",)
+)
+DOWNLOAD_SIZE_BYTES = Histogram(
+    "tenshi_image_size_bytes", "Per-image size.", ("status",), SIZE_BUCKETS
+)
+DOWNLOAD_BYTES = Counter(
+    "tenshi_image_bytes_total", "Image bytes by download outcome.", ("status",)
+)
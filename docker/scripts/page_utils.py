@@ -0,0 +1,169 @@
+"""
+Helpers that run against a Playwright (async) page leased from the
+browser pool.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from urllib.parse import urljoin
+
+from scripts.clearance_cache import ChallengeError
+from scripts.metrics import LAZY_LOAD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Titles of Cloudflare interstitials
+CHALLENGE_TITLES = ("just a moment", "attention required")
+
+# Upper bound (seconds) on scrolling a chapter until its images stop changing
+LAZY_LOAD_TIMEOUT = float(os.environ.get("TENSHI_LAZY_LOAD_TIMEOUT", "30"))
+LAZY_LOAD_INTERVAL = 0.1
+# Unchanged polls at the bottom (with no image requests pending) that count as done
+LAZY_LOAD_STABLE_POLLS = 3
+
+# Scrolls one viewport down and reports how far lazy-loading has got
+_SCROLL_STEP_JS = """() => {
+  const root = document.scrollingElement || document.documentElement;
+  window.scrollBy(0, window.innerHeight);
+  const imgs = Array.from(document.images);
+  return {
+    images: imgs.length,
+    loaded: imgs.filter(img => img.complete && img.naturalWidth > 0).length,
+    height: root.scrollHeight,
+    bottom: window.scrollY + window.innerHeight >= root.scrollHeight - 2,
+  };
+}"""
+
+
+async def raise_for_challenge(page, response) -> None:
+    """Raise ChallengeError if `response` is a 403 or a Cloudflare challenge."""
+    status = response.status if response else None
+    if status == 403:
+        raise ChallengeError(f"{page.url} answered 403")
+    title = (await page.title()).lower()
+    if any(marker in title for marker in CHALLENGE_TITLES):
+        raise ChallengeError(f"{page.url} is showing a challenge")
+
+
+class _PendingImages:
+    """Counts image requests the page has issued but not yet finished."""
+
+    def __init__(self, page):
+        self.page = page
+        self.count = 0
+
+    def __enter__(self) -> "_PendingImages":
+        self.page.on("request", self._on_request)
+        self.page.on("requestfinished", self._on_done)
+        self.page.on("requestfailed", self._on_done)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.page.remove_listener("request", self._on_request)
+        self.page.remove_listener("requestfinished", self._on_done)
+        self.page.remove_listener("requestfailed", self._on_done)
+
+    def _on_request(self, request) -> None:
+        if request.resource_type == "image":
+            self.count += 1
+
+    def _on_done(self, request) -> None:
+        if request.resource_type == "image":
+            self.count = max(0, self.count - 1)
+
+
+async def wait_for_lazy_load(page, timeout: float = LAZY_LOAD_TIMEOUT) -> dict:
+    """
+    Scroll `page` a viewport at a time until it reaches the bottom, then
+    keep nudging until the image count, the set of decoded images
+    (`naturalWidth` > 0) and the page height stop changing and no image
+    requests are pending. That settles early once every image has decoded,
+    but a page with no images yet must stay stable for the full
+    LAZY_LOAD_STABLE_POLLS. Returns as soon as that holds, or after
+    `timeout` seconds, with the last observed state.
+    """
+    start = time.monotonic()
+    state, last, stable = {}, None, 0
+    with _PendingImages(page) as pending:
+        while time.monotonic() - start < timeout:
+            state = await page.evaluate(_SCROLL_STEP_JS)
+            snapshot = (state["images"], state["loaded"], state["height"])
+            if state["bottom"] and pending.count == 0 and snapshot == last:
+                stable += 1
+                if stable >= LAZY_LOAD_STABLE_POLLS or (
+                    0 < state["images"] == state["loaded"]
+                ):
+                    break
+            else:
+                stable = 0
+            last = snapshot
+            await asyncio.sleep(LAZY_LOAD_INTERVAL)
+        else:
+            logger.warning(
+                "Lazy-load did not settle within %gs (%d/%d images loaded)",
+                timeout,
+                state.get("loaded", 0),
+                state.get("images", 0),
+            )
+    logger.info(
+        "Lazy-load finished in %.1fs: %d/%d images loaded",
+        time.monotonic() - start,
+        state.get("loaded", 0),
+        state.get("images", 0),
+    )
+    LAZY_LOAD_SECONDS.observe(time.monotonic() - start)
+    return state
+
+
+class ImageResponseRecorder:
+    """
+    Records the bodies of image responses a page receives while it loads
+    and scrolls, so images the browser already fetched need not be
+    downloaded a second time. Bodies are keyed by request URL, including
+    every URL of a redirect chain.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self._bodies: dict[str, asyncio.Future] = {}
+
+    def __enter__(self) -> "ImageResponseRecorder":
+        self.page.on("response", self._on_response)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.page.remove_listener("response", self._on_response)
+        for body in self._bodies.values():
+            if not body.done():
+                body.cancel()
+            elif not body.cancelled():
+                body.exception()  # mark retrieved
+
+    def _on_response(self, response) -> None:
+        request = response.request
+        if request.resource_type != "image" or response.status != 200:
+            return
+        body = asyncio.ensure_future(response.body())
+        self._bodies.setdefault(response.url, body)
+        while request.redirected_from:
+            request = request.redirected_from
+            self._bodies.setdefault(request.url, body)
+
+    async def bodies_for(self, urls: list[str]) -> dict[str, bytes]:
+        """
+        Return {url: body} for each of `urls` (resolved against the page
+        URL) that the page loaded successfully.
+        """
+        found = {}
+        for url in urls:
+            body = self._bodies.get(urljoin(self.page.url, url))
+            if body is None:
+                continue
+            try:
+                found[url] = await body
+            except Exception as e:
+                logger.debug("Could not read captured body for %s: %s", url, e)
+        logger.info("Captured %d/%d images from network traffic", len(found), len(urls))
+        return found
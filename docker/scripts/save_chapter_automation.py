@@ -3,80 +3,69 @@ import json
 import logging
 import os
 import sys
-import time
-from http import cookiejar
+import threading
+from collections import deque
+from contextlib import nullcontext
+from typing import Callable, ContextManager
 from urllib.parse import unquote, urlparse
 
-import requests
-from playwright.sync_api import sync_playwright
-from scripts.cloudflare_utils import bypass_cf
+from scripts.browser_control import run_with_clearance
+from scripts.browser_pool import BrowserPool, close_browser_pool, get_browser_pool
+from scripts.downloader import (
+    DOWNLOAD_CLIENT,
+    ChapterDownload,
+    DownloadResult,
+    DownloadStage,
+    client_for,
+    get_download_stage,
+    summarize,
+)
 from scripts.file_utils import filename_for_index
-from scripts.utils import CDP_ENDPOINT, FASTAPI_BASE
+from scripts.metrics import EXTRACTION_SECONDS, NAVIGATION_SECONDS
+from scripts.page_utils import (
+    ImageResponseRecorder,
+    raise_for_challenge,
+    wait_for_lazy_load,
+)
+from scripts.state_store import ImageState, SyncPlan, get_state_store
+from scripts.variants import pregenerate_thumbnails
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-def scroll_to_bottom(page, repeats=10, delay=0.2):
-    for _ in range(repeats):
-        page.keyboard.press("End")
-        time.sleep(delay)
+# Reuse image bodies the browser already downloaded instead of re-fetching
+CAPTURE_NETWORK = os.environ.get("TENSHI_CAPTURE_NETWORK", "0") == "1"
+# Chapters of a series that may be downloading while the next one is extracted
+SERIES_LOOKAHEAD = int(os.environ.get("TENSHI_SERIES_LOOKAHEAD", "2"))
 
 
 def extract_folder(chapter_url: str) -> str:
     return unquote(urlparse(chapter_url).path.rstrip("/").split("/")[-1])
 
 
-def save_chapter(chapter_url: str, js: str, slug: str):
-    folder = unquote(urlparse(chapter_url).path.rstrip("/").split("/")[-1])
-    out_dir = os.path.join("/tenshi/data", slug, folder)
-    os.makedirs(out_dir, exist_ok=True)
-
-    # 1) Bypass CF
-    bypass_cf(chapter_url)
-
-    with sync_playwright() as pw:
-        # 2) Connect to the existing browser and create a new page
-        browser = pw.chromium.connect_over_cdp(CDP_ENDPOINT)
-        context = browser.contexts[0]
-        page = context.new_page()
-
-        # 3) Harvest cookies into a requests session
-        cj = cookiejar.CookieJar()
-        for c in context.cookies():
-            cj.set_cookie(
-                cookiejar.Cookie(
-                    version=0,
-                    name=c["name"],
-                    value=c["value"],
-                    port=None,
-                    port_specified=False,
-                    domain=c["domain"],
-                    domain_specified=True,
-                    domain_initial_dot=False,
-                    path=c["path"],
-                    path_specified=True,
-                    secure=c["secure"],
-                    expires=None,
-                    discard=True,
-                    comment=None,
-                    comment_url=None,
-                    rest={},
-                    rfc2109=False,
-                )
-            )
-        session = requests.Session()
-        session.cookies = cj
-        session.headers.update({"Referer": chapter_url})
-
-        # 4) Load chapter & scroll to force lazy‐load
-        page.goto(chapter_url, wait_until="networkidle")
+async def _extract_chapter(
+    page, chapter_url: str, js: str, capture_network: bool = False
+) -> tuple:
+    """
+    Load the chapter on a pooled page and run the extraction JS.
+    Returns (image URLs, browser cookies, user agent, captured bodies) for
+    the download stage. Image responses are only recorded (and captured
+    bodies returned) when `capture_network` is set; otherwise no bodies
+    are read from the browser. Raises ChallengeError on a challenge page.
+    """
+    recording = ImageResponseRecorder(page) if capture_network else nullcontext()
+    with recording as recorder:
+        # Load chapter & scroll until lazy‐loaded images stop changing
+        with NAVIGATION_SECONDS.time(kind="chapter"):
+            response = await page.goto(chapter_url, wait_until="load")
+        await raise_for_challenge(page, response)
         logger.info("Loaded %s – scrolling to force lazy‑load", chapter_url)
-        scroll_to_bottom(page, repeats=20, delay=0.1)
+        await wait_for_lazy_load(page)
 
-        # 5) Grab all image URLs by running the provided JS
+        # Grab all image URLs by running the provided JS
         logger.info("Extracting image URLs via JS")
-        raw = page.evaluate(js)
+        with EXTRACTION_SECONDS.time():
+            raw = await page.evaluate(js)
         try:
             srcs = json.loads(raw)
         except Exception:
@@ -84,35 +73,348 @@ def save_chapter(chapter_url: str, js: str, slug: str):
             srcs = []
         logger.info("Found %d images", len(srcs))
 
-        # inside your save_chapter_automation.py, after you harvest cookies into `context`:
-        api_request = context.request  # this is a built‑in Playwright API for HTTP
+        captured = await recorder.bodies_for(srcs) if recorder is not None else {}
 
-        # Download images using a zero‑padded counter as filename: 000.jpg, 001.jpg, …
-        for idx, src in enumerate(srcs):
-            filename = filename_for_index(src, idx)
-            out_path = os.path.join(out_dir, filename)
+    cookies = await page.context.cookies()
+    user_agent = await page.evaluate("navigator.userAgent")
+    return srcs, cookies, user_agent, captured
+
+
+def _start_download(
+    stage: DownloadStage, chapter_url: str, js: str, slug: str, capture_network: bool
+) -> ChapterDownload:
+    """
+    Extract stage: bypass CF (skipped while the domain is cleared), load the
+    chapter and extract image URLs on a pooled page, then queue the images
+    on `stage` and return without waiting for them.
+    """
+    chapter = extract_folder(chapter_url)
+    out_dir = os.path.join("/tenshi/data", slug, chapter)
+    os.makedirs(out_dir, exist_ok=True)
+
+    state = get_state_store()
+    try:
+        srcs, cookies, user_agent, captured = run_with_clearance(
+            _extract_chapter, chapter_url, js, capture_network
+        )
+    except Exception as e:
+        state.record_chapter(slug, chapter_url, chapter, "failed", str(e))
+        raise
+
+    # Images are named with a zero‑padded counter: 000.jpg, 001.png, …
+    state.record_chapter(
+        slug,
+        chapter_url,
+        chapter,
+        "downloading",
+        images=[
+            ImageState(idx, src, filename_for_index(src, idx), "pending")
+            for idx, src in enumerate(srcs)
+        ],
+    )
+    client = client_for(get_browser_pool(), chapter_url, cookies, user_agent)
+    return stage.submit(client, srcs, out_dir, prefetched=captured)
+
+
+async def _browser_session(page, chapter_url: str) -> tuple:
+    """The browser's cookies and user agent, without navigating."""
+    cookies = await page.context.cookies()
+    user_agent = await page.evaluate("navigator.userAgent")
+    return cookies, user_agent
+
+
+def _retry_download(
+    stage: DownloadStage, chapter_url: str, slug: str, missing: list[ImageState]
+) -> ChapterDownload:
+    """
+    Re-queue a chapter's missing images under their original indices with
+    the browser's current cookies, skipping page load and extraction.
+    """
+    out_dir = os.path.join("/tenshi/data", slug, extract_folder(chapter_url))
+    os.makedirs(out_dir, exist_ok=True)
+    pool = get_browser_pool()
+    cookies = user_agent = None
+    if DOWNLOAD_CLIENT == "requests":
+        cookies, user_agent = pool.run(_browser_session, chapter_url)
+    return stage.submit(
+        client_for(pool, chapter_url, cookies, user_agent),
+        [image.url for image in missing],
+        out_dir,
+        indices=[image.idx for image in missing],
+    )
+
+
+def _record_results(
+    slug: str,
+    chapter_url: str,
+    download: ChapterDownload,
+    results: list[DownloadResult],
+    failed_status: str,
+) -> None:
+    """Store each image's outcome (size and hash from the manifest)."""
+    images = []
+    for result in results:
+        entry = download.manifest.get(result.filename) or {}
+        ok = result.status != "failed"
+        images.append(
+            ImageState(
+                result.index,
+                result.url,
+                result.filename,
+                "done" if ok else "failed",
+                entry.get("size") if ok else None,
+                entry.get("sha256") if ok else None,
+                result.error,
+            )
+        )
+    state = get_state_store()
+    state.record_images(slug, chapter_url, images)
+    failed = sum(image.status == "failed" for image in images)
+    if not images:
+        # Nothing extracted (e.g. the reader did not render): retry next sync
+        status, error = "failed", "no image URLs extracted"
+    elif failed:
+        status, error = failed_status, f"{failed} image(s) failed"
+    else:
+        status, error = "done", None
+    state.record_chapter(slug, chapter_url, extract_folder(chapter_url), status, error)
+
+
+def _finish_download(
+    chapter_url: str,
+    download: ChapterDownload,
+    slug: str,
+    failed_status: str = "partial",
+    pool: BrowserPool | None = None,
+) -> dict:
+    """
+    Wait for a chapter's downloads, record them in the state store and
+    return its summary. A chapter with failed images gets `failed_status`.
+    `pool` is the browser pool whose cookies the downloads used.
+    """
+    results = download.results()
+    _record_results(slug, chapter_url, download, results, failed_status)
+    summary = summarize(results)
+    if any(f["error"] == "status 403" for f in summary["failures"]):
+        # Clearance no longer accepted by the CDN; redo the bypass next time
+        (pool or get_browser_pool()).clearance.invalidate(chapter_url)
+    logger.info(
+        "Chapter %s: %d saved, %d captured, %d linked, %d skipped, %d failed",
+        extract_folder(chapter_url),
+        summary["saved"],
+        summary["captured"],
+        summary["linked"],
+        summary["skipped"],
+        summary["failed"],
+    )
+    try:
+        # Transcoded in the background; readers' first thumbnail view is a hit
+        pregenerate_thumbnails(os.path.dirname(download.manifest.path))
+    except Exception as e:
+        logger.warning("Could not queue thumbnails: %s", e)
+    return summary
 
-            # skip if already downloaded
-            if os.path.exists(out_path):
-                continue
 
-            logger.info("Downloading %s via Playwright APIRequest", filename)
+def save_chapter(
+    chapter_url: str,
+    js: str,
+    slug: str,
+    capture_network: bool = CAPTURE_NETWORK,
+    lease: Callable[[], ContextManager] = nullcontext,
+) -> dict:
+    """
+    Download every image of a chapter into /tenshi/data/<slug>/<chapter>.
+    The page is loaded on the shared browser pool; images are fetched
+    concurrently with the browser's cookies. With `capture_network`, images
+    the page already loaded are written from its own responses and only the
+    rest are downloaded. `lease()` is held while the browser is in use
+    (e.g. a browser worker lease), not while images download. Returns a
+    download summary.
+    """
+    with lease():
+        download = _start_download(
+            get_download_stage(), chapter_url, js, slug, capture_network
+        )
+        pool = get_browser_pool()
+    return _finish_download(chapter_url, download, slug, pool=pool)
+
+
+def save_series(
+    chapter_urls: list[str],
+    js: str,
+    slug: str,
+    capture_network: bool = CAPTURE_NETWORK,
+    progress: dict | None = None,
+    lease: Callable[[], ContextManager] = nullcontext,
+) -> dict:
+    """
+    Save several chapters of one series as a pipeline: while chapter N's
+    images download on the shared download stage, chapter N+1 is already
+    being loaded and extracted. At most SERIES_LOOKAHEAD chapters are
+    downloading at once. `lease()` is entered for each chapter's extraction
+    only, so a browser worker is free for other jobs while images
+    download. Per-chapter state is kept in `progress` (e.g. a job's
+    progress dict) as it changes; a failed chapter does not stop the rest.
+    Returns per-chapter summaries plus totals.
+    """
+    progress = {} if progress is None else progress
+    chapters = [
+        {
+            "chapter_url": url,
+            "chapter": extract_folder(url),
+            "status": "queued",
+            "images": 0,
+            "done": 0,
+        }
+        for url in chapter_urls
+    ]
+    progress["chapters"] = chapters
+    stage = get_download_stage()
+    in_flight: deque[tuple[dict, ChapterDownload, BrowserPool]] = deque()
+    count_lock = threading.Lock()
+
+    def count(entry: dict) -> Callable:
+        def on_done(_future) -> None:
+            with count_lock:
+                entry["done"] += 1
+
+        return on_done
+
+    def finish(entry: dict, download: ChapterDownload, pool: BrowserPool) -> None:
+        try:
+            entry["summary"] = _finish_download(
+                entry["chapter_url"], download, slug, pool=pool
+            )
+            entry["status"] = "done"
+        except Exception as e:
+            logger.error("Chapter %s failed: %s", entry["chapter"], e)
+            entry.update(status="failed", error=str(e))
+
+    for entry in chapters:
+        # Bound how far extraction runs ahead of the downloads
+        while len(in_flight) >= SERIES_LOOKAHEAD:
+            finish(*in_flight.popleft())
+        entry["status"] = "extracting"
+        try:
+            with lease():
+                download = _start_download(
+                    stage, entry["chapter_url"], js, slug, capture_network
+                )
+                pool = get_browser_pool()
+        except Exception as e:
+            logger.error("Chapter %s failed: %s", entry["chapter"], e)
+            entry.update(status="failed", error=str(e))
+            continue
+        entry.update(status="downloading", images=len(download.futures))
+        for future in download.futures:
+            future.add_done_callback(count(entry))
+        in_flight.append((entry, download, pool))
+    while in_flight:
+        finish(*in_flight.popleft())
+    return _series_totals(chapters)
+
+
+def _series_totals(chapters: list[dict]) -> dict:
+    summaries = [entry.get("summary", {}) for entry in chapters]
+    return {
+        "chapters": chapters,
+        "done": sum(entry["status"] == "done" for entry in chapters),
+        "failed": sum(entry["status"] == "failed" for entry in chapters),
+        "images": {
+            key: sum(summary.get(key, 0) for summary in summaries)
+            for key in (
+                "total",
+                "saved",
+                "captured",
+                "linked",
+                "skipped",
+                "failed",
+                "bytes",
+            )
+        },
+    }
+
+
+def sync_series(
+    chapter_urls: list[str],
+    js: str,
+    slug: str,
+    capture_network: bool = CAPTURE_NETWORK,
+    progress: dict | None = None,
+    full: bool = False,
+    run_id: int | None = None,
+    lease: Callable[[], ContextManager] = nullcontext,
+) -> dict:
+    """
+    Bring a series up to date using the state store: chapters never seen
+    (or whose extraction failed) go through save_series, chapters with
+    missing or failed images only re-download those, and complete chapters
+    are skipped without touching the browser or the disk. `full` ignores
+    the store. The run is recorded (or, with `run_id`, resumed) so it is
+    picked up again after a restart. `lease` is as for save_series.
+    """
+    progress = {} if progress is None else progress
+    state = get_state_store()
+    if run_id is None:
+        run_id = state.start_run(
+            slug,
+            {
+                "chapter_urls": chapter_urls,
+                "js": js,
+                "capture_network": capture_network,
+            },
+        )
+    try:
+        if full:
+            plan = SyncPlan(list(dict.fromkeys(chapter_urls)), {}, [])
+        else:
+            plan = state.diff(slug, chapter_urls)
+        progress.update(run_id=run_id, plan=plan.to_dict())
+        logger.info("Sync %s: %s", slug, plan.to_dict())
+
+        # Retries need no extraction, so they download alongside save_series
+        stage = get_download_stage()
+        retries = []
+        for chapter_url, missing in plan.retry.items():
+            entry = {
+                "chapter_url": chapter_url,
+                "chapter": extract_folder(chapter_url),
+                "status": "retrying",
+                "images": len(missing),
+            }
             try:
-                resp = api_request.get(src, headers={"Referer": chapter_url})
-                if resp.status != 200:
-                    logger.error("Failed to fetch %s: status %d", src, resp.status)
-                    continue
-                body = resp.body()
+                with lease():
+                    download = _retry_download(stage, chapter_url, slug, missing)
+                    retries.append((entry, download, get_browser_pool()))
             except Exception as e:
-                logger.error("Playwright request for %s threw: %s", src, e)
-                continue
+                logger.error("Retry of %s failed: %s", entry["chapter"], e)
+                entry.update(status="failed", error=str(e))
+                retries.append((entry, None, None))
+        progress["retries"] = [entry for entry, *_ in retries]
 
-            # write out with zero‑padded name
-            with open(out_path, "wb") as f:
-                f.write(body)
-
-        page.close()
-        browser.close()
+        saved = save_series(plan.extract, js, slug, capture_network, progress, lease)
+        for entry, download, pool in retries:
+            if download is None:
+                continue
+            try:
+                # Still failing with fresh cookies: re-extract on the next sync
+                entry["summary"] = _finish_download(
+                    entry["chapter_url"], download, slug, "failed", pool
+                )
+                entry["status"] = "done"
+            except Exception as e:
+                logger.error("Retry of %s failed: %s", entry["chapter"], e)
+                entry.update(status="failed", error=str(e))
+    except BaseException:
+        state.finish_run(run_id, "failed")
+        raise
+    state.finish_run(run_id)
+    return {
+        "run_id": run_id,
+        "plan": plan.to_dict(),
+        "up_to_date": plan.up_to_date,
+        **_series_totals(saved["chapters"] + [entry for entry, *_ in retries]),
+    }
 
 
 if __name__ == "__main__":
@@ -123,4 +425,7 @@ if __name__ == "__main__":
     chapter_url = sys.argv[1]
     js = sys.argv[2]
     slug = sys.argv[3]
-    save_chapter(chapter_url, js, slug)
+    try:
+        save_chapter(chapter_url, js, slug)
+    finally:
+        close_browser_pool()
@@ -1,21 +1,23 @@
+import asyncio
+import hashlib
 import logging
 import os
 import sys
-import time
+from typing import Callable, Container
 from urllib.parse import urlparse
 
-import requests
-from playwright.sync_api import sync_playwright
-from scripts.cloudflare_utils import bypass_cf
-from scripts.file_utils import filename_for_index
-from scripts.utils import CDP_ENDPOINT, FASTAPI_BASE
-
-
-def scroll_to_bottom(page, repeats=5, delay=0.3):
-    """Press End key `repeats` times with a short delay to trigger lazy‑load."""
-    for _ in range(repeats):
-        page.keyboard.press("End")
-        time.sleep(delay)
+from scripts.blob_store import get_blob_store
+from scripts.browser_control import run_with_clearance
+from scripts.browser_pool import close_browser_pool
+from scripts.clearance_cache import ChallengeError
+from scripts.file_utils import (
+    ChapterManifest,
+    allocate_indices,
+    atomic_write,
+    filename_for_index,
+)
+from scripts.metrics import NAVIGATION_SECONDS
+from scripts.page_utils import raise_for_challenge, wait_for_lazy_load
 
 
 def extract_chapter_folder(chapter_url: str) -> str:
@@ -25,66 +27,134 @@ def extract_chapter_folder(chapter_url: str) -> str:
     return "default_chapter"
 
 
-def save_image(chapter_url: str, image_url: str):
+def save_image(chapter_url: str, image_url: str, slug: str | None = None) -> dict:
+    """Save one image of a chapter; see save_images."""
+    result = save_images(chapter_url, [image_url], slug)[0]
+    if result["status"] != "saved":
+        raise RuntimeError(result["error"])
+    return result
+
+
+def save_images(
+    chapter_url: str, image_urls: list[str], slug: str | None = None
+) -> list[dict]:
+    """
+    Save `image_urls` (in order) after the chapter's existing images,
+    loading the chapter page once for all of them. Indices are reserved up
+    front from the chapter's counter, so concurrent saves never collide.
+    Returns one {image_url, filename, status, error} dict per image; a
+    failed image does not stop the rest.
+    """
     chapter = extract_chapter_folder(chapter_url)
-    target_dir = os.path.join("/tenshi/data", chapter)
+    if slug:
+        target_dir = os.path.join("/tenshi/data", slug, chapter)
+    else:
+        target_dir = os.path.join("/tenshi/data", chapter)
     os.makedirs(target_dir, exist_ok=True)
 
-    # determine next index by counting existing images
-    existing = sorted(
-        [
-            f
-            for f in os.listdir(target_dir)
-            if os.path.splitext(f)[1].lower() in (".jpg", ".jpeg", ".png", ".gif")
-        ]
-    )
-    idx = len(existing)
-    filename = filename_for_index(image_url, idx)
-    out_path = os.path.join(target_dir, filename)
-
-    bypass_cf(chapter_url)
-
-    with sync_playwright() as pw:
-        browser = pw.chromium.connect_over_cdp(CDP_ENDPOINT)
-        context = browser.contexts[0]
-        page = context.new_page()
-
-        # 1) Load chapter page so cookies are shared
-        page.goto(chapter_url, wait_until="networkidle")
-        logging.info("Loaded chapter page, now scrolling to load all images…")
-
-        # 2) Scroll to the bottom a few times to trigger lazy‑load
-        scroll_to_bottom(page)
+    image_urls = list(dict.fromkeys(image_urls))
+    indices = allocate_indices(target_dir, len(image_urls))
+    filenames = {
+        url: filename_for_index(url, idx) for url, idx in zip(image_urls, indices)
+    }
+    manifest = ChapterManifest(target_dir)
+    store = get_blob_store()
+    results: dict[str, dict] = {}
+
+    def on_image(image_url: str, body: bytes | None, error: str | None) -> None:
+        filename = filenames[image_url]
+        if body is None:
+            results[image_url] = _result(image_url, filename, "failed", error)
+            return
+        # 4) Write out to disk atomically and record it in the chapter manifest
+        out_path = os.path.join(target_dir, filename)
+        sha256 = hashlib.sha256(body).hexdigest()
+        if store is not None:
+            store.write(out_path, body, sha256, image_url)
+        else:
+            atomic_write(out_path, body)
+        manifest.record(filename, image_url, len(body), sha256)
+        results[image_url] = _result(image_url, filename, "saved")
+        logging.info("✔ Saved %s", out_path)
 
-        # 3) Now fetch the image URL
-        logging.info("Fetching image %s", filename)
-        response = page.goto(image_url, wait_until="networkidle")
+    try:
+        run_with_clearance(
+            _fetch_image_pages, chapter_url, image_urls, on_image, results
+        )
+    finally:
+        manifest.save()
+        if store is not None:
+            store.save_index()
+    return [
+        results.get(url) or _result(url, filenames[url], "failed", "not fetched")
+        for url in image_urls
+    ]
+
+
+def _result(image_url: str, filename: str, status: str, error: str | None = None):
+    return {
+        "image_url": image_url,
+        "filename": filename,
+        "status": status,
+        "error": error,
+    }
+
+
+async def _fetch_image_pages(
+    page,
+    chapter_url: str,
+    image_urls: list[str],
+    on_image: Callable,
+    done: Container[str],
+) -> None:
+    """
+    Open the chapter on a pooled page (for cookies) once, then fetch each
+    image and hand it to `on_image(url, body, error)` on a worker thread.
+    URLs in `done` are skipped, so a retry after a challenge only fetches
+    what is still missing.
+    """
+    # 1) Load chapter page so cookies are shared
+    with NAVIGATION_SECONDS.time(kind="chapter"):
+        response = await page.goto(chapter_url, wait_until="load")
+    await raise_for_challenge(page, response)
+    logging.info("Loaded chapter page, now scrolling to load all images…")
+
+    # 2) Scroll until lazy‑loaded images stop changing
+    await wait_for_lazy_load(page)
+
+    # 3) Now fetch each image URL
+    for image_url in image_urls:
+        if image_url in done:
+            continue
+        logging.info("Fetching image %s", image_url)
+        with NAVIGATION_SECONDS.time(kind="image"):
+            response = await page.goto(image_url, wait_until="networkidle")
+        if response and response.status == 403:
+            raise ChallengeError(f"{image_url} answered 403")
         if not response or response.status != 200:
-            raise RuntimeError(
-                f"Failed to load {image_url}: {response.status if response else 'no response'}"
+            body = None
+            error = f"Failed to load {image_url}: " + (
+                str(response.status) if response else "no response"
             )
-        img_bytes = response.body()
-
-        # 4) Write out to disk
-        with open(out_path, "wb") as f:
-            f.write(img_bytes)
-        logging.info("✔ Saved %s", out_path)
-
-        page.close()
-        browser.close()
+        else:
+            body, error = await response.body(), None
+        await asyncio.to_thread(on_image, image_url, body, error)
 
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: save_image_automation.py <chapter_url> <image_url>")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: save_image_automation.py <chapter_url> <image_url> [slug]")
         sys.exit(1)
 
     chapter_url, image_url = sys.argv[1], sys.argv[2]
+    slug = sys.argv[3] if len(sys.argv) == 4 else None
     try:
-        save_image(chapter_url, image_url)
+        save_image(chapter_url, image_url, slug)
     except Exception as e:
         logging.error("Error saving %s: %s", image_url, e)
         sys.exit(1)
+    finally:
+        close_browser_pool()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,435 @@
+"""
+Screen capture backends for Tenshi template matching.
+
+`XShmCapture` reads the X display (Xvfb) through the MIT-SHM extension into
+preallocated shared-memory buffers, so a poll tick only allocates the
+grayscale frame it returns (a quarter of the BGRA capture). `PILCapture` wraps
+`PIL.ImageGrab` and is used whenever MIT-SHM is unavailable.
+
+Xlib's default handlers terminate the process on a protocol error (e.g. a
+region past the screen edge) or a lost connection (Xvfb exiting). The MIT-SHM
+backend replaces them, so both surface as a RuntimeError from `grab()`.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from PIL import ImageGrab
+
+logger = logging.getLogger(__name__)
+
+# auto | xshm | pil
+CAPTURE_BACKEND = os.environ.get("TENSHI_CAPTURE_BACKEND", "auto").lower()
+
+Region = tuple[int, int, int, int]  # x, y, width, height
+
+
+class PILCapture:
+    """Fallback backend: PIL.ImageGrab followed by a grayscale conversion."""
+
+    name = "pil"
+    closed = False
+
+    def __init__(self, display: str | None = None):
+        self.display = display
+
+    def grab(self, region: Region | None = None) -> np.ndarray:
+        """Capture the screen (or `region`) as a grayscale array."""
+        bbox = None
+        if region:
+            x, y, w, h = region
+            bbox = (x, y, x + w, y + h)
+        screen = np.asarray(ImageGrab.grab(bbox=bbox, xdisplay=self.display))
+        return cv2.cvtColor(screen, cv2.COLOR_RGB2GRAY)
+
+    def close(self) -> None:
+        pass
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+
+class _XErrorEvent(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_int),
+        ("display", ctypes.c_void_p),
+        ("resourceid", ctypes.c_ulong),
+        ("serial", ctypes.c_ulong),
+        ("error_code", ctypes.c_ubyte),
+        ("request_code", ctypes.c_ubyte),
+        ("minor_code", ctypes.c_ubyte),
+    ]
+
+
+class _XImage(ctypes.Structure):
+    # Only the leading fields we read are declared.
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+    ]
+
+
+_ZPIXMAP = 2
+_ALL_PLANES = 0xFFFFFFFF
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+
+_ERROR_HANDLER = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XErrorEvent)
+)
+_IO_ERROR_EXIT_HANDLER = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p)
+
+# Reported by the handlers below, by Display pointer, until the call checks them
+_x_errors: dict[int, str] = {}
+_lost_displays: set[int] = set()
+_handlers_lock = threading.Lock()
+_error_handler_installed = False
+
+
+@_ERROR_HANDLER
+def _on_x_error(display, event) -> int:
+    e = event.contents
+    _x_errors[display] = (
+        f"X error {e.error_code} (request {e.request_code}.{e.minor_code})"
+    )
+    return 0
+
+
+@_IO_ERROR_EXIT_HANDLER
+def _on_io_error(display, _data) -> None:
+    # Returning instead of calling exit() leaves the connection marked dead
+    _lost_displays.add(display)
+
+
+def _load_library(name: str) -> ctypes.CDLL:
+    path = ctypes.util.find_library(name)
+    if not path:
+        raise OSError(f"lib{name} not found")
+    return ctypes.CDLL(path)
+
+
+class _ShmImage:
+    """One MIT-SHM XImage plus its reusable BGRA view."""
+
+    def __init__(self, capture: "XShmCapture", width: int, height: int):
+        self._capture = capture
+        self.info = _XShmSegmentInfo()
+        self.image = capture._xext.XShmCreateImage(
+            capture._display,
+            capture._visual,
+            capture._depth,
+            _ZPIXMAP,
+            None,
+            ctypes.byref(self.info),
+            width,
+            height,
+        )
+        if not self.image:
+            raise RuntimeError("XShmCreateImage failed")
+        ximage = self.image.contents
+        if ximage.bits_per_pixel != 32:
+            raise RuntimeError(f"Unsupported {ximage.bits_per_pixel}bpp display")
+
+        libc = capture._libc
+        size = ximage.bytes_per_line * ximage.height
+        self.info.shmid = libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if self.info.shmid < 0:
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        addr = libc.shmat(self.info.shmid, None, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            libc.shmctl(self.info.shmid, _IPC_RMID, None)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+        self.info.shmaddr = addr
+        self.info.readOnly = 0
+        ximage.data = addr
+
+        if not capture._xext.XShmAttach(capture._display, ctypes.byref(self.info)):
+            self._release(attached=False)
+            raise RuntimeError("XShmAttach failed")
+        capture._x11.XSync(capture._display, 0)
+        # Segment is freed automatically once both sides have detached.
+        libc.shmctl(self.info.shmid, _IPC_RMID, None)
+        try:
+            capture._check("XShmAttach")
+        except RuntimeError:
+            self._release(attached=False)
+            raise
+
+        raw = np.ctypeslib.as_array((ctypes.c_ubyte * size).from_address(addr))
+        self.bgra = raw.reshape(height, ximage.bytes_per_line // 4, 4)[:, :width]
+
+    def _release(self, attached: bool = True) -> None:
+        capture = self._capture
+        if attached:
+            capture._xext.XShmDetach(capture._display, ctypes.byref(self.info))
+        if self.info.shmaddr:
+            capture._libc.shmdt(ctypes.c_void_p(self.info.shmaddr))
+            self.info.shmaddr = None
+        if self.image:
+            capture._x11.XFree(self.image)
+            self.image = None
+
+    def close(self) -> None:
+        self.bgra = None
+        self._release()
+
+
+class XShmCapture:
+    """
+    MIT-SHM backend. Shared-memory buffers are allocated once per capture
+    size and reused; each `grab()` returns its own grayscale array, so a
+    frame stays valid while another thread captures the same display.
+    """
+
+    name = "xshm"
+
+    def __init__(self, display: str | None = None):
+        self.display = display
+        self._lock = threading.Lock()
+        self._images: dict[tuple[int, int], _ShmImage] = {}
+
+        self._x11 = _load_library("X11")
+        self._xext = _load_library("Xext")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._declare_prototypes()
+
+        self._display = self._x11.XOpenDisplay(display.encode() if display else None)
+        if not self._display:
+            raise RuntimeError(f"Cannot open X display {display or '$DISPLAY'}")
+        self._install_error_handlers()
+        if not self._xext.XShmQueryExtension(self._display):
+            self._x11.XCloseDisplay(self._display)
+            self._display = None
+            raise RuntimeError("MIT-SHM extension not available")
+
+        screen = self._x11.XDefaultScreen(self._display)
+        self._root = self._x11.XDefaultRootWindow(self._display)
+        self._visual = self._x11.XDefaultVisual(self._display, screen)
+        self._depth = self._x11.XDefaultDepth(self._display, screen)
+        self.width = self._x11.XDisplayWidth(self._display, screen)
+        self.height = self._x11.XDisplayHeight(self._display, screen)
+
+    def _declare_prototypes(self) -> None:
+        x11, xext, libc = self._x11, self._xext, self._libc
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XFree.argtypes = [ctypes.c_void_p]
+        x11.XSetErrorHandler.argtypes = [_ERROR_HANDLER]
+        x11.XSetErrorHandler.restype = ctypes.c_void_p
+
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.POINTER(_XShmSegmentInfo),
+            ctypes.c_uint,
+            ctypes.c_uint,
+        ]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_ulong,
+            ctypes.POINTER(_XImage),
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_ulong,
+        ]
+
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def _install_error_handlers(self) -> None:
+        global _error_handler_installed
+        with _handlers_lock:
+            if not _error_handler_installed:
+                self._x11.XSetErrorHandler(_on_x_error)
+                _error_handler_installed = True
+        try:
+            set_exit_handler = self._x11.XSetIOErrorExitHandler  # libX11 >= 1.7
+        except AttributeError:
+            logger.warning("libX11 < 1.7: losing the X connection will exit Tenshi")
+            return
+        set_exit_handler.argtypes = [
+            ctypes.c_void_p,
+            _IO_ERROR_EXIT_HANDLER,
+            ctypes.c_void_p,
+        ]
+        set_exit_handler(self._display, _on_io_error, None)
+
+    @property
+    def closed(self) -> bool:
+        return self._display is None
+
+    def _check(self, request: str) -> None:
+        """Raise if Xlib reported an error (or lost the connection) for `request`."""
+        if self._display in _lost_displays:
+            _lost_displays.discard(self._display)
+            self._abandon()
+            raise RuntimeError(f"Lost X display {self.display or '$DISPLAY'}")
+        error = _x_errors.pop(self._display, None)
+        if error:
+            raise RuntimeError(f"{request} failed: {error}")
+
+    def _abandon(self) -> None:
+        """Drop a dead connection without sending it any more requests."""
+        for image in self._images.values():
+            image.bgra = None
+            image._release(attached=False)
+        self._images.clear()
+        self._display = None
+
+    def _clamp(self, region: Region | None) -> Region:
+        """
+        `region` cut at the right and bottom screen edges, since XShmGetImage
+        fails with BadMatch past them. Raises ValueError if it starts
+        off-screen (clamping there would shift the frame's origin).
+        """
+        if region is None:
+            return 0, 0, self.width, self.height
+        x, y, w, h = region
+        if not (0 <= x < self.width and 0 <= y < self.height and w > 0 and h > 0):
+            raise ValueError(
+                f"Region {region} is outside the {self.width}x{self.height} screen"
+            )
+        return x, y, min(w, self.width - x), min(h, self.height - y)
+
+    def _image_for(self, width: int, height: int) -> _ShmImage:
+        image = self._images.get((width, height))
+        if image is None:
+            logger.debug("Allocating %dx%d MIT-SHM capture buffer", width, height)
+            image = _ShmImage(self, width, height)
+            self._images[(width, height)] = image
+        return image
+
+    def grab(self, region: Region | None = None) -> np.ndarray:
+        """
+        Capture the screen (or `region`) as a grayscale array. A region
+        running past the screen edge is cut to the visible part.
+        """
+        x, y, w, h = self._clamp(region)
+        with self._lock:
+            if self._display is None:
+                raise RuntimeError("Capture backend is closed")
+            image = self._image_for(w, h)
+            ok = self._xext.XShmGetImage(
+                self._display, self._root, image.image, x, y, _ALL_PLANES
+            )
+            self._check("XShmGetImage")
+            if not ok:
+                raise RuntimeError(f"XShmGetImage failed for region {x, y, w, h}")
+            # Converted while the lock is held: the next grab reuses image.bgra
+            return cv2.cvtColor(image.bgra, cv2.COLOR_BGRA2GRAY)
+
+    def close(self) -> None:
+        with self._lock:
+            for image in self._images.values():
+                image.close()
+            self._images.clear()
+            if self._display:
+                self._x11.XCloseDisplay(self._display)
+                self._display = None
+
+
+_backends: dict[str | None, PILCapture | XShmCapture] = {}
+_backends_lock = threading.Lock()
+_local = threading.local()
+
+
+def current_display() -> str | None:
+    """The X display this thread drives: set by `use_display`, else $DISPLAY."""
+    return getattr(_local, "display", None) or os.environ.get("DISPLAY")
+
+
+@contextmanager
+def use_display(display: str):
+    """Direct captures and xdotool input on this thread to `display`."""
+    previous = getattr(_local, "display", None)
+    _local.display = display
+    try:
+        yield
+    finally:
+        _local.display = previous
+
+
+def display_env() -> dict[str, str]:
+    """Environment for subprocesses (xdotool) targeting the current display."""
+    env = dict(os.environ)
+    display = current_display()
+    if display:
+        env["DISPLAY"] = display
+    return env
+
+
+def get_capture_backend(display: str | None = None) -> PILCapture | XShmCapture:
+    """
+    Return the shared capture backend for `display` (default: the current
+    display), creating it on first use (or after its X connection was lost)
+    according to TENSHI_CAPTURE_BACKEND.
+    """
+    display = display or current_display()
+    backend = _backends.get(display)
+    if backend is not None and not backend.closed:
+        return backend
+    with _backends_lock:
+        backend = _backends.get(display)
+        if backend is None or backend.closed:
+            backend = _create_backend(display)
+            _backends[display] = backend
+    return backend
+
+
+def _create_backend(display: str | None) -> PILCapture | XShmCapture:
+    if CAPTURE_BACKEND in ("auto", "xshm"):
+        try:
+            backend = XShmCapture(display)
+            logger.info(
+                "Using MIT-SHM screen capture (%dx%d)", backend.width, backend.height
+            )
+            return backend
+        except (OSError, RuntimeError) as e:
+            if CAPTURE_BACKEND == "xshm":
+                raise
+            logger.warning("MIT-SHM capture unavailable (%s); falling back to PIL", e)
+    return PILCapture(display)
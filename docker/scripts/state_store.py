@@ -0,0 +1,290 @@
+"""
+SQLite record of what has been fetched, per series slug.
+
+Every chapter a save job touches is stored with its status and extracted
+image list, and every image with its index, URL, filename, status, size and
+SHA-256. `diff` compares a series' chapter list against that record so a
+sync only extracts new (or previously failed) chapters and only downloads
+the images still missing from partially saved ones, without navigating to
+or stat-ing anything already done. Sync runs are recorded too, so runs cut
+short by a container restart are resumed on startup.
+
+Chapter status: downloading (extracted, images queued), done, partial
+(extracted, some images failed) or failed (extraction or retry failed).
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+STATE_DB = os.environ.get("TENSHI_STATE_DB", "/tenshi/data/.state.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    slug TEXT NOT NULL,
+    chapter_url TEXT NOT NULL,
+    chapter TEXT NOT NULL,
+    status TEXT NOT NULL,
+    images INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (slug, chapter_url)
+);
+CREATE TABLE IF NOT EXISTS images (
+    slug TEXT NOT NULL,
+    chapter_url TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (slug, chapter_url, idx)
+);
+CREATE TABLE IF NOT EXISTS sync_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    slug TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+"""
+
+
+class ImageState(NamedTuple):
+    """One image row: page index, source URL, filename, status, size, hash."""
+
+    idx: int
+    url: str
+    filename: str
+    status: str  # pending | done | failed
+    size: int | None = None
+    sha256: str | None = None
+    error: str | None = None
+
+
+class SyncPlan(NamedTuple):
+    """Work a sync still has to do, in the series' chapter order."""
+
+    extract: list[str]  # chapters to load and extract from scratch
+    retry: dict[str, list[ImageState]]  # chapter -> images still missing
+    up_to_date: list[str]
+
+    def to_dict(self) -> dict:
+        return {
+            "extract": len(self.extract),
+            "retry": len(self.retry),
+            "retry_images": sum(len(images) for images in self.retry.values()),
+            "up_to_date": len(self.up_to_date),
+        }
+
+
+class StateStore:
+    """Chapters, images and sync runs in one SQLite database (WAL mode)."""
+
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+
+    def _write(self, sql: str, rows) -> None:
+        with self._lock, self._db:
+            self._db.executemany(sql, rows)
+
+    def _query(self, sql: str, *params) -> list[sqlite3.Row]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def record_chapter(
+        self,
+        slug: str,
+        chapter_url: str,
+        chapter: str,
+        status: str,
+        error: str | None = None,
+        images: list[ImageState] | None = None,
+    ) -> None:
+        """
+        Set a chapter's status. With `images`, the chapter's image list is
+        replaced (a fresh extraction); otherwise it is left as is.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            if images is not None:
+                self._db.execute(
+                    "DELETE FROM images WHERE slug = ? AND chapter_url = ?",
+                    (slug, chapter_url),
+                )
+                self._db.executemany(
+                    "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(slug, chapter_url, *image, now) for image in images],
+                )
+            self._db.execute(
+                "INSERT INTO chapters VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (slug, chapter_url) DO UPDATE SET "
+                "chapter = excluded.chapter, status = excluded.status, "
+                "images = CASE WHEN ? THEN excluded.images ELSE images END, "
+                "error = excluded.error, updated_at = excluded.updated_at",
+                (
+                    slug,
+                    chapter_url,
+                    chapter,
+                    status,
+                    len(images or ()),
+                    error,
+                    now,
+                    images is not None,
+                ),
+            )
+
+    def record_images(
+        self, slug: str, chapter_url: str, images: list[ImageState]
+    ) -> None:
+        """Update the outcome of downloaded (or failed) images."""
+        now = time.time()
+        self._write(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(slug, chapter_url, *image, now) for image in images],
+        )
+
+    def chapter(self, slug: str, chapter_url: str) -> dict | None:
+        rows = self._query(
+            "SELECT * FROM chapters WHERE slug = ? AND chapter_url = ?",
+            slug,
+            chapter_url,
+        )
+        return dict(rows[0]) if rows else None
+
+    def chapters(self, slug: str) -> list[dict]:
+        """Every recorded chapter of `slug` with its image counts by status."""
+        rows = self._query(
+            "SELECT c.chapter_url, c.chapter, c.status, c.images, c.error, "
+            "c.updated_at, "
+            "SUM(i.status = 'done') AS done, SUM(i.status = 'failed') AS failed, "
+            "SUM(i.size) AS bytes "
+            "FROM chapters c LEFT JOIN images i "
+            "ON i.slug = c.slug AND i.chapter_url = c.chapter_url "
+            "WHERE c.slug = ? GROUP BY c.chapter_url ORDER BY c.updated_at",
+            slug,
+        )
+        return [
+            {**dict(row), "done": row["done"] or 0, "failed": row["failed"] or 0}
+            for row in rows
+        ]
+
+    def missing_images(self, slug: str, chapter_url: str) -> list[ImageState]:
+        rows = self._query(
+            "SELECT idx, url, filename, status, size, sha256, error FROM images "
+            "WHERE slug = ? AND chapter_url = ? AND status != 'done' ORDER BY idx",
+            slug,
+            chapter_url,
+        )
+        return [ImageState(*row) for row in rows]
+
+    def diff(self, slug: str, chapter_urls: list[str]) -> SyncPlan:
+        """
+        Split `chapter_urls` into chapters to extract (unknown or failed),
+        chapters with images to retry, and chapters already complete.
+        """
+        known = {
+            row["chapter_url"]: row["status"]
+            for row in self._query(
+                "SELECT chapter_url, status FROM chapters WHERE slug = ?", slug
+            )
+        }
+        plan = SyncPlan([], {}, [])
+        for url in dict.fromkeys(chapter_urls):
+            status = known.get(url)
+            if status is None or status == "failed":
+                plan.extract.append(url)
+                continue
+            missing = self.missing_images(slug, url)
+            if missing:
+                plan.retry[url] = missing
+            elif status == "done":
+                plan.up_to_date.append(url)
+            else:
+                # Extracted but nothing recorded as downloaded: start over
+                plan.extract.append(url)
+        return plan
+
+    def start_run(self, slug: str, params: dict) -> int:
+        """Record a sync run so it can be resumed if the process stops."""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO sync_runs (slug, params, status, started_at) "
+                "VALUES (?, ?, 'running', ?)",
+                (slug, json.dumps(params), time.time()),
+            )
+            return cursor.lastrowid
+
+    def finish_run(self, run_id: int, status: str = "done") -> None:
+        self._write(
+            "UPDATE sync_runs SET status = ?, finished_at = ? WHERE id = ?",
+            [(status, time.time(), run_id)],
+        )
+
+    def unfinished_runs(self) -> list[dict]:
+        """Sync runs that were still running when the process stopped."""
+        rows = self._query(
+            "SELECT id, slug, params FROM sync_runs WHERE status = 'running' "
+            "ORDER BY id"
+        )
+        return [
+            {"id": row["id"], "slug": row["slug"], **json.loads(row["params"])}
+            for row in rows
+        ]
+
+    def stats(self) -> dict:
+        rows = self._query("SELECT status, COUNT(*) AS n FROM chapters GROUP BY status")
+        images = self._query(
+            "SELECT status, COUNT(*) AS n, SUM(size) AS bytes FROM images "
+            "GROUP BY status"
+        )
+        return {
+            "chapters": {row["status"]: row["n"] for row in rows},
+            "images": {
+                row["status"]: {"count": row["n"], "bytes": row["bytes"] or 0}
+                for row in images
+            },
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_store: StateStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    """The process-wide state store, opened on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = StateStore()
+        return _store
+
+
+def close_state_store() -> None:
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
@@ -3,6 +3,7 @@
 Tenshi utilities: screenshot capture, template matching, and wait routines.
 """
 import logging
+import math
 import os
 import time
 
@@ -14,4 +15,24 @@ logger = logging.getLogger(__name__)
 DEBUG_OPENCV = os.environ.get("DEBUG_OPENCV", "0") == "1"
 FASTAPI_BASE = "http://127.0.0.1:8000"
 CDP_ENDPOINT = "http://127.0.0.1:9222"
+IMAGES_DIR = "/tenshi/images"
 RELOAD_TPL = "/tenshi/images/reload-button-template.png"
+
+
+def container_cpu_count() -> int:
+    """
+    Number of CPUs this process may use, honouring CPU affinity and a
+    cgroup v2 CPU quota (e.g. `docker run --cpus`).
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            count = min(count, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
@@ -0,0 +1,318 @@
+"""
+Resized / re-encoded variants of chapter images for /get_image.
+
+Variants (e.g. a 320px WebP thumbnail) are produced by Pillow in a process
+pool so decoding multi-megabyte strips never blocks the event loop or
+contends for the GIL, and are kept under /tenshi/data/.variants keyed by
+the source's SHA-256 plus the requested format, width and quality. A
+replaced source therefore never serves a stale variant, and identical
+images in different chapters share one. The cache is held to a byte
+budget; the least recently served variants are evicted first.
+
+Workers are spawned, so each one imports the main module unless it is a
+package `__main__`; the server is therefore started with `python3 -m
+scripts` (see `scripts/__main__.py`), which keeps the workers down to this
+module and Pillow instead of the whole API server. A pool whose worker died
+is replaced on the next miss.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple
+
+from PIL import Image, UnidentifiedImageError
+from scripts.chapter_index import chapter_index
+
+logger = logging.getLogger(__name__)
+
+VARIANT_DIR = "/tenshi/data/.variants"
+VARIANT_CACHE_MB = int(os.environ.get("TENSHI_VARIANT_CACHE_MB", "1024"))
+TRANSCODE_WORKERS = int(
+    os.environ.get("TENSHI_TRANSCODE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))
+)
+# Width of the thumbnails generated after each saved chapter (0 disables)
+THUMBNAIL_WIDTH = int(os.environ.get("TENSHI_THUMBNAIL_WIDTH", "320"))
+THUMBNAIL_FORMAT = "webp"
+DEFAULT_QUALITY = 75
+# Largest dimension libwebp can encode
+WEBP_MAX_SIZE = 16383
+
+# format name -> (Pillow encoder, extension, MIME type)
+FORMATS = {
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "png": ("PNG", "png", "image/png"),
+}
+_MIME_FORMATS = {mime: name for name, (_, _, mime) in FORMATS.items()}
+
+
+class TranscodeError(ValueError):
+    """The source cannot be converted to the requested variant."""
+
+
+class VariantSpec(NamedTuple):
+    """Requested output: format name, width in pixels (None keeps it), quality."""
+
+    format: str
+    width: int | None
+    quality: int
+
+    @property
+    def mime(self) -> str:
+        return FORMATS[self.format][2]
+
+    def filename(self, sha256: str) -> str:
+        return f"{sha256}-w{self.width or 0}-q{self.quality}.{FORMATS[self.format][1]}"
+
+    def etag(self, sha256: str) -> str:
+        return f'"{sha256[:32]}-{self.format}-{self.width or 0}-{self.quality}"'
+
+
+def variant_spec(
+    source_mime: str,
+    image_format: str | None = None,
+    width: int | None = None,
+    quality: int = DEFAULT_QUALITY,
+) -> VariantSpec:
+    """
+    Normalize request parameters: "jpg" means JPEG, and without a format
+    the source's is kept when it can be encoded (WebP otherwise).
+    """
+    if image_format:
+        image_format = image_format.lower().replace("jpg", "jpeg")
+        if image_format not in FORMATS:
+            raise TranscodeError(f"Unsupported format {image_format!r}")
+    else:
+        image_format = _MIME_FORMATS.get(source_mime, "webp")
+    return VariantSpec(image_format, width, quality)
+
+
+def transcode(src: str, dst: str, spec: VariantSpec) -> int:
+    """
+    Write `src` as `spec` to `dst` (atomically) and return its size. Runs
+    in the worker processes. Images are only ever scaled down.
+    """
+    encoder = FORMATS[spec.format][0]
+    try:
+        img = Image.open(src)
+    except UnidentifiedImageError as e:
+        raise TranscodeError(f"Cannot decode {os.path.basename(src)}") from e
+    with img:
+        if spec.width and spec.width < img.width:
+            # thumbnail() lets JPEG decode at reduced scale before resampling
+            img.thumbnail((spec.width, img.height), Image.LANCZOS)
+        if encoder == "WEBP" and max(img.size) > WEBP_MAX_SIZE:
+            raise TranscodeError(
+                f"{img.width}x{img.height} exceeds the WebP size limit; "
+                "request a smaller width or another format"
+            )
+        if encoder == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+        options = {
+            "WEBP": {"quality": spec.quality, "method": 4},
+            "JPEG": {"quality": spec.quality, "optimize": True, "progressive": True},
+            "PNG": {"optimize": False},
+        }[encoder]
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(dst), f".tmp-{uuid.uuid4().hex}")
+        try:
+            img.save(tmp, encoder, **options)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    return os.path.getsize(dst)
+
+
+class VariantCache:
+    """
+    On-disk variant cache with a byte budget and LRU eviction; misses are
+    transcoded on a process pool, concurrent requests for one variant
+    share a single conversion.
+    """
+
+    def __init__(
+        self,
+        root: str = VARIANT_DIR,
+        max_bytes: int = VARIANT_CACHE_MB << 20,
+        workers: int = TRANSCODE_WORKERS,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = max(1, workers)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending: dict[str, Future] = {}
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._load()
+
+    def _load(self) -> None:
+        """Index existing variants, least recently used (oldest mtime) first."""
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.startswith(".tmp-"):
+                    os.unlink(path)
+                    continue
+                st = os.stat(path)
+                found.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self._bytes += size
+
+    def path_for(self, sha256: str, spec: VariantSpec) -> str:
+        return os.path.join(self.root, sha256[:2], spec.filename(sha256))
+
+    def request(self, src: str, sha256: str, spec: VariantSpec) -> Future:
+        """
+        Future resolving to the variant's path; already completed when the
+        variant is cached.
+        """
+        path = self.path_for(sha256, spec)
+        with self._lock:
+            if path in self._entries and os.path.exists(path):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                future: Future = Future()
+                future.set_result(path)
+                # mtime carries recency across restarts
+                os.utime(path)
+                return future
+            pending = self._pending.get(path)
+            if pending is not None:
+                return pending
+            self.misses += 1
+            pool, job = self._submit(src, path, spec)
+            future = Future()
+            self._pending[path] = future
+        job.add_done_callback(lambda job: self._finish(path, pool, job, future))
+        return future
+
+    def _submit(
+        self, src: str, path: str, spec: VariantSpec
+    ) -> tuple[ProcessPoolExecutor, Future]:
+        """Queue a transcode, replacing a broken pool. Called with the lock held."""
+        if self._pool is not None:
+            try:
+                return self._pool, self._pool.submit(transcode, src, path, spec)
+            except BrokenProcessPool:
+                self._drop_pool(self._pool)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        return self._pool, self._pool.submit(transcode, src, path, spec)
+
+    def _drop_pool(self, pool: ProcessPoolExecutor) -> None:
+        """
+        Forget `pool` after one of its workers died, so the next miss starts
+        a new one. Called with the lock held.
+        """
+        if self._pool is pool:
+            logger.warning("A transcoding process died; restarting the pool")
+            self._pool = None
+            self.restarts += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _finish(
+        self, path: str, pool: ProcessPoolExecutor, job: Future, future: Future
+    ) -> None:
+        try:
+            error = job.exception()
+        except CancelledError as e:
+            error = e
+        with self._lock:
+            del self._pending[path]
+            if isinstance(error, BrokenProcessPool):
+                self._drop_pool(pool)
+            if error is None:
+                size = job.result()
+                self._bytes += size - self._entries.get(path, 0)
+                self._entries[path] = size
+                self._entries.move_to_end(path)
+                self._evict()
+        if error is None:
+            future.set_result(path)
+        else:
+            logger.warning("Could not create %s: %s", os.path.basename(path), error)
+            future.set_exception(error)
+
+    def _evict(self) -> None:
+        # The newest entry stays even if it alone exceeds the budget
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "restarts": self.restarts,
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def pregenerate_thumbnails(chapter_path: str) -> int:
+    """
+    Queue THUMBNAIL_WIDTH thumbnails for every image of a chapter without
+    waiting for them. Returns the number of images queued.
+    """
+    if THUMBNAIL_WIDTH <= 0:
+        return 0
+    cache = get_variant_cache()
+    listing = chapter_index.get(chapter_path)
+    spec = VariantSpec(THUMBNAIL_FORMAT, THUMBNAIL_WIDTH, DEFAULT_QUALITY)
+    for name in listing.images:
+        path = os.path.join(chapter_path, name)
+        cache.request(path, chapter_index.sha256(path), spec)
+    return len(listing.images)
+
+
+_cache: VariantCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_variant_cache() -> VariantCache:
+    """The process-wide variant cache, created on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = VariantCache()
+        return _cache
+
+
+def close_variant_cache() -> None:
+    """Stop the transcoding processes."""
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.shutdown()
+            _cache = None
@@ -0,0 +1,389 @@
+"""
+Offline benchmark and accuracy check for the template-matching pipeline.
+
+Runs headless (no display, browser or network) against synthetic frames:
+the PNG templates are pasted at known positions and scales onto light and
+dark page-like backgrounds with Gaussian noise, plus frames without any
+template. A directory of recorded screenshots can be added with --corpus;
+screenshots listed in its labels.json are scored as well, the rest are
+only timed. labels.json maps a file name to the templates it shows:
+
+    {"challenge.png": [{"template": "cloudflare_logo_template.png",
+                        "x": 640, "y": 212}], "blank.png": []}
+
+For each matching mode it reports detect_templates latency percentiles and
+frames per second, the cost of an unchanged polling tick, and precision /
+recall per template. --max-p95-ms, --min-precision and --min-recall turn it
+into a regression gate (exit status 1).
+
+    python3 /tenshi/scripts/vision_benchmark.py --frames 200 --json out.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+from scripts.cloudflare_utils import (
+    TemplateQuery,
+    detect_templates,
+    frame_changed,
+    frame_signature,
+    templates,
+)
+from scripts.utils import IMAGES_DIR
+
+# Templates bundled with the repo, for runs outside the container
+BUNDLED_IMAGES_DIR = os.path.join(os.path.dirname(__file__), "..", "images")
+MODES = ("exhaustive", "coarse")
+# (background gray level, UI element gray levels) per theme
+THEMES = {
+    "light": (245, (200, 225, 255)),
+    "dark": (28, (45, 60, 90)),
+}
+
+
+class Placement(NamedTuple):
+    """A template shown in a frame: its file name and center coordinates."""
+
+    template: str
+    x: int
+    y: int
+
+
+class Frame(NamedTuple):
+    name: str
+    image: np.ndarray
+    truth: list[Placement] | None  # None: not labelled, latency only
+
+
+def _draw_background(
+    rng: np.random.Generator, size: tuple[int, int], theme: str
+) -> np.ndarray:
+    """A page-like grayscale backdrop: gradient, panels and text lines."""
+    width, height = size
+    base, shades = THEMES[theme]
+    gradient = np.linspace(0, 8 if theme == "light" else -8, height)
+    frame = np.clip(base - gradient[:, None], 0, 255).astype(np.uint8)
+    frame = np.repeat(frame, width, axis=1)
+    for _ in range(rng.integers(3, 8)):
+        x, y = rng.integers(0, width - 40), rng.integers(0, height - 20)
+        w, h = rng.integers(40, width // 2), rng.integers(20, height // 3)
+        cv2.rectangle(frame, (x, y), (x + w, y + h), int(rng.choice(shades)), -1)
+    ink = 40 if theme == "light" else 210
+    for _ in range(rng.integers(5, 15)):
+        x, y = rng.integers(0, width - 100), rng.integers(15, height)
+        text = "".join(rng.choice(list("abcdefghij klmnop")) for _ in range(20))
+        cv2.putText(frame, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, ink, 1)
+    return frame
+
+
+def synthetic_frames(
+    paths: list[str],
+    count: int,
+    size: tuple[int, int],
+    scales: tuple,
+    noise: float,
+    seed: int,
+) -> list[Frame]:
+    """
+    `count` frames alternating light/dark themes, each with zero to two
+    non-overlapping templates at a random position and one of `scales`.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    frames = []
+    for n in range(count):
+        theme = "light" if n % 2 == 0 else "dark"
+        image = _draw_background(rng, size, theme)
+        truth: list[Placement] = []
+        taken: list[tuple[int, int, int, int]] = []
+        for i in rng.permutation(len(paths))[: rng.integers(0, 3)]:
+            template = templates.get(paths[i])
+            scale = float(rng.choice(scales))
+            w = int(template.shape[1] * scale)
+            h = int(template.shape[0] * scale)
+            if w >= width or h >= height:
+                continue
+            # A few tries for a spot that does not overlap an earlier paste
+            for _ in range(10):
+                x = int(rng.integers(0, width - w))
+                y = int(rng.integers(0, height - h))
+                if all(
+                    x + w <= ox or ox + ow <= x or y + h <= oy or oy + oh <= y
+                    for ox, oy, ow, oh in taken
+                ):
+                    image[y : y + h, x : x + w] = cv2.resize(template, (w, h))
+                    taken.append((x, y, w, h))
+                    truth.append(
+                        Placement(os.path.basename(paths[i]), x + w // 2, y + h // 2)
+                    )
+                    break
+        if noise > 0:
+            grain = rng.normal(0, noise, image.shape)
+            image = np.clip(image + grain, 0, 255).astype(np.uint8)
+        frames.append(Frame(f"synthetic-{n:04d}-{theme}", image, truth))
+    return frames
+
+
+def corpus_frames(corpus_dir: str) -> list[Frame]:
+    """Recorded screenshots in `corpus_dir`, labelled from its labels.json."""
+    labels_path = os.path.join(corpus_dir, "labels.json")
+    labels = {}
+    if os.path.exists(labels_path):
+        with open(labels_path) as f:
+            labels = json.load(f)
+    frames = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if not name.lower().endswith((".png", ".jpg", ".jpeg")):
+            continue
+        image = cv2.imread(os.path.join(corpus_dir, name), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            logging.warning("Skipping unreadable screenshot %s", name)
+            continue
+        truth = None
+        if name in labels:
+            truth = [
+                Placement(os.path.basename(p["template"]), p["x"], p["y"])
+                for p in labels[name]
+            ]
+        frames.append(Frame(name, image, truth))
+    return frames
+
+
+def _percentiles(samples: list[float]) -> dict:
+    """Latency summary in milliseconds."""
+    if not samples:
+        return {}
+    ms = np.array(samples) * 1000
+    return {
+        "mean": round(float(ms.mean()), 3),
+        **{f"p{p}": round(float(np.percentile(ms, p)), 3) for p in (50, 90, 95, 99)},
+        "max": round(float(ms.max()), 3),
+    }
+
+
+def _score(counts: dict, name: str, outcome: str) -> None:
+    counts.setdefault(name, {"tp": 0, "fp": 0, "fn": 0})[outcome] += 1
+
+
+def _precision_recall(counts: dict) -> dict:
+    tp, fp, fn = counts["tp"], counts["fp"], counts["fn"]
+    return {
+        **counts,
+        "precision": round(tp / (tp + fp), 4) if tp + fp else 1.0,
+        "recall": round(tp / (tp + fn), 4) if tp + fn else 1.0,
+    }
+
+
+def benchmark_mode(
+    frames: list[Frame],
+    paths: list[str],
+    mode: str,
+    threshold: float,
+    scales: tuple,
+    tolerance: int,
+    warmup: int,
+) -> dict:
+    """
+    Match every template against every frame with one detect_templates
+    call, as a wait_for_templates tick does. A hit within `tolerance`
+    pixels of a labelled center is a true positive; any other hit is a
+    false positive, and a labelled template without a hit a false negative.
+    """
+    queries = [TemplateQuery(path, threshold, scales, mode) for path in paths]
+    for frame in frames[:warmup]:
+        detect_templates(frame.image, queries)
+
+    latencies, counts = [], {}
+    started = time.perf_counter()
+    for frame in frames:
+        t0 = time.perf_counter()
+        hits = detect_templates(frame.image, queries)
+        latencies.append(time.perf_counter() - t0)
+        if frame.truth is None:
+            continue
+        expected = {p.template: p for p in frame.truth}
+        for hit in hits:
+            name = os.path.basename(hit.path)
+            place = expected.pop(name, None)
+            if place is None:
+                _score(counts, name, "fp")
+            elif max(abs(hit.coords[0] - place.x), abs(hit.coords[1] - place.y)) > (
+                tolerance
+            ):
+                # Right template, wrong place: a false alarm and a miss
+                _score(counts, name, "fp")
+                _score(counts, name, "fn")
+            else:
+                _score(counts, name, "tp")
+        for name in expected:
+            _score(counts, name, "fn")
+    elapsed = time.perf_counter() - started
+
+    total = {"tp": 0, "fp": 0, "fn": 0}
+    for per_template in counts.values():
+        for key in total:
+            total[key] += per_template[key]
+    return {
+        "frames": len(frames),
+        "fps": round(len(frames) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": _percentiles(latencies),
+        **_precision_recall(total),
+        "templates": {name: _precision_recall(c) for name, c in sorted(counts.items())},
+    }
+
+
+def benchmark_idle_tick(frames: list[Frame], repeat: int = 5) -> dict:
+    """
+    Cost of a polling tick on an unchanged screen: wait_for_templates then
+    only computes and compares the frame signature, skipping matching.
+    """
+    latencies = []
+    for frame in frames:
+        previous = frame_signature(frame.image)
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            frame_changed(previous, frame_signature(frame.image))
+            latencies.append(time.perf_counter() - t0)
+    return {"latency_ms": _percentiles(latencies)}
+
+
+def _print_report(report: dict) -> None:
+    print(
+        f"{report['frames']} frames ({report['labelled']} labelled), "
+        f"{len(report['templates'])} templates, "
+        f"threshold {report['threshold']}, scales {report['scales']}"
+    )
+    idle = report["idle_tick"]["latency_ms"]
+    print(f"idle tick: p50 {idle['p50']:.3f} ms, p99 {idle['p99']:.3f} ms")
+    for mode, result in report["modes"].items():
+        lat = result["latency_ms"]
+        print(
+            f"\n[{mode}] {result['fps']:.1f} fps, latency ms "
+            f"p50 {lat['p50']:.2f} p90 {lat['p90']:.2f} "
+            f"p95 {lat['p95']:.2f} p99 {lat['p99']:.2f} max {lat['max']:.2f}"
+        )
+        print(
+            f"  precision {result['precision']:.3f} recall {result['recall']:.3f} "
+            f"(tp {result['tp']}, fp {result['fp']}, fn {result['fn']})"
+        )
+        for name, c in result["templates"].items():
+            print(
+                f"  {name:<45} precision {c['precision']:.3f} "
+                f"recall {c['recall']:.3f} (tp {c['tp']}, fp {c['fp']}, fn {c['fn']})"
+            )
+
+
+def _gate(report: dict, args: argparse.Namespace) -> list[str]:
+    """Threshold violations, one message each."""
+    failures = []
+    for mode, result in report["modes"].items():
+        p95 = result["latency_ms"]["p95"]
+        if args.max_p95_ms is not None and p95 > args.max_p95_ms:
+            failures.append(f"{mode}: p95 {p95:.2f} ms > {args.max_p95_ms} ms")
+        if args.min_precision is not None and result["precision"] < args.min_precision:
+            failures.append(
+                f"{mode}: precision {result['precision']:.3f} < {args.min_precision}"
+            )
+        if args.min_recall is not None and result["recall"] < args.min_recall:
+            failures.append(
+                f"{mode}: recall {result['recall']:.3f} < {args.min_recall}"
+            )
+    return failures
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--images",
+        default=IMAGES_DIR if os.path.isdir(IMAGES_DIR) else BUNDLED_IMAGES_DIR,
+        help="Template directory (default: %(default)s)",
+    )
+    parser.add_argument("--corpus", help="Directory of recorded screenshots")
+    parser.add_argument("--frames", type=int, default=100, help="Synthetic frames")
+    parser.add_argument("--size", default="1280x720", help="Synthetic frame WxH")
+    parser.add_argument("--noise", type=float, default=6.0, help="Noise std. dev.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument(
+        "--threshold", type=float, default=TemplateQuery._field_defaults["threshold"]
+    )
+    parser.add_argument(
+        "--scales",
+        default=",".join(str(s) for s in TemplateQuery._field_defaults["scales"]),
+        help="Scales templates are pasted and matched at",
+    )
+    parser.add_argument(
+        "--tolerance", type=int, default=8, help="Max center error in pixels"
+    )
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--max-p95-ms", type=float)
+    parser.add_argument("--min-precision", type=float)
+    parser.add_argument("--min-recall", type=float)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    images_dir = os.path.abspath(args.images)
+    paths = sorted(
+        os.path.join(images_dir, name)
+        for name in os.listdir(images_dir)
+        if name.lower().endswith(".png")
+    )
+    paths = [path for path in paths if templates.get(path) is not None]
+    if not paths:
+        parser.error(f"No PNG templates in {images_dir}")
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"Unknown mode(s): {', '.join(sorted(unknown))}")
+    scales = tuple(float(s) for s in args.scales.split(","))
+    width, height = (int(v) for v in args.size.lower().split("x"))
+
+    frames = synthetic_frames(
+        paths, args.frames, (width, height), scales, args.noise, args.seed
+    )
+    if args.corpus:
+        frames += corpus_frames(args.corpus)
+    if not frames:
+        parser.error("Nothing to benchmark")
+
+    report = {
+        "frames": len(frames),
+        "labelled": sum(frame.truth is not None for frame in frames),
+        "templates": [os.path.basename(path) for path in paths],
+        "threshold": args.threshold,
+        "scales": list(scales),
+        "idle_tick": benchmark_idle_tick(frames),
+        "modes": {
+            mode: benchmark_mode(
+                frames,
+                paths,
+                mode,
+                args.threshold,
+                scales,
+                args.tolerance,
+                args.warmup,
+            )
+            for mode in modes
+        },
+    }
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failures = _gate(report, args)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""
+Pool of isolated browser workers and the scheduler that leases them.
+
+Each worker is its own Xvfb display plus Brave instance with a separate CDP
+port and profile directory, launched by `start_browser.sh <index>`. A job
+leases one worker while it drives the browser; while leased, screen
+capture, xdotool input and `get_browser_pool()` on the job's thread all
+target that worker, so concurrent jobs never type into the same window. Excess jobs wait for a
+free worker, and workers that fail health checks or keep failing jobs with
+browser errors are restarted before their next lease.
+"""
+
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from playwright.async_api import Error as PlaywrightError
+from scripts.browser_control import BrowserUpdateError
+from scripts.browser_pool import BrowserPool, get_browser_pool, use_browser_pool
+from scripts.clearance_cache import ClearanceCache
+from scripts.screen_capture import use_display
+
+logger = logging.getLogger(__name__)
+
+BROWSER_WORKERS = int(os.environ.get("TENSHI_BROWSER_WORKERS", "1"))
+# Worker i uses display :(DISPLAY_BASE + i) and CDP port (CDP_PORT_BASE + i)
+DISPLAY_BASE = int(os.environ.get("TENSHI_DISPLAY_BASE", "99"))
+CDP_PORT_BASE = int(os.environ.get("TENSHI_CDP_PORT_BASE", "9223"))
+START_BROWSER = "/tenshi/config/start_browser.sh"
+# Consecutive failed jobs after which a worker is restarted
+WORKER_MAX_FAILURES = 3
+# Errors that implicate the worker's browser rather than the job itself
+BROWSER_ERRORS = (PlaywrightError, BrowserUpdateError, ConnectionError)
+# Seconds to wait for a restarted browser to accept CDP connections
+BROWSER_START_TIMEOUT = 30.0
+
+
+class BrowserWorker:
+    """One display + browser pair and the CDP pool connected to it."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.display = f":{DISPLAY_BASE + index}"
+        self.cdp_port = CDP_PORT_BASE + index
+        self.failures = 0
+        self.recycles = 0
+        self.jobs = 0
+        self.busy = False
+        if index == 0:
+            # The first browser is the one the default pool (and port 9222) reach
+            self.pool = get_browser_pool()
+        else:
+            self.pool = BrowserPool(f"http://127.0.0.1:{self.cdp_port}")
+            self.pool.start()
+
+    def healthy(self) -> bool:
+        return self.pool.health()["connected"]
+
+    def failed_by(self, error: BaseException) -> bool:
+        """
+        Whether a job failing with `error` counts against this worker: a
+        browser/CDP error, or any error after which the browser no longer
+        answers. Bad requests, challenges and empty chapters do not.
+        """
+        if isinstance(error, BROWSER_ERRORS):
+            return True
+        try:
+            return not self.healthy()
+        except Exception:
+            return True
+
+    def recycle(self) -> None:
+        """Restart this worker's display/browser and reconnect to it."""
+        logger.warning(
+            "Recycling browser worker %d (%d consecutive failures)",
+            self.index,
+            self.failures,
+        )
+        self.pool.close()
+        if os.path.exists(START_BROWSER):
+            subprocess.run([START_BROWSER, str(self.index)], check=True, timeout=60)
+            self._wait_for_cdp()
+        else:
+            logger.warning("%s not found; reconnecting without restart", START_BROWSER)
+        self.pool.clearance = ClearanceCache()
+        self.pool.start()
+        self.failures = 0
+        self.recycles += 1
+
+    def _wait_for_cdp(self) -> None:
+        url = f"http://127.0.0.1:{self.cdp_port}/json/version"
+        end = time.time() + BROWSER_START_TIMEOUT
+        while time.time() < end:
+            try:
+                with urllib.request.urlopen(url, timeout=2):
+                    return
+            except OSError:
+                time.sleep(0.5)
+        raise RuntimeError(f"Browser worker {self.index} did not start on {url}")
+
+    def stats(self) -> dict:
+        return {
+            "index": self.index,
+            "display": self.display,
+            "cdp_port": self.cdp_port,
+            "busy": self.busy,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "recycles": self.recycles,
+        }
+
+
+class WorkerScheduler:
+    """Leases browser workers to jobs; excess jobs wait for a free worker."""
+
+    def __init__(self, size: int = BROWSER_WORKERS):
+        self.size = max(1, size)
+        self.workers: list[BrowserWorker] = []
+        self._idle: queue.Queue = queue.Queue()
+        self._start_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Create the workers (idempotent)."""
+        with self._start_lock:
+            if self.workers:
+                return
+            for index in range(self.size):
+                worker = BrowserWorker(index)
+                self.workers.append(worker)
+                self._idle.put(worker)
+            logger.info("Started %d browser worker(s)", self.size)
+
+    @property
+    def free(self) -> int:
+        """Workers currently free."""
+        return self._idle.qsize()
+
+    @contextmanager
+    def lease(self, timeout: float | None = None):
+        """
+        Borrow a worker for the duration of a job and route this thread's
+        display and browser pool to it. Unhealthy workers are recycled
+        before being handed out.
+        """
+        self.start()
+        try:
+            worker: BrowserWorker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No browser worker free after {timeout:g}s")
+        try:
+            if worker.failures >= WORKER_MAX_FAILURES or not worker.healthy():
+                worker.recycle()
+        except Exception as e:
+            logger.error("Could not recycle browser worker %d: %s", worker.index, e)
+        worker.busy = True
+        worker.jobs += 1
+        try:
+            with use_display(worker.display), use_browser_pool(worker.pool):
+                yield worker
+            worker.failures = 0
+        except Exception as e:
+            if worker.failed_by(e):
+                worker.failures += 1
+            raise
+        finally:
+            worker.busy = False
+            self._idle.put(worker)
+
+    def health(self) -> list[dict]:
+        """Per-worker stats plus browser connection status."""
+        return [{**w.stats(), "browser": w.pool.health()} for w in self.workers]
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.pool.close()
+        self.workers = []
+        self._idle = queue.Queue()
+
+
+_scheduler: WorkerScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> WorkerScheduler:
+    """Return the process-wide worker scheduler, starting it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = WorkerScheduler()
+        _scheduler.start()
+        return _scheduler
+
+
+def free_workers() -> int | None:
+    """Free workers, or None if the scheduler has not been started."""
+    scheduler = _scheduler
+    return scheduler.free if scheduler is not None else None
+
+
+def close_scheduler() -> None:
+    """Close every worker's browser connection."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.close()
+            _scheduler = None
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts import each other as `scripts.<module>` (PYTHONPATH=/tenshi in the image)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,110 @@
+import errno
+import hashlib
+import os
+
+import pytest
+from scripts.blob_store import BlobStore
+
+PAGE = b"credit page " * 100
+SHA = hashlib.sha256(PAGE).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / ".blobs"))
+
+
+@pytest.fixture
+def chapters(tmp_path):
+    for name in ("ch1", "ch2"):
+        (tmp_path / name).mkdir()
+    return tmp_path
+
+
+def _save(chapters, name: str) -> str:
+    path = chapters / name
+    path.write_bytes(PAGE)
+    return str(path)
+
+
+def _no_links(monkeypatch, code: int) -> None:
+    def link(src, dst):
+        raise OSError(code, os.strerror(code), src)
+
+    monkeypatch.setattr(os, "link", link)
+
+
+def test_adopt_shares_one_inode_between_duplicates(store, chapters):
+    first = _save(chapters, "ch1/000.png")
+    assert not store.adopt(first, SHA, "https://cdn/credit.png")
+    assert os.path.samefile(first, store.blob_path(SHA))
+
+    second = _save(chapters, "ch2/000.png")
+    assert store.adopt(second, SHA)
+    assert os.path.samefile(second, store.blob_path(SHA))
+    assert os.stat(second).st_nlink == 3
+    assert store.adopt(second, SHA) is False  # already the blob
+    assert not [n for n in os.listdir(chapters / "ch2") if n.startswith(".tmp-")]
+
+
+def test_link_to_writes_nothing_for_known_blobs(store, chapters):
+    store.adopt(_save(chapters, "ch1/000.png"), SHA)
+    path = str(chapters / "ch2" / "000.png")
+    assert store.write(path, PAGE, SHA, "https://cdn/credit.png")
+    assert os.path.samefile(path, store.blob_path(SHA))
+    assert store.stats()["session"] == {
+        "links": 1,
+        "url_hits": 0,
+        "bytes_not_written": len(PAGE),
+    }
+
+
+@pytest.mark.parametrize("code", [errno.EXDEV, errno.EPERM])
+def test_without_hardlinks_files_are_kept_or_copied(store, chapters, monkeypatch, code):
+    store.adopt(_save(chapters, "ch1/000.png"), SHA)
+    _no_links(monkeypatch, code)
+
+    duplicate = _save(chapters, "ch2/000.png")
+    assert not store.adopt(duplicate, SHA)
+    assert open(duplicate, "rb").read() == PAGE
+
+    copied = str(chapters / "ch2" / "001.png")
+    assert store.link_to(SHA, copied) == len(PAGE)
+    assert open(copied, "rb").read() == PAGE
+    assert not os.path.samefile(copied, store.blob_path(SHA))
+    assert store.stats()["session"]["bytes_not_written"] == 0
+
+
+def test_other_link_errors_propagate(store, chapters, monkeypatch):
+    _no_links(monkeypatch, errno.ENOSPC)
+    with pytest.raises(OSError):
+        store.adopt(_save(chapters, "ch1/000.png"), SHA)
+
+
+def test_url_index_round_trips(store, chapters):
+    store.adopt(_save(chapters, "ch1/000.png"), SHA, "https://cdn/credit.png")
+    store.save_index()
+
+    reopened = BlobStore(store.root)
+    assert reopened.lookup_url("https://cdn/credit.png") == SHA
+    assert reopened.lookup_url("https://cdn/other.png") is None
+    assert reopened.stats()["session"]["url_hits"] == 1
+
+    # Entries whose blob is gone are not trusted
+    os.unlink(store.blob_path(SHA))
+    assert reopened.lookup_url("https://cdn/credit.png") is None
+
+
+def test_stats_counts_shared_bytes(store, chapters):
+    other = b"page two" * 50
+    other_sha = hashlib.sha256(other).hexdigest()
+    store.adopt(_save(chapters, "ch1/000.png"), SHA, "u0")
+    store.adopt(_save(chapters, "ch2/000.png"), SHA, "u1")
+    (chapters / "ch2" / "001.png").write_bytes(other)
+    store.adopt(str(chapters / "ch2" / "001.png"), other_sha)
+
+    stats = store.stats()
+    assert (stats["blobs"], stats["known_urls"]) == (2, 2)
+    assert stats["stored_bytes"] == len(PAGE) + len(other)
+    assert stats["logical_bytes"] == 2 * len(PAGE) + len(other)
+    assert stats["saved_bytes"] == len(PAGE)
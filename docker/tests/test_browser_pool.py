@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+from scripts.browser_pool import BrowserPool
+
+
+class _Page:
+    def __init__(self, target: str):
+        self.target = target
+        self.closed = False
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class _Session:
+    def __init__(self, page: _Page):
+        self.page = page
+
+    async def send(self, method: str) -> dict:
+        assert method == "Target.getTargetInfo"
+        return {"targetInfo": {"targetId": self.page.target}}
+
+    async def detach(self) -> None:
+        pass
+
+
+class _Context:
+    def __init__(self, *pages: _Page):
+        self.pages = list(pages)
+
+    async def new_cdp_session(self, page: _Page) -> _Session:
+        return _Session(page)
+
+
+@pytest.fixture
+def pool():
+    pool = BrowserPool("http://127.0.0.1:9")
+    yield pool
+    pool.close()
+
+
+def test_run_cancels_the_coroutine_on_timeout(pool, monkeypatch):
+    cancelled = threading.Event()
+
+    async def without_page(fn, *args):
+        return await fn(None, *args)
+
+    async def slow(page):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(pool, "_with_page", without_page)
+    with pytest.raises(FutureTimeoutError):
+        pool.run(slow, timeout=0.05)
+    assert cancelled.wait(5)
+
+
+def test_pooled_tabs_from_a_lost_connection_are_closed_on_reconnect(pool):
+    old_handle = _Page("pooled")
+    pool._owned = {old_handle: "pooled"}
+    pool._forget_pages()
+    assert pool._owned == {} and pool._orphans == {"pooled"}
+
+    # After reconnecting, the same tabs come back as new page objects
+    visible, pooled = _Page("visible"), _Page("pooled")
+    context = _Context(pooled, visible)
+    asyncio.run(pool._close_orphans(context))
+    assert pooled.closed and not visible.closed
+    assert pool._orphans == set()
+    assert asyncio.run(pool._visible_page(context)) is visible
+
+
+def test_visible_page_skips_owned_pages(pool):
+    leased, visible = _Page("leased"), _Page("visible")
+    pool._owned = {leased: "leased"}
+    assert asyncio.run(pool._visible_page(_Context(leased, visible))) is visible
@@ -0,0 +1,162 @@
+import hashlib
+import io
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+from scripts import fastapi_server
+from scripts.chapter_index import ChapterIndex
+from scripts.file_utils import ChapterManifest
+
+
+def _png(seed: int) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 48), (seed, 0, 0)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+PAGES = {"001.png": _png(1), "002.png": _png(2), "010.png": _png(3)}
+
+
+def _touch(path, mtime_ns: int) -> None:
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def chapter(tmp_path):
+    path = tmp_path / "series" / "chapter_1"
+    path.mkdir(parents=True)
+    for name, body in PAGES.items():
+        (path / name).write_bytes(body)
+    (path / "notes.txt").write_text("not an image")
+    return path
+
+
+def test_listing_sorts_pages_and_detects_types(chapter):
+    (chapter / "002.png").rename(chapter / "002.jpg")
+    listing = ChapterIndex().get(str(chapter))
+    assert listing.images == ["001.png", "002.jpg", "010.png"]
+    assert listing.files["002.jpg"].mime == "image/png"
+
+
+def test_etag_is_the_manifest_hash_or_size_and_mtime(chapter):
+    recorded = hashlib.sha256(PAGES["001.png"]).hexdigest()
+    manifest = ChapterManifest(str(chapter))
+    manifest.record("001.png", "u1", len(PAGES["001.png"]), recorded)
+    manifest.record("002.png", "u2", 1, "0" * 64)  # stale: size differs
+    manifest.save()
+
+    index = ChapterIndex()
+    files = index.get(str(chapter)).files
+    assert files["001.png"].etag == f'"{recorded[:32]}"'
+    stat = files["002.png"].stat
+    assert files["002.png"].etag == f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    assert files["002.png"].sha256 is None
+
+    # Unrecorded files are hashed on demand, once per listing
+    expected = hashlib.sha256(PAGES["002.png"]).hexdigest()
+    assert index.sha256(str(chapter / "002.png")) == expected
+    assert index.get(str(chapter)).hashes == {"002.png": expected}
+
+
+def test_listings_are_rebuilt_only_when_the_mtime_changes(chapter):
+    index = ChapterIndex()
+    _touch(chapter, 1_000_000_000_000_000_001)
+    first = index.get(str(chapter))
+    assert index.get(str(chapter)) is first
+    assert (index.hits, index.misses) == (1, 1)
+
+    (chapter / "003.png").write_bytes(_png(4))
+    _touch(chapter, 1_000_000_000_000_000_001)  # same mtime: still cached
+    assert index.get(str(chapter)) is first
+
+    _touch(chapter, 1_000_000_000_000_000_002)
+    second = index.get(str(chapter))
+    assert second is not first
+    assert "003.png" in second.images
+    assert index.stats() == {"chapters": 1, "hits": 2, "misses": 2}
+
+
+def test_least_recently_used_listings_are_evicted(tmp_path):
+    for name in "abc":
+        (tmp_path / name).mkdir()
+    index = ChapterIndex(max_chapters=2)
+    a = index.get(str(tmp_path / "a"))
+    index.get(str(tmp_path / "b"))
+    index.get(str(tmp_path / "a"))
+    index.get(str(tmp_path / "c"))  # evicts b
+    assert index.stats()["chapters"] == 2
+    assert index.get(str(tmp_path / "a")) is a
+    misses = index.misses
+    index.get(str(tmp_path / "b"))
+    assert index.misses == misses + 1
+
+
+@pytest.fixture
+def client(chapter, monkeypatch):
+    monkeypatch.setattr(fastapi_server, "DATA_DIR", str(chapter.parent.parent))
+    monkeypatch.setattr(fastapi_server, "chapter_index", ChapterIndex())
+    return TestClient(fastapi_server.app)
+
+
+def _image(client, name="001.png", **headers):
+    return client.get(
+        "/get_image",
+        params={"slug": "series", "chapter": "chapter_1", "filename": name},
+        headers=headers,
+    )
+
+
+def test_get_image_serves_the_file_with_validators(client):
+    resp = _image(client)
+    assert resp.status_code == 200
+    assert resp.content == PAGES["001.png"]
+    assert resp.headers["content-type"] == "image/png"
+    assert resp.headers["etag"].startswith('"')
+
+    etag, modified = resp.headers["etag"], resp.headers["last-modified"]
+    revalidated = _image(client, **{"If-None-Match": etag})
+    assert (revalidated.status_code, revalidated.content) == (304, b"")
+    assert revalidated.headers["etag"] == etag
+    assert _image(client, **{"If-Modified-Since": modified}).status_code == 304
+    assert _image(client, **{"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_get_image_serves_ranges(client):
+    resp = _image(client, Range="bytes=0-9")
+    assert resp.status_code == 206
+    assert resp.content == PAGES["001.png"][:10]
+    size = len(PAGES["001.png"])
+    assert resp.headers["content-range"] == f"bytes 0-9/{size}"
+
+    # A stale If-Range validator gets the whole file
+    stale = _image(client, Range="bytes=0-9", **{"If-Range": '"other"'})
+    assert (stale.status_code, stale.content) == (200, PAGES["001.png"])
+
+
+def test_get_image_lists_the_chapter(client):
+    params = {"slug": "series", "chapter": "chapter_1"}
+    resp = client.get("/get_image", params=params)
+    assert resp.json() == {"chapter": "chapter_1", "images": sorted(PAGES)}
+    assert resp.headers["etag"].startswith('W/"')
+    revalidated = client.get(
+        "/get_image", params=params, headers={"If-None-Match": resp.headers["etag"]}
+    )
+    assert revalidated.status_code == 304
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"slug": "series", "chapter": "chapter_1", "filename": "../chapter_1/001.png"},
+        {"slug": "series", "chapter": "chapter_1", "filename": "notes.txt"},
+        {"slug": "series", "chapter": "chapter_1", "filename": "/etc/passwd"},
+        {"slug": "series", "chapter": "../.."},
+        {"slug": "..", "chapter": ".."},
+        {"chapter": "."},
+        {"chapter": "missing"},
+    ],
+)
+def test_get_image_refuses_paths_outside_the_chapter(client, params):
+    assert client.get("/get_image", params=params).status_code == 404
@@ -0,0 +1,78 @@
+import pytest
+from scripts import clearance_cache
+from scripts.clearance_cache import EXPIRY_MARGIN, ClearanceCache, domain_of
+
+URL = "https://Read.Example.com/chapter/1"
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(clearance_cache, "time", clock)
+    return clock
+
+
+def _cookie(domain: str, expires: float, name: str = "cf_clearance") -> dict:
+    return {"name": name, "domain": domain, "expires": expires}
+
+
+def test_domain_of_lowercases_the_host():
+    assert domain_of(URL) == "read.example.com"
+    assert domain_of("not a url") == ""
+
+
+def test_ttl_expiry_honours_the_margin(clock):
+    cache = ClearanceCache(ttl=300)
+    assert not cache.is_valid(URL)
+    cache.store(URL, [])
+
+    clock.now += 300 - EXPIRY_MARGIN - 1
+    assert cache.is_valid(URL)
+    clock.now += 1
+    assert not cache.is_valid(URL)
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.stats()["domains"] == {}
+
+
+def test_clearance_cookie_expiry_wins_over_ttl(clock):
+    cache = ClearanceCache(ttl=10_000)
+    now = clock.now
+    cache.store(
+        URL,
+        [
+            _cookie(".example.com", now + 600),
+            _cookie("read.example.com", now + 400),
+            _cookie(".other.com", now + 100),
+            _cookie(".example.com", now + 50, name="session"),
+            _cookie(".example.com", -1),
+        ],
+    )
+    assert cache.stats()["domains"] == {"read.example.com": 400}
+
+    clock.now = now + 400 - EXPIRY_MARGIN - 1
+    assert cache.is_valid(URL)
+    clock.now += 1
+    assert not cache.is_valid(URL)
+
+
+def test_cookie_for_another_host_falls_back_to_ttl(clock):
+    cache = ClearanceCache(ttl=900)
+    cache.store(URL, [_cookie("example.org", clock.now + 100)])
+    assert cache.stats()["domains"] == {"read.example.com": 900}
+
+
+def test_invalidate(clock):
+    cache = ClearanceCache(ttl=900)
+    cache.store(URL, [])
+    cache.invalidate("https://read.example.com/other")
+    cache.invalidate(URL)
+    assert cache.invalidations == 1
+    assert not cache.is_valid(URL)
@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+from functools import partial
+
+import cv2
+import numpy as np
+import pytest
+from scripts import cloudflare_utils
+from scripts.cloudflare_utils import (
+    MIN_TEMPLATE_SIZE,
+    SIGNATURE_SIZE,
+    TemplateHit,
+    TemplateQuery,
+    TemplateRegistry,
+    _match_coarse_to_fine,
+    _match_exhaustive,
+    detect_templates,
+    downscale_frame,
+    frame_changed,
+    frame_signature,
+    wait_for_templates,
+)
+from scripts.vision_benchmark import BUNDLED_IMAGES_DIR, synthetic_frames
+
+
+def _write_template(path, value: int, size: tuple[int, int] = (40, 60)) -> str:
+    template = np.full(size, value, np.uint8)
+    template[::4, ::3] = 255 - value  # some structure so resizes differ
+    cv2.imwrite(str(path), template)
+    return str(path)
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return TemplateRegistry(str(tmp_path))
+
+
+def test_variants_are_cached_per_scale_tuple(registry, tmp_path):
+    path = _write_template(tmp_path / "logo.png", 10)
+    variants = registry.variants(path, (0.5, 1.0))
+    assert [scale for scale, _ in variants] == [0.5, 1.0]
+    assert variants[0][1].shape == (20, 30)
+    assert registry.variants(path, (0.5, 1.0)) is variants
+    assert registry.variants(path, [0.5, 1.0]) is variants
+
+    other = registry.variants(path, (1.0,))
+    assert other is not variants
+    assert registry.variants(path, (1.0,)) is other
+
+
+def test_scales_below_the_minimum_size_are_dropped(registry, tmp_path):
+    path = _write_template(tmp_path / "logo.png", 10)
+    tiny = (MIN_TEMPLATE_SIZE - 1) / 40
+    assert [scale for scale, _ in registry.variants(path, (tiny, 1.0))] == [1.0]
+
+
+def test_reload_one_template(registry, tmp_path):
+    logo = _write_template(tmp_path / "logo.png", 10)
+    button = _write_template(tmp_path / "button.png", 20)
+    logo_variants = registry.variants(logo, (1.0,))
+    button_variants = registry.variants(button, (1.0,))
+
+    _write_template(tmp_path / "logo.png", 200)
+    assert registry.get(logo)[1, 1] == 10  # still cached
+    registry.reload(logo)
+
+    assert registry.get(logo)[1, 1] == 200
+    reloaded = registry.variants(logo, (1.0,))
+    assert reloaded is not logo_variants
+    assert reloaded[0][1][1, 1] == 200
+    assert registry.variants(button, (1.0,)) is button_variants
+
+
+def test_reload_all_templates_preloads_the_directory(registry, tmp_path):
+    logo = _write_template(tmp_path / "logo.png", 10)
+    variants = registry.variants(logo, (1.0,))
+    _write_template(tmp_path / "logo.png", 200)
+    _write_template(tmp_path / "new.png", 30)
+
+    registry.reload()
+
+    assert set(registry._templates) == {logo, str(tmp_path / "new.png")}
+    assert registry.get(logo)[1, 1] == 200
+    assert registry.variants(logo, (1.0,)) is not variants
+
+
+def test_missing_template(registry, tmp_path):
+    path = str(tmp_path / "missing.png")
+    assert registry.get(path) is None
+    assert registry.variants(path, (1.0,)) == []
+
+    # Not cached as missing: the file is picked up once it exists
+    _write_template(path, 10)
+    assert registry.get(path) is not None
+    assert len(registry.variants(path, (1.0,))) == 1
+
+
+def _bundled_templates() -> list[str]:
+    return sorted(
+        os.path.abspath(os.path.join(BUNDLED_IMAGES_DIR, name))
+        for name in os.listdir(BUNDLED_IMAGES_DIR)
+        if name.endswith(".png")
+    )
+
+
+@pytest.fixture(scope="module")
+def frames():
+    return synthetic_frames(
+        _bundled_templates(), 8, (800, 450), (0.9, 1.0, 1.1), 3.0, seed=4
+    )
+
+
+def test_coarse_mode_finds_the_exhaustive_matches(frames):
+    paths = _bundled_templates()
+    placed = 0
+    for frame in frames:
+        exhaustive = detect_templates(
+            frame.image, [TemplateQuery(p, 0.8, mode="exhaustive") for p in paths]
+        )
+        coarse = detect_templates(
+            frame.image, [TemplateQuery(p, 0.8, mode="coarse") for p in paths]
+        )
+        assert {hit.path for hit in coarse} == {hit.path for hit in exhaustive}
+        for a, b in zip(coarse, exhaustive):
+            assert a.scale == b.scale
+            assert abs(a.coords[0] - b.coords[0]) <= 1
+            assert abs(a.coords[1] - b.coords[1]) <= 1
+        # Every pasted template is found, and nothing else
+        assert {os.path.basename(hit.path) for hit in coarse} == {
+            placement.template for placement in frame.truth
+        }
+        placed += len(frame.truth)
+    assert placed  # the seed places templates in some frames
+
+
+def test_coarse_refinement_matches_exhaustive_location():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (300, 400), np.uint8)
+    template = frame[120:170, 210:290].copy()
+    coarse_frame = downscale_frame(frame, 0.5)
+    coarse_template = cv2.resize(template, (40, 25), interpolation=cv2.INTER_AREA)
+
+    score, loc = _match_coarse_to_fine(
+        frame, coarse_frame, template, coarse_template, 0.9, 0.5
+    )
+    assert (round(score, 3), loc) == (1.0, (210, 120))
+    assert _match_exhaustive(frame, template)[1] == loc
+
+
+def test_coarse_refinement_without_candidates():
+    frame = np.full((200, 200), 128, np.uint8)
+    template = np.random.default_rng(1).integers(0, 256, (40, 40), np.uint8)
+    coarse = cv2.resize(template, (20, 20), interpolation=cv2.INTER_AREA)
+    assert _match_coarse_to_fine(
+        frame, downscale_frame(frame, 0.5), template, coarse, 0.9, 0.5
+    ) == (0.0, (0, 0))
+
+
+def test_run_parallel_keeps_task_order(monkeypatch):
+    monkeypatch.setattr(cloudflare_utils, "MATCH_WORKERS", 4)
+
+    def task(i):
+        time.sleep(0.01 * (5 - i))  # later tasks finish first
+        return i, threading.current_thread().name
+
+    results = cloudflare_utils._run_parallel([partial(task, i) for i in range(6)])
+    assert [i for i, _ in results] == list(range(6))
+    assert all(name.startswith("match") for _, name in results)
+
+
+def test_parallel_matching_agrees_with_serial(monkeypatch, frames):
+    queries = [TemplateQuery(p, 0.8) for p in _bundled_templates()]
+    for frame in frames[:4]:
+        monkeypatch.setattr(cloudflare_utils, "MATCH_WORKERS", 1)
+        serial = detect_templates(frame.image, queries)
+        monkeypatch.setattr(cloudflare_utils, "MATCH_WORKERS", 4)
+        assert detect_templates(frame.image, queries) == serial
+
+
+def test_frame_changed_ignores_noise_but_not_small_changes():
+    rng = np.random.default_rng(2)
+    frame = rng.integers(60, 200, (720, 1280), np.uint8)
+    noisy = np.clip(frame + rng.integers(-2, 3, frame.shape), 0, 255).astype(np.uint8)
+    changed = frame.copy()
+    changed[300:340, 600:640] = 255  # e.g. a checkbox appearing
+
+    signature = frame_signature(frame)
+    assert signature.shape == SIGNATURE_SIZE[::-1]
+    assert not frame_changed(signature, frame_signature(noisy))
+    assert frame_changed(signature, frame_signature(changed))
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    perf_counter = time
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(round(seconds, 4))
+        self.now += seconds
+
+
+@pytest.fixture
+def polling(monkeypatch):
+    """Screen frames served from a list, with matching counted, on a fake clock."""
+    clock = _FakeClock()
+    state = {"frames": [], "matched": []}
+
+    def grab_frame(region=None):
+        return (
+            state["frames"].pop(0) if len(state["frames"]) > 1 else state["frames"][0]
+        )
+
+    def detect(frame, queries, origin=(0, 0)):
+        state["matched"].append(frame)
+        found = int(frame[0, 0]) == 255
+        return [TemplateHit(queries[0].path, (1, 1), 1.0, 1.0)] if found else []
+
+    monkeypatch.setattr(cloudflare_utils, "time", clock)
+    monkeypatch.setattr(cloudflare_utils, "grab_frame", grab_frame)
+    monkeypatch.setattr(cloudflare_utils, "detect_templates", detect)
+    return clock, state
+
+
+def test_unchanged_frames_are_not_matched_and_polling_backs_off(polling):
+    clock, state = polling
+    idle = np.zeros((72, 128), np.uint8)
+    state["frames"] = [idle]
+
+    assert wait_for_templates(["t.png"], interval=0.1, timeout=2.0) == []
+    assert len(state["matched"]) == 1
+    # 0.1 after the matched frame, then x1.5 per unchanged frame up to 4x
+    assert clock.sleeps[:6] == [0.1, 0.15, 0.225, 0.3375, 0.4, 0.4]
+
+
+def test_a_changed_frame_is_matched_and_resets_the_interval(polling):
+    clock, state = polling
+    idle = np.zeros((72, 128), np.uint8)
+    found = idle.copy()
+    found[:20, :20] = 255
+    state["frames"] = [idle, idle, idle, found]
+
+    hits = wait_for_templates(["t.png"], interval=0.1, timeout=5.0)
+    assert [hit.path for hit in hits] == ["t.png"]
+    assert len(state["matched"]) == 2
+    assert clock.sleeps == [0.1, 0.15, 0.225]
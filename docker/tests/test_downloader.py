@@ -0,0 +1,242 @@
+import hashlib
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from PIL import Image
+from scripts.downloader import (
+    PART_SUFFIX,
+    DownloadClient,
+    _already_saved,
+    _browser_to_part,
+    _download_to_part,
+    _fetch,
+    _HostLimiter,
+    _stream_to_part,
+)
+from scripts.file_utils import ChapterManifest
+
+
+def _png(width: int = 64, height: int = 256) -> bytes:
+    buf = io.BytesIO()
+    Image.effect_noise((width, height), 50).convert("RGB").save(buf, "PNG")
+    return buf.getvalue()
+
+
+BODY = _png()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    /range.png honours Range; /plain.png always sends the whole body;
+    /guarded.png is /range.png but refuses anything but the browser.
+    """
+
+    ranges: list = []
+
+    def do_GET(self):
+        if self.path == "/guarded.png":
+            if self.headers.get("X-Client") != "browser":
+                self.send_error(403)
+                return
+            self.path = "/range.png"
+        if self.path not in ("/range.png", "/plain.png"):
+            self.send_error(404)
+            return
+        header = self.headers.get("Range")
+        type(self).ranges.append(header)
+        status, body = 200, BODY
+        if header and self.path == "/range.png":
+            offset = int(header.removeprefix("bytes=").rstrip("-"))
+            if offset >= len(BODY):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(BODY)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status, body = 206, BODY[offset:]
+        self.send_response(status)
+        if status == 206:
+            self.send_header(
+                "Content-Range", f"bytes {offset}-{len(BODY) - 1}/{len(BODY)}"
+            )
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Browser:
+    """Stands in for BrowserPool.request, returning lower-cased headers."""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, url, headers, timeout):
+        self.requests.append((url, headers))
+        resp = requests.get(
+            url, headers={**headers, "X-Client": "browser"}, timeout=timeout
+        )
+        headers = {k.lower(): v for k, v in resp.headers.items()}
+        return resp.status_code, headers, resp.content
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def reset_ranges():
+    _Handler.ranges = []
+
+
+def test_stream_resumes_a_partial_download(server, tmp_path):
+    part = tmp_path / ("000.png" + PART_SUFFIX)
+    part.write_bytes(BODY[:1000])
+    resp, size, sha256 = _stream_to_part(
+        requests.Session(), f"{server}/range.png", str(part)
+    )
+    assert resp.status_code == 206
+    assert _Handler.ranges == ["bytes=1000-"]
+    assert size == len(BODY)
+    assert sha256 == hashlib.sha256(BODY).hexdigest()
+    assert part.read_bytes() == BODY
+
+
+def test_stream_starts_over_when_range_is_ignored(server, tmp_path):
+    part = tmp_path / ("000.png" + PART_SUFFIX)
+    part.write_bytes(b"stale partial bytes")
+    resp, size, sha256 = _stream_to_part(
+        requests.Session(), f"{server}/plain.png", str(part)
+    )
+    assert resp.status_code == 200
+    assert part.read_bytes() == BODY
+    assert sha256 == hashlib.sha256(BODY).hexdigest()
+
+
+def test_stream_starts_over_on_416(server, tmp_path):
+    part = tmp_path / ("000.png" + PART_SUFFIX)
+    part.write_bytes(BODY + b"extra")
+    _, size, _ = _stream_to_part(requests.Session(), f"{server}/range.png", str(part))
+    assert _Handler.ranges == [f"bytes={len(BODY) + 5}-", None]
+    assert size == len(BODY)
+    assert part.read_bytes() == BODY
+
+
+def test_browser_resumes_a_partial_download(server, tmp_path):
+    part = tmp_path / ("000.png" + PART_SUFFIX)
+    part.write_bytes(BODY[:1000])
+    browser = _Browser()
+    status, _, size, sha256 = _browser_to_part(
+        browser, f"{server}/range.png", "https://example.org/ch", str(part)
+    )
+    assert status == 206
+    assert browser.requests[0][1] == {
+        "Referer": "https://example.org/ch",
+        "Range": "bytes=1000-",
+    }
+    assert size == len(BODY)
+    assert sha256 == hashlib.sha256(BODY).hexdigest()
+    assert part.read_bytes() == BODY
+
+
+def test_browser_starts_over_on_416(server, tmp_path):
+    part = tmp_path / ("000.png" + PART_SUFFIX)
+    part.write_bytes(BODY + b"extra")
+    _, _, size, _ = _browser_to_part(_Browser(), f"{server}/range.png", "", str(part))
+    assert _Handler.ranges == [f"bytes={len(BODY) + 5}-", None]
+    assert size == len(BODY)
+    assert part.read_bytes() == BODY
+
+
+def test_requests_client_falls_back_to_the_browser_on_403(server, tmp_path):
+    part = tmp_path / ("000.png" + PART_SUFFIX)
+    browser = _Browser()
+    client = DownloadClient(browser, "", requests.Session())
+    status, _, size, _ = _download_to_part(client, f"{server}/guarded.png", str(part))
+    assert (status, size) == (200, len(BODY))
+    assert len(browser.requests) == 1
+    assert part.read_bytes() == BODY
+
+    part.unlink()
+    status, _, size, _ = _download_to_part(
+        client._replace(browser=None), f"{server}/guarded.png", str(part)
+    )
+    assert (status, size) == (403, -1)
+
+
+def test_fetch_saves_then_skips(server, tmp_path):
+    manifest = ChapterManifest(str(tmp_path))
+    args = (
+        DownloadClient(_Browser(), ""),
+        0,
+        f"{server}/range.png",
+        str(tmp_path),
+        _HostLimiter(2),
+        0,
+        manifest,
+    )
+    first = _fetch(*args)
+    assert (first.status, first.filename, first.bytes) == (
+        "saved",
+        "000.png",
+        len(BODY),
+    )
+    assert (tmp_path / "000.png").read_bytes() == BODY
+    assert not (tmp_path / ("000.png" + PART_SUFFIX)).exists()
+    assert manifest.get("000.png")["sha256"] == hashlib.sha256(BODY).hexdigest()
+
+    assert _fetch(*args).status == "skipped"
+    assert len(_Handler.ranges) == 1
+
+
+def test_fetch_reports_http_errors(server, tmp_path):
+    result = _fetch(
+        DownloadClient(_Browser(), ""),
+        3,
+        f"{server}/gone.png",
+        str(tmp_path),
+        _HostLimiter(2),
+        2,
+        ChapterManifest(str(tmp_path)),
+    )
+    assert (result.status, result.attempts, result.error) == (
+        "failed",
+        1,
+        "status 404",
+    )
+
+
+def test_already_saved_checks_files_missing_from_the_manifest(tmp_path):
+    manifest = ChapterManifest(str(tmp_path))
+    (tmp_path / "000.png").write_bytes(BODY)
+    (tmp_path / "001.png").write_bytes(BODY[: len(BODY) // 2])
+
+    assert _already_saved(manifest, "000.png", "u0", str(tmp_path / "000.png"))
+    assert manifest.get("000.png")["size"] == len(BODY)
+
+    assert not _already_saved(manifest, "001.png", "u1", str(tmp_path / "001.png"))
+    assert not (tmp_path / "001.png").exists()
+    assert manifest.get("001.png") is None
+
+
+def test_already_saved_rejects_files_that_no_longer_match(tmp_path):
+    manifest = ChapterManifest(str(tmp_path))
+    path = tmp_path / "000.png"
+    path.write_bytes(BODY)
+    manifest.record("000.png", "u", len(BODY), hashlib.sha256(BODY).hexdigest())
+    assert _already_saved(manifest, "000.png", "u", str(path))
+
+    path.write_bytes(BODY[:-1] + b"\0")
+    assert not _already_saved(manifest, "000.png", "u", str(path))
+    assert not path.exists()
@@ -0,0 +1,80 @@
+import io
+import os
+import zipfile
+
+import pytest
+from scripts.export import chapter_number, iter_archive, select_chapters
+
+
+@pytest.fixture
+def series(tmp_path):
+    for chapter in ("chapter-1", "chapter-2", "chapter-10", "chapter-2.5", "extras"):
+        os.mkdir(tmp_path / chapter)
+    os.mkdir(tmp_path / ".hidden")
+    (tmp_path / "cover.jpg").write_bytes(b"cover")
+    return tmp_path
+
+
+def _fill(chapter_path, names):
+    for name in names:
+        (chapter_path / name).write_bytes(f"{chapter_path.name}/{name}".encode())
+
+
+def test_chapter_number():
+    assert chapter_number("chapter-12.5") == 12.5
+    assert chapter_number("extras") is None
+
+
+def test_select_chapters_natural_order(series):
+    assert select_chapters(str(series)) == [
+        "chapter-1",
+        "chapter-2",
+        "chapter-2.5",
+        "chapter-10",
+        "extras",
+    ]
+
+
+def test_select_chapters_number_range(series):
+    assert select_chapters(str(series), start=2) == [
+        "chapter-2",
+        "chapter-2.5",
+        "chapter-10",
+    ]
+    assert select_chapters(str(series), start=1.5, end=3) == [
+        "chapter-2",
+        "chapter-2.5",
+    ]
+    assert select_chapters(str(series), chapter="extras") == ["extras"]
+
+
+def test_select_chapters_missing(series):
+    with pytest.raises(FileNotFoundError):
+        select_chapters(str(series), chapter="chapter-3")
+    with pytest.raises(FileNotFoundError):
+        select_chapters(str(series), start=11)
+
+
+def _archive(series, chapters) -> zipfile.ZipFile:
+    return zipfile.ZipFile(io.BytesIO(b"".join(iter_archive(str(series), chapters))))
+
+
+def test_single_chapter_is_stored_flat_in_page_order(series):
+    _fill(series / "chapter-1", ["10.jpg", "2.png", "001.jpg", "notes.txt"])
+    archive = _archive(series, ["chapter-1"])
+    assert archive.namelist() == ["001.jpg", "2.png", "10.jpg"]
+    assert archive.read("10.jpg") == b"chapter-1/10.jpg"
+    assert {info.compress_type for info in archive.infolist()} == {zipfile.ZIP_STORED}
+    assert archive.testzip() is None
+
+
+def test_several_chapters_are_prefixed(series):
+    _fill(series / "chapter-2", ["001.jpg", "000.jpg"])
+    _fill(series / "chapter-10", ["000.webp"])
+    archive = _archive(series, ["chapter-2", "chapter-10"])
+    assert archive.namelist() == [
+        "chapter-2/000.jpg",
+        "chapter-2/001.jpg",
+        "chapter-10/000.webp",
+    ]
+    assert archive.read("chapter-10/000.webp") == b"chapter-10/000.webp"
@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import threading
+
+from scripts.file_utils import (
+    COUNTER_NAME,
+    MANIFEST_NAME,
+    ChapterManifest,
+    allocate_indices,
+    atomic_write,
+    filename_for_index,
+    reserve_indices,
+    sha256_file,
+)
+
+
+def test_filename_for_index_keeps_extension():
+    assert filename_for_index("https://cdn.x/a/b.webp?x=1", 7) == "007.webp"
+    assert filename_for_index("https://cdn.x/a/noext", 12) == "012.jpg"
+
+
+def test_atomic_write_replaces_without_leftovers(tmp_path):
+    path = tmp_path / "000.jpg"
+    atomic_write(str(path), b"old")
+    atomic_write(str(path), b"new")
+    assert path.read_bytes() == b"new"
+    assert os.listdir(tmp_path) == ["000.jpg"]
+
+
+def test_allocate_indices_is_unique_across_threads(tmp_path):
+    taken = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(25):
+            indices = allocate_indices(str(tmp_path), 3)
+            with lock:
+                taken.extend(indices)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(taken) == list(range(8 * 25 * 3))
+
+
+def _allocate_in_child(directory, queue):
+    queue.put([i for _ in range(20) for i in allocate_indices(directory, 2)])
+
+
+def test_allocate_indices_is_unique_across_processes(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    procs = [
+        ctx.Process(target=_allocate_in_child, args=(str(tmp_path), queue))
+        for _ in range(4)
+    ]
+    for proc in procs:
+        proc.start()
+    taken = [i for _ in procs for i in queue.get(timeout=30)]
+    for proc in procs:
+        proc.join(timeout=30)
+    assert sorted(taken) == list(range(4 * 20 * 2))
+
+
+def test_counter_is_rebuilt_from_existing_files(tmp_path):
+    for name in ("000.jpg", "001.png", "004.webp", "cover.jpg"):
+        (tmp_path / name).write_bytes(b"x")
+    (tmp_path / COUNTER_NAME).write_text("garbage")
+    assert allocate_indices(str(tmp_path), 2) == range(5, 7)
+    assert (tmp_path / COUNTER_NAME).read_text() == "7"
+
+
+def test_reserve_indices_never_moves_the_counter_back(tmp_path):
+    reserve_indices(str(tmp_path), 10)
+    reserve_indices(str(tmp_path), 4)
+    assert allocate_indices(str(tmp_path)) == range(10, 11)
+
+
+def test_manifest_round_trip_and_verify(tmp_path):
+    image = tmp_path / "000.jpg"
+    image.write_bytes(b"image-bytes")
+    manifest = ChapterManifest(str(tmp_path))
+    manifest.record("000.jpg", "https://cdn/1.jpg", 11, sha256_file(str(image)))
+    manifest.save()
+
+    reloaded = ChapterManifest(str(tmp_path))
+    assert reloaded.get("000.jpg")["url"] == "https://cdn/1.jpg"
+    assert reloaded.verify("000.jpg")
+
+    # Same size, different content: only the hash check catches it
+    image.write_bytes(b"IMAGE-BYTES")
+    assert reloaded.verify("000.jpg", check_hash=False)
+    assert not reloaded.verify("000.jpg")
+
+    image.write_bytes(b"short")
+    assert not reloaded.verify("000.jpg", check_hash=False)
+    assert not reloaded.verify("missing.jpg")
+
+
+def test_manifest_save_only_writes_changes(tmp_path):
+    manifest = ChapterManifest(str(tmp_path))
+    manifest.save()
+    assert not (tmp_path / MANIFEST_NAME).exists()
+
+    manifest.record("000.jpg", "u", 1, "0" * 64)
+    manifest.forget("000.jpg")
+    manifest.save()
+    assert ChapterManifest(str(tmp_path)).entries == {}
+
+
+def test_unreadable_manifest_starts_empty(tmp_path):
+    (tmp_path / MANIFEST_NAME).write_text("{not json")
+    assert ChapterManifest(str(tmp_path)).entries == {}
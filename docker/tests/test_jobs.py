@@ -0,0 +1,125 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from scripts.fastapi_server import run_job
+from scripts.jobs import JobQueue, JobQueueFull, get_job
+
+
+def _wait_until_running(job) -> None:
+    deadline = time.monotonic() + 5
+    while job.status != "running" and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert job.status == "running"
+
+
+@pytest.fixture
+def gate():
+    """An event the blocking jobs wait on; always released on teardown."""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+@pytest.fixture
+def busy_queue(gate):
+    """A one-worker queue whose worker is stuck on `gate`."""
+    jobs = JobQueue("test", workers=1, max_pending=2)
+    blocker = jobs.submit("blocker", gate.wait, 10)
+    _wait_until_running(blocker)
+    yield jobs
+    gate.set()
+    jobs.shutdown()
+
+
+def test_submit_runs_jobs_and_records_them():
+    jobs = JobQueue("test", workers=2)
+    job = jobs.submit("add", lambda a, b: a + b, 2, 3)
+    assert job.future.result(5) == 5
+    assert get_job(job.id) is job
+    assert (job.status, job.result, job.error) == ("done", 5, None)
+
+    failing = jobs.submit("fail", lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        failing.future.result(5)
+    assert failing.status == "failed"
+    jobs.shutdown()
+
+
+def test_cancelled_jobs_free_their_slot_and_never_run(busy_queue, gate):
+    ran = []
+    first = busy_queue.submit("first", ran.append, "first")
+    busy_queue.submit("second", ran.append, "second")
+    assert busy_queue.depth == 2
+    with pytest.raises(JobQueueFull):
+        busy_queue.submit("third", ran.append, "third")
+
+    assert busy_queue.cancel(first)
+    assert (first.status, busy_queue.depth) == ("cancelled", 1)
+    third = busy_queue.submit("third", ran.append, "third")
+
+    gate.set()
+    third.future.result(5)
+    assert ran == ["second", "third"]
+    assert busy_queue.depth == 0
+
+
+def test_running_jobs_cannot_be_cancelled(gate):
+    jobs = JobQueue("test", workers=1)
+    job = jobs.submit("block", gate.wait, 10)
+    _wait_until_running(job)
+    assert not jobs.cancel(job)
+    gate.set()
+    assert job.future.result(5) is True
+    jobs.shutdown()
+
+
+def test_run_job_returns_the_result():
+    jobs = JobQueue("test")
+    assert asyncio.run(run_job(jobs, "echo", False, 5, lambda x: {"x": x}, 1)) == {
+        "x": 1
+    }
+    jobs.shutdown()
+
+
+def test_run_job_background_returns_the_job_id():
+    jobs = JobQueue("test")
+    response = asyncio.run(run_job(jobs, "echo", True, 5, lambda: None))
+    body = json.loads(response.body)
+    assert response.status_code == 202
+    assert body["job"] == f"/jobs/{body['job_id']}"
+    jobs.shutdown()
+
+
+def test_run_job_cancels_a_job_that_never_started(busy_queue):
+    ran = []
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(run_job(busy_queue, "late", False, 0.05, ran.append, 1))
+    assert exc.value.status_code == 504
+    assert "cancelled" in exc.value.detail
+    assert busy_queue.depth == 0
+    assert ran == []
+
+
+def test_run_job_hands_back_a_running_job(gate):
+    jobs = JobQueue("test")
+    response = asyncio.run(run_job(jobs, "slow", False, 0.05, gate.wait, 10))
+    body = json.loads(response.body)
+    assert (response.status_code, body["status"]) == (202, "Running")
+
+    job = get_job(body["job_id"])
+    gate.set()
+    assert job.future.result(5) is True
+    assert job.status == "done"
+    jobs.shutdown()
+
+
+def test_run_job_rejects_a_full_queue(busy_queue):
+    busy_queue.submit("a", print)
+    busy_queue.submit("b", print)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(run_job(busy_queue, "c", False, 1, print))
+    assert exc.value.status_code == 503
@@ -0,0 +1,79 @@
+import pytest
+from scripts import metrics
+from scripts.metrics import Counter, Gauge, Histogram, Registry
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, "registry", registry)
+    return registry
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    hist = Histogram("t_seconds", "Test latency.", ("op",), buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 3):
+        hist.observe(value, op="a")
+    hist.observe(0.2, op="b")
+    assert hist.render() == [
+        "# HELP t_seconds Test latency.",
+        "# TYPE t_seconds histogram",
+        't_seconds_bucket{op="a",le="0.1"} 2',
+        't_seconds_bucket{op="a",le="1"} 3',
+        't_seconds_bucket{op="a",le="+Inf"} 4',
+        't_seconds_sum{op="a"} 3.65',
+        't_seconds_count{op="a"} 4',
+        't_seconds_bucket{op="b",le="0.1"} 0',
+        't_seconds_bucket{op="b",le="1"} 1',
+        't_seconds_bucket{op="b",le="+Inf"} 1',
+        't_seconds_sum{op="b"} 0.2',
+        't_seconds_count{op="b"} 1',
+    ]
+
+
+def test_histogram_time_observes_failures(registry):
+    hist = Histogram("t_seconds", "Test latency.")
+    with pytest.raises(ValueError):
+        with hist.time():
+            raise ValueError
+    assert hist.render()[-1] == "t_seconds_count 1"
+
+
+def test_counter_escapes_label_values(registry):
+    counter = Counter("t_total", "Test count.", ("path",))
+    counter.inc(path='a"b\\c\nd')
+    counter.inc(2, path='a"b\\c\nd')
+    counter.inc(path="z")
+    assert counter.render()[2:] == [
+        r't_total{path="a\"b\\c\nd"} 3',
+        't_total{path="z"} 1',
+    ]
+
+
+def test_gauge_reads_its_callback(registry):
+    assert Gauge("t_up", "Up.", lambda: 1).render()[-1] == "t_up 1"
+    gauge = Gauge(
+        "t_workers", "Workers.", lambda: {("idle",): 2, ("busy",): 1}, ("state",)
+    )
+    assert gauge.render()[2:] == [
+        't_workers{state="busy"} 1',
+        't_workers{state="idle"} 2',
+    ]
+    assert Gauge("t_free", "Free.", lambda: None).render() == [
+        "# HELP t_free Free.",
+        "# TYPE t_free gauge",
+    ]
+
+
+def test_registry_renders_every_metric(registry):
+    Counter("t_total", "Test count.").inc()
+    Gauge("t_up", "Up.", lambda: 0)
+    Gauge("t_up", "Up again.", lambda: 1)
+    assert registry.render() == (
+        "# HELP t_total Test count.\n"
+        "# TYPE t_total counter\n"
+        "t_total 1\n"
+        "# HELP t_up Up again.\n"
+        "# TYPE t_up gauge\n"
+        "t_up 1\n"
+    )
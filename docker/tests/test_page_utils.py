@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from scripts import page_utils
+from scripts.page_utils import LAZY_LOAD_STABLE_POLLS, wait_for_lazy_load
+
+
+class _Page:
+    """Replays a list of scroll states, repeating the last one."""
+
+    def __init__(self, states: list[dict]):
+        self.states = states
+        self.polls = 0
+
+    async def evaluate(self, script):
+        self.polls += 1
+        return self.states[min(self.polls, len(self.states)) - 1]
+
+    def on(self, event, handler):
+        pass
+
+    def remove_listener(self, event, handler):
+        pass
+
+
+def _state(images: int, loaded: int, bottom: bool = True) -> dict:
+    return {"images": images, "loaded": loaded, "height": 1000, "bottom": bottom}
+
+
+@pytest.fixture(autouse=True)
+def no_interval(monkeypatch):
+    monkeypatch.setattr(page_utils, "LAZY_LOAD_INTERVAL", 0)
+
+
+def test_settles_once_every_image_has_loaded():
+    page = _Page([_state(3, 1, bottom=False), _state(3, 3)])
+    state = asyncio.run(wait_for_lazy_load(page, timeout=5))
+    assert state == _state(3, 3)
+    assert page.polls == 3
+
+
+def test_an_empty_page_waits_the_full_stability_window():
+    page = _Page([_state(0, 0)])
+    state = asyncio.run(wait_for_lazy_load(page, timeout=5))
+    assert state == _state(0, 0)
+    assert page.polls == LAZY_LOAD_STABLE_POLLS + 1
+
+
+def test_images_appearing_late_are_waited_for():
+    page = _Page([_state(0, 0), _state(0, 0), _state(2, 0), _state(2, 2)])
+    state = asyncio.run(wait_for_lazy_load(page, timeout=5))
+    assert state == _state(2, 2)
@@ -0,0 +1,62 @@
+import ctypes
+
+import pytest
+from scripts import screen_capture
+from scripts.screen_capture import (
+    PILCapture,
+    XShmCapture,
+    _on_io_error,
+    _on_x_error,
+    _XErrorEvent,
+    get_capture_backend,
+)
+
+DISPLAY_PTR = 0x5EED
+
+
+@pytest.fixture
+def capture():
+    # Built without an X server: only the bookkeeping around Xlib is exercised
+    capture = XShmCapture.__new__(XShmCapture)
+    capture.display = ":42"
+    capture.width, capture.height = 1280, 720
+    capture._display = DISPLAY_PTR
+    capture._images = {}
+    yield capture
+    screen_capture._x_errors.pop(DISPLAY_PTR, None)
+    screen_capture._lost_displays.discard(DISPLAY_PTR)
+
+
+def test_clamp_cuts_regions_at_the_screen_edge(capture):
+    assert capture._clamp(None) == (0, 0, 1280, 720)
+    assert capture._clamp((100, 50, 200, 100)) == (100, 50, 200, 100)
+    assert capture._clamp((1200, 700, 200, 100)) == (1200, 700, 80, 20)
+
+
+@pytest.mark.parametrize(
+    "region", [(-1, 0, 10, 10), (0, 720, 10, 10), (1280, 0, 10, 10), (0, 0, 0, 10)]
+)
+def test_clamp_rejects_regions_off_screen(capture, region):
+    with pytest.raises(ValueError):
+        capture._clamp(region)
+
+
+def test_x_errors_raise_instead_of_exiting(capture):
+    event = _XErrorEvent(error_code=8, request_code=130, minor_code=4)
+    assert _on_x_error(DISPLAY_PTR, ctypes.pointer(event)) == 0
+    with pytest.raises(RuntimeError, match=r"X error 8 \(request 130\.4\)"):
+        capture._check("XShmGetImage")
+    capture._check("XShmGetImage")  # reported once
+    assert not capture.closed
+
+
+def test_lost_connection_closes_the_backend(capture, monkeypatch):
+    _on_io_error(DISPLAY_PTR, None)
+    with pytest.raises(RuntimeError, match="Lost X display :42"):
+        capture._check("XShmGetImage")
+    assert capture.closed
+
+    replacement = PILCapture(":42")
+    monkeypatch.setattr(screen_capture, "_backends", {":42": capture})
+    monkeypatch.setattr(screen_capture, "_create_backend", lambda display: replacement)
+    assert get_capture_backend(":42") is replacement
@@ -0,0 +1,95 @@
+import pytest
+from scripts.state_store import ImageState, StateStore
+
+SLUG = "series"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    yield store
+    store.close()
+
+
+def _images(*statuses: str) -> list[ImageState]:
+    return [
+        ImageState(i, f"https://cdn/{i}.jpg", f"{i:03d}.jpg", status)
+        for i, status in enumerate(statuses)
+    ]
+
+
+def test_diff_splits_chapters_by_state(store):
+    store.record_chapter(SLUG, "c/done", "done", "done", images=_images("done"))
+    store.record_chapter(SLUG, "c/failed", "failed", "failed", error="boom")
+    store.record_chapter(
+        SLUG, "c/partial", "partial", "partial", images=_images("done", "failed")
+    )
+    store.record_chapter(SLUG, "c/empty", "empty", "downloading", images=[])
+    store.record_chapter("other", "c/new", "new", "done", images=[])
+
+    plan = store.diff(
+        SLUG,
+        ["c/new", "c/done", "c/failed", "c/partial", "c/empty", "c/new", "c/done"],
+    )
+    assert plan.extract == ["c/new", "c/failed", "c/empty"]
+    assert plan.up_to_date == ["c/done"]
+    assert list(plan.retry) == ["c/partial"]
+    assert [image.idx for image in plan.retry["c/partial"]] == [1]
+    assert plan.to_dict() == {
+        "extract": 3,
+        "retry": 1,
+        "retry_images": 1,
+        "up_to_date": 1,
+    }
+
+
+def test_record_images_completes_a_partial_chapter(store):
+    store.record_chapter(
+        SLUG, "c/1", "1", "partial", images=_images("done", "failed", "pending")
+    )
+    missing = store.missing_images(SLUG, "c/1")
+    store.record_images(
+        SLUG, "c/1", [image._replace(status="done", size=10) for image in missing]
+    )
+    store.record_chapter(SLUG, "c/1", "1", "done")
+
+    assert store.diff(SLUG, ["c/1"]).up_to_date == ["c/1"]
+    (row,) = store.chapters(SLUG)
+    assert (row["images"], row["done"], row["failed"], row["bytes"]) == (3, 3, 0, 20)
+
+
+def test_record_chapter_without_images_keeps_the_image_list(store):
+    store.record_chapter(SLUG, "c/1", "1", "downloading", images=_images("pending"))
+    store.record_chapter(SLUG, "c/1", "1", "failed", error="retry failed")
+
+    chapter = store.chapter(SLUG, "c/1")
+    assert (chapter["status"], chapter["images"], chapter["error"]) == (
+        "failed",
+        1,
+        "retry failed",
+    )
+    assert len(store.missing_images(SLUG, "c/1")) == 1
+
+    store.record_chapter(SLUG, "c/1", "1", "downloading", images=[])
+    assert store.missing_images(SLUG, "c/1") == []
+
+
+def test_unfinished_runs_survive_a_restart(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path)
+    finished = store.start_run(SLUG, {"url": "https://site/series"})
+    running = store.start_run("other", {"url": "https://site/other", "start": 2})
+    store.record_chapter(SLUG, "c/1", "1", "done", images=_images("done"))
+    store.finish_run(finished)
+    store.close()
+
+    store = StateStore(path)
+    try:
+        assert store.unfinished_runs() == [
+            {"id": running, "slug": "other", "url": "https://site/other", "start": 2}
+        ]
+        assert store.diff(SLUG, ["c/1"]).up_to_date == ["c/1"]
+        store.finish_run(running, "failed")
+        assert store.unfinished_runs() == []
+    finally:
+        store.close()
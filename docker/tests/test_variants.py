@@ -0,0 +1,177 @@
+import os
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+from scripts import fastapi_server, variants
+from scripts.chapter_index import ChapterIndex
+from scripts.variants import VariantCache, VariantSpec, transcode
+
+SPEC = VariantSpec("webp", 16, 50)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "000.png"
+    Image.effect_noise((64, 96), 40).convert("RGB").save(path)
+    return str(path)
+
+
+class _Pool:
+    """
+    Runs transcodes on a thread once `gate` is set, or fails them with
+    `error`, in place of the process pool.
+    """
+
+    created: list = []
+
+    def __init__(self, max_workers=None, mp_context=None):
+        self.gate = threading.Event()
+        self.error: BaseException | None = None
+        self.submitted = []
+        type(self).created.append(self)
+
+    def submit(self, fn, *args) -> Future:
+        self.submitted.append(args)
+        job: Future = Future()
+
+        def run():
+            self.gate.wait(5)
+            if self.error is not None:
+                job.set_exception(self.error)
+            else:
+                job.set_result(fn(*args))
+
+        threading.Thread(target=run, daemon=True).start()
+        return job
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.gate.set()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    _Pool.created = []
+    monkeypatch.setattr(variants, "ProcessPoolExecutor", _Pool)
+    return _Pool
+
+
+def test_transcode_scales_down_only(source, tmp_path):
+    dst = tmp_path / "v" / "small.webp"
+    assert transcode(source, str(dst), SPEC) == dst.stat().st_size
+    with Image.open(dst) as img:
+        assert (img.format, img.size) == ("WEBP", (16, 24))
+    transcode(source, str(dst), VariantSpec("png", 512, 50))
+    with Image.open(dst) as img:
+        assert img.size == (64, 96)
+
+
+def test_concurrent_requests_share_one_transcode(pool, source, tmp_path):
+    cache = VariantCache(str(tmp_path / "variants"), workers=1)
+    first = cache.request(source, "ab" * 32, SPEC)
+    second = cache.request(source, "ab" * 32, SPEC)
+    assert first is second
+    assert cache.stats()["pending"] == 1
+
+    pool.created[0].gate.set()
+    path = first.result(5)
+    assert path == cache.path_for("ab" * 32, SPEC)
+    assert len(pool.created[0].submitted) == 1
+    assert cache.request(source, "ab" * 32, SPEC).result(0) == path
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["pending"]) == (1, 1, 0)
+
+
+def test_least_recently_served_variants_are_evicted(pool, source, tmp_path):
+    cache = VariantCache(str(tmp_path / "variants"), workers=1)
+    hashes = ["aa" * 32, "bb" * 32, "cc" * 32]
+    for sha256 in hashes[:2]:
+        future = cache.request(source, sha256, SPEC)
+        pool.created[0].gate.set()
+        future.result(5)
+    size = cache.stats()["bytes"] // 2
+    cache.max_bytes = 2 * size
+
+    cache.request(source, hashes[0], SPEC)  # now more recent than bb
+    cache.request(source, hashes[2], SPEC).result(5)
+    assert cache.stats()["evictions"] == 1
+    assert not os.path.exists(cache.path_for(hashes[1], SPEC))
+    for sha256 in (hashes[0], hashes[2]):
+        assert os.path.exists(cache.path_for(sha256, SPEC))
+
+    # Recency survives a restart through the files' mtimes
+    reloaded = VariantCache(cache.root, max_bytes=2 * size, workers=1)
+    assert list(reloaded._entries) == [
+        cache.path_for(hashes[0], SPEC),
+        cache.path_for(hashes[2], SPEC),
+    ]
+
+
+def test_a_broken_pool_is_replaced(pool, source, tmp_path):
+    cache = VariantCache(str(tmp_path / "variants"), workers=1)
+    broken = cache.request(source, "aa" * 32, SPEC)
+    pool.created[0].error = BrokenProcessPool("worker died")
+    pool.created[0].gate.set()
+    with pytest.raises(BrokenProcessPool):
+        broken.result(5)
+    assert cache.stats()["restarts"] == 1
+
+    retried = cache.request(source, "aa" * 32, SPEC)
+    assert len(pool.created) == 2
+    pool.created[1].gate.set()
+    assert retried.result(5) == cache.path_for("aa" * 32, SPEC)
+
+
+def test_a_pool_that_refuses_work_is_replaced(pool, source, tmp_path):
+    cache = VariantCache(str(tmp_path / "variants"), workers=1)
+    cache._pool = refusing = _Pool()
+
+    def submit(*args):
+        raise BrokenProcessPool("worker died")
+
+    refusing.submit = submit
+    future = cache.request(source, "aa" * 32, SPEC)
+    pool.created[-1].gate.set()
+    assert future.result(5) == cache.path_for("aa" * 32, SPEC)
+    assert cache.stats()["restarts"] == 1
+
+
+def test_spawned_workers_transcode_and_recover(source, tmp_path):
+    cache = VariantCache(str(tmp_path / "variants"), workers=1)
+    try:
+        assert os.path.exists(cache.request(source, "aa" * 32, SPEC).result(60))
+        for process in list(cache._pool._processes.values()):
+            process.kill()
+            process.join(10)
+        # The kill surfaces either on this request or when submitting it
+        try:
+            cache.request(source, "bb" * 32, SPEC).result(60)
+        except BrokenProcessPool:
+            pass
+        assert cache.stats()["restarts"] == 1
+        assert os.path.exists(cache.request(source, "cc" * 32, SPEC).result(60))
+    finally:
+        cache.shutdown()
+
+
+def test_get_image_answers_503_while_the_transcoder_restarts(
+    source, tmp_path, monkeypatch
+):
+    class _Broken:
+        def request(self, src, sha256, spec):
+            future: Future = Future()
+            future.set_exception(BrokenProcessPool("worker died"))
+            return future
+
+    monkeypatch.setattr(fastapi_server, "DATA_DIR", str(tmp_path.parent))
+    monkeypatch.setattr(fastapi_server, "chapter_index", ChapterIndex())
+    monkeypatch.setattr(fastapi_server, "get_variant_cache", _Broken)
+    resp = TestClient(fastapi_server.app).get(
+        "/get_image",
+        params={"chapter": tmp_path.name, "filename": "000.png", "width": 16},
+    )
+    assert resp.status_code == 503
+    assert "retry" in resp.json()["detail"]
@@ -0,0 +1,71 @@
+import pytest
+from fastapi import HTTPException
+from playwright.async_api import Error as PlaywrightError
+from scripts import workers
+from scripts.clearance_cache import ChallengeError
+from scripts.workers import (
+    WORKER_MAX_FAILURES,
+    BrowserWorker,
+    WorkerScheduler,
+    free_workers,
+)
+
+
+class _Pool:
+    def __init__(self):
+        self.connected = True
+
+    def health(self) -> dict:
+        return {"connected": self.connected}
+
+
+@pytest.fixture
+def scheduler():
+    # One worker built without launching or connecting to a browser
+    worker = BrowserWorker.__new__(BrowserWorker)
+    worker.index, worker.display, worker.pool = 0, ":99", _Pool()
+    worker.failures = worker.recycles = worker.jobs = 0
+    worker.busy = False
+    worker.recycle = lambda: setattr(worker, "recycles", worker.recycles + 1)
+    scheduler = WorkerScheduler(1)
+    scheduler.workers.append(worker)
+    scheduler._idle.put(worker)
+    return scheduler
+
+
+def _fail(scheduler, error: Exception) -> BrowserWorker:
+    with pytest.raises(type(error)):
+        with scheduler.lease(timeout=1):
+            raise error
+    return scheduler.workers[0]
+
+
+@pytest.mark.parametrize(
+    "error",
+    [HTTPException(404), ChallengeError("challenge"), ValueError("no images")],
+)
+def test_job_errors_do_not_count_against_a_healthy_worker(scheduler, error):
+    for _ in range(WORKER_MAX_FAILURES + 1):
+        worker = _fail(scheduler, error)
+    assert (worker.failures, worker.recycles) == (0, 0)
+    assert scheduler.free == 1
+
+
+def test_browser_errors_count_and_recycle_the_worker(scheduler):
+    for _ in range(WORKER_MAX_FAILURES):
+        worker = _fail(scheduler, PlaywrightError("Target closed"))
+    assert worker.failures == WORKER_MAX_FAILURES
+    with scheduler.lease(timeout=1):
+        pass
+    assert (worker.failures, worker.recycles) == (0, 1)
+
+
+def test_any_error_counts_once_the_browser_is_gone(scheduler):
+    scheduler.workers[0].pool.connected = False
+    assert _fail(scheduler, ValueError("no images")).failures == 1
+
+
+def test_free_workers_does_not_start_the_scheduler(monkeypatch):
+    monkeypatch.setattr(workers, "_scheduler", None)
+    assert free_workers() is None
+    assert workers._scheduler is None